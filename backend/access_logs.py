@@ -0,0 +1,336 @@
+"""
+Import page views from nginx access logs into the visitors table.
+
+The API only sees clients that reach /api/geolocation; nginx logs every
+page load. This counts successful GETs of pages (not assets, API calls or
+errors) per client IP, skipping bots, blocklisted and bot-range IPs, and
+merges them into visitors:
+
+    python access_logs.py /var/log/nginx/access.log* [--db visitors.db] [--dry-run]
+
+Logs must use nginx's default "combined" format; rotated .gz files are
+read as they are. Files are streamed in READ_CHUNK_BYTES chunks and one
+compiled regex runs over each chunk, so memory stays flat however large
+the log is. Page views are tallied per IP and written every
+IMPORT_BATCH_LINES lines in a single transaction, together with how far
+into the file the import got. Progress is kept per file in job_state,
+keyed by a hash of the file's first line, so a file is recognised after
+logrotate renames or compresses it and an interrupted or repeated import
+carries on where it stopped instead of counting lines twice.
+
+Totals per IP are kept in access_log_visitors. A visitor's visit_count
+becomes the larger of the API's count and the log's count, because both
+count the same page loads. first_visit and last_visit are widened to
+cover both. New visitors are enriched by the running app's geo enricher.
+"""
+import argparse
+import asyncio
+import gzip
+import hashlib
+import re
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from database import VisitorDatabase, default_db_path
+from ipranges import BLOCKED, BOT, INVALID, IPClassifier
+from logs import log
+from ratelimit import is_bot_user_agent
+
+# Bytes read per chunk (only complete lines are parsed; the rest carries over)
+READ_CHUNK_BYTES = 4 * 1024 * 1024
+
+# Lines parsed between transactions, and the most distinct IPs tallied before writing early
+IMPORT_BATCH_LINES = 1_000_000
+IMPORT_BATCH_IPS = 100_000
+
+# Parsed timestamps and user agent verdicts are memoized, up to this many of each
+# (log timestamps only move forward, so a small memo catches nearly every repeat)
+PARSE_CACHE_SIZE = 10_000
+
+# Successful GETs only, in the combined format:
+# $remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" "$http_user_agent"
+# (nginx escapes quotes inside fields as \x22, so [^"]* can't end a field early)
+LOG_LINE_PATTERN = re.compile(
+    rb'^(\S+) \S+ \S+ \[([^\]]+)\] "GET ([^ "?]*)[^"]*" (?:200|304) \S+ "([^"]*)" "([^"]*)"',
+    re.MULTILINE,
+)
+
+# job_state names: uncompressed bytes imported from a file, and whether a (compressed, final) file is done
+STATE_PREFIX = "access_log:"
+
+# Each batch is staged in a temp table and merged with set-based statements, which is
+# several times faster than an upsert per IP (SQLite walks the indexes in key order)
+CREATE_BATCH_TABLE_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS access_log_batch (
+        ip TEXT PRIMARY KEY,
+        visits INTEGER NOT NULL,
+        first_visit TEXT NOT NULL,
+        last_visit TEXT NOT NULL,
+        last_referer TEXT
+    )
+"""
+
+STAGE_BATCH_SQL = """
+    INSERT INTO temp.access_log_batch (ip, visits, first_visit, last_visit, last_referer) VALUES (?, ?, ?, ?, ?)
+"""
+
+UPSERT_LOG_VISITORS_SQL = """
+    INSERT INTO access_log_visitors (ip, visits, first_visit, last_visit, last_referer)
+    SELECT ip, visits, first_visit, last_visit, last_referer FROM temp.access_log_batch WHERE true
+    ON CONFLICT(ip) DO UPDATE SET
+        visits = visits + excluded.visits,
+        first_visit = MIN(first_visit, excluded.first_visit),
+        last_visit = MAX(last_visit, excluded.last_visit),
+        last_referer = CASE WHEN excluded.last_visit >= last_visit THEN excluded.last_referer ELSE last_referer END
+"""
+
+# Both sources count the same page loads, so the larger count wins rather than the sum
+MERGE_VISITORS_SQL = """
+    INSERT INTO visitors (ip, visit_count, first_visit, last_visit, last_referer)
+    SELECT ip, visits, first_visit, last_visit, last_referer FROM access_log_visitors
+    WHERE ip IN (SELECT ip FROM temp.access_log_batch)
+    ON CONFLICT(ip) DO UPDATE SET
+        visit_count = MAX(visit_count, excluded.visit_count),
+        first_visit = MIN(COALESCE(first_visit, excluded.first_visit), excluded.first_visit),
+        last_visit = MAX(COALESCE(last_visit, excluded.last_visit), excluded.last_visit),
+        last_referer = CASE WHEN excluded.last_visit > COALESCE(last_visit, '') THEN excluded.last_referer
+                            ELSE last_referer END
+"""
+
+SAVE_STATE_SQL = """
+    INSERT INTO job_state (name, value) VALUES (?, ?)
+    ON CONFLICT(name) DO UPDATE SET value = excluded.value
+"""
+
+
+def is_page_path(path: bytes) -> bool:
+    """Pages are the SPA's routes and .html files; anything else with an extension is an asset"""
+    if path.startswith(b"/api/"):
+        return False
+    dot = path.rfind(b".")
+    return dot <= path.rfind(b"/") or path.endswith(b".html")
+
+
+class PageViewTally:
+    """Page views from one IP since the last write"""
+
+    __slots__ = ("visits", "first_visit", "last_visit", "last_referer")
+
+    def __init__(self, timestamp: str):
+        self.visits = 0
+        self.first_visit = timestamp
+        self.last_visit = timestamp
+        self.last_referer = ""
+
+
+class AccessLogImporter:
+    """Parses access log chunks into per-IP tallies and writes them to the visitors database"""
+
+    def __init__(
+        self,
+        db: Optional[VisitorDatabase],
+        classifier: IPClassifier,
+        batch_lines: int = IMPORT_BATCH_LINES,
+        batch_ips: int = IMPORT_BATCH_IPS,
+    ):
+        self.db = db  # None for a dry run: parse and count, write nothing
+        self.classifier = classifier
+        self.batch_lines = batch_lines
+        self.batch_ips = batch_ips
+        self._batch: Dict[bytes, PageViewTally] = {}
+        self._timestamps: Dict[bytes, str] = {}
+        self._bot_agents: Dict[bytes, bool] = {}
+        self.lines = 0
+        self.page_views = 0
+        self.bot_views = 0
+        self.skipped_ips = 0
+        self.visitors_written = 0
+
+    def timestamp(self, value: bytes) -> str:
+        """'10/Oct/2025:13:55:36 +0200' as the naive UTC ISO timestamp the visitors table uses"""
+        parsed = self._timestamps.get(value)
+        if parsed is None:
+            if len(self._timestamps) >= PARSE_CACHE_SIZE:
+                self._timestamps.clear()
+            moment = datetime.strptime(value.decode("ascii"), "%d/%b/%Y:%H:%M:%S %z")
+            parsed = self._timestamps[value] = moment.astimezone(timezone.utc).replace(tzinfo=None).isoformat()
+        return parsed
+
+    def is_bot(self, user_agent: bytes) -> bool:
+        verdict = self._bot_agents.get(user_agent)
+        if verdict is None:
+            if len(self._bot_agents) >= PARSE_CACHE_SIZE:
+                self._bot_agents.clear()
+            # nginx logs a missing User-Agent as "-"; live traffic without one counts as a bot, so this does too
+            agent = "" if user_agent == b"-" else user_agent.decode("latin-1")
+            verdict = self._bot_agents[user_agent] = is_bot_user_agent(agent)
+        return verdict
+
+    def parse(self, chunk: bytes):
+        """Tally the page views in chunk, which must end at a line boundary"""
+        self.lines += chunk.count(b"\n")
+        batch = self._batch
+        for match in LOG_LINE_PATTERN.finditer(chunk):
+            ip, time_local, path, referer, user_agent = match.groups()
+            if not is_page_path(path):
+                continue
+            if self.is_bot(user_agent):
+                self.bot_views += 1
+                continue
+            timestamp = self.timestamp(time_local)
+            tally = batch.get(ip)
+            if tally is None:
+                tally = batch[ip] = PageViewTally(timestamp)
+            tally.visits += 1
+            if timestamp < tally.first_visit:
+                tally.first_visit = timestamp
+            if timestamp >= tally.last_visit:
+                tally.last_visit = timestamp
+                tally.last_referer = "" if referer == b"-" else referer.decode("utf-8", "replace")
+            self.page_views += 1
+
+    @property
+    def batch_full(self) -> bool:
+        return len(self._batch) >= self.batch_ips
+
+    def _batch_rows(self) -> List[Tuple[str, int, str, str, str]]:
+        rows = []
+        for ip_bytes, tally in self._batch.items():
+            ip = ip_bytes.decode("latin-1")
+            if self.classifier.classify(ip) in (BLOCKED, BOT, INVALID):
+                self.skipped_ips += 1
+                continue
+            rows.append((ip, tally.visits, tally.first_visit, tally.last_visit, tally.last_referer))
+        return rows
+
+    async def flush(self, state: List[Tuple[str, int]]):
+        """Write the tallied page views and the given job_state progress in one transaction"""
+        rows = self._batch_rows()
+        self._batch = {}
+        if self.db is None:
+            return
+        async with self.db.writer() as conn:
+            await conn.execute(CREATE_BATCH_TABLE_SQL)
+            await conn.executemany(STAGE_BATCH_SQL, rows)
+            await conn.execute(UPSERT_LOG_VISITORS_SQL)
+            await conn.execute(MERGE_VISITORS_SQL)
+            await conn.execute("DELETE FROM temp.access_log_batch")
+            await conn.executemany(SAVE_STATE_SQL, state)
+        self.visitors_written += len(rows)
+
+    async def load_state(self, name: str) -> int:
+        if self.db is None:
+            return 0
+        async with self.db.reader() as conn:
+            cursor = await conn.execute("SELECT value FROM job_state WHERE name = ?", (name,))
+            row = await cursor.fetchone()
+        return row[0] if row else 0
+
+    async def import_file(self, path: Path):
+        """Import one log file from wherever the last import of it stopped"""
+        compressed = path.suffix == ".gz"
+        with open_log(path, compressed) as f:
+            first_line = f.readline(64 * 1024)
+            if not first_line.endswith(b"\n"):
+                log(f"{path}: no complete line yet, skipping")
+                return
+            key = STATE_PREFIX + hashlib.blake2b(first_line, digest_size=8).hexdigest()
+            if await self.load_state(key + ":complete"):
+                log(f"{path}: already imported")
+                return
+            offset = await self.load_state(key)
+            if offset:
+                log(f"{path}: resuming at byte {offset}")
+            skip_to(f, offset, compressed)
+
+            start = time.perf_counter()
+            lines_at_flush = self.lines
+            for chunk in read_lines(f):
+                self.parse(chunk)
+                offset += len(chunk)
+                if self.lines - lines_at_flush >= self.batch_lines or self.batch_full:
+                    await self.flush([(key, offset)])
+                    lines_at_flush = self.lines
+                    log(f"{path}: {offset / (1024 * 1024):.0f} MB, {self.lines} lines, "
+                        f"{self.page_views} page views, {self.lines / (time.perf_counter() - start):.0f} lines/s")
+            # A rotated, compressed log never changes again, so later runs can skip it without reading it
+            state = [(key, offset)] + ([(key + ":complete", 1)] if compressed else [])
+            await self.flush(state)
+        log(f"{path}: imported up to byte {offset} in {time.perf_counter() - start:.1f}s")
+
+    def stats(self) -> dict:
+        return {
+            "lines": self.lines,
+            "page_views": self.page_views,
+            "bot_page_views": self.bot_views,
+            "skipped_ips": self.skipped_ips,
+            "visitors_written": self.visitors_written,
+        }
+
+
+def open_log(path: Path, compressed: bool) -> BinaryIO:
+    return gzip.open(path, "rb") if compressed else open(path, "rb")
+
+
+def skip_to(f: BinaryIO, offset: int, compressed: bool):
+    """Position f at offset uncompressed bytes (gzip can't seek, so compressed files are read up to it)"""
+    if not compressed:
+        f.seek(offset)
+        return
+    f.seek(0)
+    remaining = offset
+    while remaining > 0:
+        skipped = len(f.read(min(remaining, READ_CHUNK_BYTES)))
+        if not skipped:
+            break
+        remaining -= skipped
+
+
+def read_lines(f: BinaryIO, chunk_size: int = READ_CHUNK_BYTES) -> Iterator[bytes]:
+    """Chunks of complete lines; a trailing partial line (still being written) is left unread"""
+    tail = b""
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            return
+        data = tail + data
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            tail = data
+            continue
+        tail = data[end:]
+        yield data[:end]
+
+
+async def run_import(args):
+    db = None
+    if not args.dry_run:
+        db = VisitorDatabase(args.db, reader_count=1)
+        await db.open()
+    try:
+        importer = AccessLogImporter(db, IPClassifier.from_env(), batch_lines=args.batch_lines)
+        # Oldest first, so progress is logged in the order the traffic happened
+        for path in sorted(args.paths, key=lambda p: p.stat().st_mtime):
+            await importer.import_file(path)
+        log(f"Import finished: {importer.stats()}")
+    finally:
+        if db is not None:
+            await db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", type=Path, help="Access log files (plain or .gz)")
+    parser.add_argument(
+        "--db", type=Path,
+        default=default_db_path(),
+    )
+    parser.add_argument("--batch-lines", type=int, default=IMPORT_BATCH_LINES, help="Lines per transaction")
+    parser.add_argument("--dry-run", action="store_true", help="Parse and count only; don't touch the database")
+    asyncio.run(run_import(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Benchmark access_logs.py: import throughput and importer memory per log size.
+
+Writes a synthetic nginx access log per --lines size (a mix of page views,
+assets, API calls, errors and bots from --ips distinct clients, about 60%
+of them counted as page views), gzips a copy, then imports each into a
+scratch visitors database with access_logs.py in a subprocess while
+sampling its resident memory from /proc. Peak memory should stay flat as
+--lines grows; it depends on --ips (one tally per client per batch).
+
+Run from the backend directory:
+    python bench/bench_access_logs.py [--lines 100000,1000000,5000000] [--ips 50000]
+"""
+import argparse
+import gzip
+import json
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from bench_export import BACKEND_DIR, MemorySampler
+
+USER_AGENTS = [
+    "Mozilla/5.0 (X11; Linux x86_64; rv:140.0) Gecko/20100101 Firefox/140.0",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 18_5 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148 Safari/604.1",
+    "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)",
+]
+# (request line, status, weight): pages, assets, API calls, errors
+REQUESTS = [
+    ("GET / HTTP/2.0", 200, 30),
+    ("GET /trace HTTP/2.0", 200, 15),
+    ("GET /notes?page=2 HTTP/2.0", 304, 15),
+    ("GET /assets/index-4f2a.js HTTP/2.0", 200, 15),
+    ("GET /api/geolocation HTTP/2.0", 200, 15),
+    ("POST /api/notes HTTP/2.0", 405, 5),
+    ("GET /wp-login.php HTTP/2.0", 404, 5),
+]
+
+
+def write_log(path: Path, lines: int, ips: int, seed: int = 1):
+    rng = random.Random(seed)
+    requests = [(line, status) for line, status, weight in REQUESTS for _ in range(weight)]
+    start = datetime(2025, 6, 1)
+    with open(path, "w") as f:
+        for i in range(lines):
+            n = rng.randrange(ips)
+            ip = f"11.{n // 65536}.{n // 256 % 256}.{n % 256}"
+            moment = (start + timedelta(seconds=i // 20)).strftime("%d/%b/%Y:%H:%M:%S +0000")
+            request, status = rng.choice(requests)
+            referer = "https://www.google.com/" if i % 5 == 0 else "-"
+            agent = USER_AGENTS[0 if i % 10 < 6 else 1 if i % 10 < 9 else 2]
+            f.write(f'{ip} - - [{moment}] "{request}" {status} 1234 "{referer}" "{agent}"\n')
+
+
+def run_import(log_path: Path, db_path: Path) -> dict:
+    start = time.perf_counter()
+    importer = subprocess.Popen(
+        [sys.executable, "access_logs.py", str(log_path), "--db", str(db_path)],
+        cwd=str(BACKEND_DIR), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+    )
+    sampler = MemorySampler(importer.pid)
+    sampler.start()
+    output, _ = importer.communicate()
+    elapsed = time.perf_counter() - start
+    peak = sampler.stop()
+    if importer.returncode:
+        raise RuntimeError(f"access_logs.py failed:\n{output}")
+    return {"seconds": round(elapsed, 2), "importer_rss_peak_mb": peak}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", default="100000,1000000,5000000", help="Comma-separated log sizes")
+    parser.add_argument("--ips", type=int, default=50_000, help="Distinct client IPs in each log")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for lines in (int(n) for n in args.lines.split(",")):
+            log_path = Path(tmp) / "access.log"
+            write_log(log_path, lines, args.ips)
+            gz_path = Path(tmp) / "access.log.1.gz"
+            with open(log_path, "rb") as src, gzip.open(gz_path, "wb", compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst)
+            size_mb = log_path.stat().st_size / (1024 * 1024)
+            for name, path in (("plain", log_path), ("gzip", gz_path)):
+                db_path = Path(tmp) / f"visitors-{name}.db"
+                result = run_import(path, db_path)
+                result.update(
+                    lines=lines, format=name, log_mb=round(size_mb, 1),
+                    lines_per_second=round(lines / result["seconds"]),
+                    mb_per_second=round(size_mb / result["seconds"], 1),
+                )
+                print(f"  {lines} lines, {name}: {result}", file=sys.stderr)
+                results.append(result)
+                for suffix in ("", "-wal", "-shm"):
+                    Path(f"{db_path}{suffix}").unlink(missing_ok=True)
+            log_path.unlink()
+            gz_path.unlink()
+    print(json.dumps({"ips": args.ips, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
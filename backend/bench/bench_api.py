@@ -0,0 +1,362 @@
+"""
+Load test the API: throughput and p50/p95/p99 latency per endpoint, as JSON.
+
+Everything the app needs is generated: a synthetic GeoLite2 .mmdb
+(mmdb_fixture.py), a scratch visitors database per --rows size
+(bench_export.py) and a stub Nominatim server that answers every reverse
+lookup after --nominatim-latency-ms. Each dataset is served two ways:
+
+    inprocess  the ASGI app driven through httpx's ASGITransport (no sockets)
+    uvicorn    a local uvicorn subprocess over HTTP; with --workers N > 1, N
+               workers in front of a visit writer process (visit_writer.py)
+
+Scenarios:
+
+    resume             GET /api/resume
+    visitors           GET /api/visitors (first page; served from the response cache)
+    visitors_uncached  GET /api/visitors?since=... (unique per request, so every one hits SQLite)
+    geolocation        GET /api/geolocation, X-Forwarded-For cycling over fixture IPs
+                       and reverse geocodes its coordinates)
+
+The geocode cache is seeded with the fixture's cities, so geolocation
+measures the steady state. With --cold-geocode-cache every city is looked
+up through the stub instead, queued behind the app's 1 request/second
+Nominatim limit, and requests that miss the deadline answer without one.
+
+Run from the backend directory:
+    python bench/bench_api.py [--rows 1000,100000,1000000] [--mode inprocess|uvicorn|both]
+        [--scenarios resume,visitors,...] [--requests 2000] [--concurrency 16]
+        [--nominatim-latency-ms 200] [--cold-geocode-cache] [--workers 1]
+        [--output results.json] [--compare baseline.json]
+
+Results carry the git commit they were measured at; --compare prints the
+change in throughput and latency against an earlier --output file.
+"""
+import argparse
+import asyncio
+import contextlib
+import importlib
+import itertools
+import json
+import math
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import httpx
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from bench_export import create_database, free_port, start_server  # noqa: E402
+from geocoding import GEOCODE_CACHE_TTL_SECONDS, GeocodeCache  # noqa: E402
+from mmdb_fixture import CITIES, fixture_ips, write_fixture  # noqa: E402
+
+# Networks in the generated GeoLite2 fixture, and the build the app will report for it
+FIXTURE_NETWORKS = 65536
+FIXTURE_BUILD_EPOCH = 1
+FIXTURE_VERSION = f"GeoLite2-City:{FIXTURE_BUILD_EPOCH}"
+
+# Sent with every request, so /api/geolocation doesn't shed the benchmark as a bot
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64; rv:140.0) Gecko/20100101 Firefox/140.0"
+
+# Requests sent before measuring each scenario (warms caches and connections)
+WARMUP_REQUESTS = 50
+
+Request = Tuple[str, Dict[str, str]]
+
+SCENARIOS: Dict[str, Callable[[int, List[str]], Request]] = {
+    "resume": lambda i, ips: ("/api/resume", {}),
+    "visitors": lambda i, ips: ("/api/visitors", {}),
+    "visitors_uncached": lambda i, ips: (f"/api/visitors?since=2025-06-01T00:00:00.{i:06d}", {}),
+    "geolocation": lambda i, ips: ("/api/geolocation", {"X-Forwarded-For": ips[i % len(ips)]}),
+}
+
+
+class StubNominatim:
+    """Answers Nominatim /reverse requests with a fixed address after a delay"""
+
+    def __init__(self, latency_ms: float):
+        stub = self
+        self.latency = latency_ms / 1000
+        self.requests = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests += 1
+                time.sleep(stub.latency)
+                body = json.dumps({
+                    "lat": "0", "lon": "0", "display_name": "Bench Road, Bench City",
+                    "address": {"road": "Bench Road", "city": "Bench City"},
+                }).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def domain(self) -> str:
+        return f"127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self) -> "StubNominatim":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def seed_geocode_cache(db_path: Path):
+    """Cache a street location for every fixture city, as if each had been looked up before"""
+    now = time.time()
+    conn = sqlite3.connect(str(db_path))
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO geocode_cache (coord_key, street_location, expires_at, fetched_at) "
+            "VALUES (?, ?, ?, ?)",
+            [
+                (GeocodeCache.coord_key((lat, lng)), f"Bench Road, {city}", now + GEOCODE_CACHE_TTL_SECONDS, now)
+                for city, _, _, _, lat, lng, _ in CITIES
+            ],
+        )
+    conn.close()
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Nearest-rank percentile"""
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+async def run_scenario(client: httpx.AsyncClient, name: str, ips: List[str], requests: int, concurrency: int) -> dict:
+    make_request = SCENARIOS[name]
+    index = itertools.count()
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    errors = 0
+
+    async def worker(count: int, record: bool):
+        nonlocal errors
+        while (i := next(index)) < count:
+            path, headers = make_request(i, ips)
+            start = time.perf_counter()
+            try:
+                response = await client.get(path, headers=headers)
+                await response.aread()
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            if record:
+                latencies.append(time.perf_counter() - start)
+                statuses[response.status_code] += 1
+
+    await asyncio.gather(*(worker(WARMUP_REQUESTS, False) for _ in range(concurrency)))
+    index = itertools.count(WARMUP_REQUESTS)
+    errors = 0
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(WARMUP_REQUESTS + requests, True) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    result = {
+        "requests": len(latencies),
+        "errors": errors,
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+    }
+    if latencies:
+        result["latency_ms"] = {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p95": round(percentile(latencies, 95) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "max": round(latencies[-1] * 1000, 2),
+        }
+    return result
+
+
+async def run_scenarios(client: httpx.AsyncClient, args, ips: List[str]) -> Dict[str, dict]:
+    results = {}
+    for name in args.scenarios:
+        results[name] = await run_scenario(client, name, ips, args.requests, args.concurrency)
+        print(f"  {name}: {results[name]['requests_per_second']} req/s, "
+              f"{results[name].get('latency_ms')}", file=sys.stderr)
+    return results
+
+
+async def bench_inprocess(db_path: Path, env: dict, args, ips: List[str]) -> Dict[str, dict]:
+    """Drive a freshly imported app (module globals are per dataset) through ASGITransport"""
+    os.environ.update(env, VISITORS_DB_PATH=str(db_path))
+    with contextlib.redirect_stdout(sys.stderr):
+        main = importlib.reload(sys.modules["main"]) if "main" in sys.modules else importlib.import_module("main")
+        async with main.app.router.lifespan_context(main.app):
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://bench", headers={"User-Agent": USER_AGENT}, timeout=None
+            ) as client:
+                return await run_scenarios(client, args, ips)
+
+
+def start_visit_writer(db_path: Path, env: dict) -> subprocess.Popen:
+    """Start visit_writer.py and wait until its socket is listening"""
+    socket_path = Path(env["VISIT_WRITER_SOCKET"])
+    writer = subprocess.Popen(
+        [sys.executable, "visit_writer.py"], cwd=str(BACKEND_DIR),
+        env=dict(os.environ, **env, VISITORS_DB_PATH=str(db_path)),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while not socket_path.exists():
+        if time.monotonic() > deadline or writer.poll() is not None:
+            writer.kill()
+            raise RuntimeError("visit writer did not start")
+        time.sleep(0.1)
+    return writer
+
+
+async def bench_uvicorn(db_path: Path, env: dict, args, ips: List[str]) -> Dict[str, dict]:
+    port = free_port()
+    writer = None
+    if args.workers > 1:
+        env = dict(env, VISIT_WRITER_SOCKET=str(db_path.with_suffix(".sock")))
+        writer = start_visit_writer(db_path, env)
+    server = start_server(db_path, port, env, workers=args.workers)
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{port}", headers={"User-Agent": USER_AGENT}, limits=limits, timeout=None
+        ) as client:
+            return await run_scenarios(client, args, ips)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+        if writer is not None:
+            writer.terminate()
+            writer.wait(timeout=30)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=str(BACKEND_DIR),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def compare(results: List[dict], baseline_path: Path):
+    """Print throughput and latency changes against a baseline results file"""
+    baseline = {
+        (entry["mode"], entry["rows"], entry["scenario"]): entry
+        for entry in json.loads(baseline_path.read_text())["results"]
+    }
+    print(f"\nCompared with {baseline_path}:", file=sys.stderr)
+    for entry in results:
+        old = baseline.get((entry["mode"], entry["rows"], entry["scenario"]))
+        if old is None or "latency_ms" not in old or "latency_ms" not in entry:
+            continue
+        changes = [f"req/s {change(old['requests_per_second'], entry['requests_per_second'])}"]
+        for p in ("p50", "p95", "p99"):
+            changes.append(f"{p} {change(old['latency_ms'][p], entry['latency_ms'][p])}")
+        print(f"  {entry['mode']:>9} {entry['rows']:>8} {entry['scenario']:<18} {', '.join(changes)}", file=sys.stderr)
+
+
+def change(old: float, new: float) -> str:
+    return f"{old} -> {new} ({(new - old) / old * 100:+.1f}%)" if old else f"{old} -> {new}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", default="1000,100000,1000000", help="Comma-separated visitor counts")
+    parser.add_argument("--mode", choices=["inprocess", "uvicorn", "both"], default="both")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated scenario names")
+    parser.add_argument("--requests", type=int, default=2000, help="Measured requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--nominatim-latency-ms", type=float, default=200)
+    parser.add_argument("--cold-geocode-cache", action="store_true", help="Don't seed the geocode cache")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers (more than 1 adds a visit writer)")
+    parser.add_argument("--output", type=Path, help="Also write the results here")
+    parser.add_argument("--compare", type=Path, help="Earlier --output file to compare against")
+    args = parser.parse_args()
+    args.scenarios = args.scenarios.split(",")
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)} (choose from {', '.join(SCENARIOS)})")
+    row_counts = [int(rows) for rows in args.rows.split(",")]
+    modes = ["inprocess", "uvicorn"] if args.mode == "both" else [args.mode]
+
+    ips = fixture_ips(WARMUP_REQUESTS + args.requests, FIXTURE_NETWORKS)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp, StubNominatim(args.nominatim_latency_ms) as nominatim:
+        mmdb_path = write_fixture(Path(tmp) / "GeoLite2-City.mmdb", FIXTURE_NETWORKS, build_epoch=FIXTURE_BUILD_EPOCH)
+        env = {
+            "GEOIP_DATABASE_PATH": str(mmdb_path),
+            "GEOIP_MIN_SIZE_MB": "0",
+            "NOMINATIM_DOMAIN": nominatim.domain,
+            "NOMINATIM_SCHEME": "http",
+            # Every request comes from a handful of fixture IPs
+            "RATE_LIMITS": "off",
+        }
+        for rows in row_counts:
+            db_path = Path(tmp) / f"visitors-{rows}.db"
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(sys.stderr):
+                create_database(db_path, rows, geo_source=FIXTURE_VERSION)
+            if not args.cold_geocode_cache:
+                seed_geocode_cache(db_path)
+            print(f"Created {rows} visitors in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+            for mode in modes:
+                # Each mode starts from the same data, including an empty geocode cache
+                mode_db_path = shutil.copy(db_path, Path(tmp) / f"visitors-{rows}-{mode}.db")
+                print(f"{mode}, {rows} visitors:", file=sys.stderr)
+                bench = bench_inprocess if mode == "inprocess" else bench_uvicorn
+                for scenario, result in asyncio.run(bench(mode_db_path, env, args, ips)).items():
+                    results.append({"mode": mode, "rows": rows, "scenario": scenario, **result})
+                os.remove(mode_db_path)
+            os.remove(db_path)
+        nominatim_requests = nominatim.requests
+
+    report = {
+        "commit": git_commit(),
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "workers": args.workers,
+            "nominatim_latency_ms": args.nominatim_latency_ms,
+            "geocode_cache": "cold" if args.cold_geocode_cache else "seeded",
+            "nominatim_requests": nominatim_requests,
+        },
+        "results": results,
+    }
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+    if args.compare:
+        compare(results, args.compare)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Benchmark geo_backfill.py against the app's GeoEnricher on a stale database.
+
+Builds a synthetic GeoLite2 file (mmdb_fixture.py) and, for each run, a
+fresh scratch visitors database of --rows visitors enriched from an older
+build, so every row has to be looked up again and most of them change.
+Then it times GeoEnricher.enrich_pending() in-process (the background
+path, one batch at a time on the event loop) and geo_backfill.py with each
+--workers count. Reverse geocoding is left out: it is bound by Nominatim's
+rate limit, not by this code.
+
+Worker processes only help up to the number of cores; on one core the
+pool mostly adds pickling overhead.
+
+Run from the backend directory:
+    python bench/bench_backfill.py [--rows 200000] [--workers 1,2,4] [--networks 65536]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from bench_export import BACKEND_DIR, create_database
+from mmdb_fixture import write_fixture
+
+from database import VisitorDatabase  # noqa: E402
+from enrichment import GeoEnricher  # noqa: E402
+from geoip import GeoIPDatabase  # noqa: E402
+from ipranges import IPClassifier  # noqa: E402
+
+
+def fresh_database(path: Path, rows: int):
+    for suffix in ("", "-wal", "-shm"):
+        Path(f"{path}{suffix}").unlink(missing_ok=True)
+    create_database(path, rows, geo_source="old")
+
+
+def stale_rows(path: Path, version: str) -> int:
+    conn = sqlite3.connect(str(path))
+    try:
+        return conn.execute("SELECT COUNT(*) FROM visitors WHERE geo_source IS NOT ?", (version,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+async def run_enricher(db_path: Path) -> str:
+    geoip = GeoIPDatabase(mode="MMAP_EXT", min_size_mb=0)
+    geoip.load()
+    version = geoip.lookup.version
+    db = VisitorDatabase(db_path)
+    await db.open()
+    try:
+        classifier = IPClassifier.from_env()
+        enricher = GeoEnricher(db, lambda: geoip.lookup, lambda: None, classifier.is_special)
+        await enricher.enrich_pending()
+    finally:
+        await db.close()
+        geoip.close()
+    return version
+
+
+def run_backfill(db_path: Path, workers: int, env: dict):
+    subprocess.run(
+        [sys.executable, "geo_backfill.py", "--db", str(db_path), "--workers", str(workers), "--no-geocode"],
+        cwd=str(BACKEND_DIR), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--workers", default="1,2,4", help="Comma-separated worker counts for geo_backfill.py")
+    parser.add_argument("--networks", type=int, default=65536, help="Networks in the synthetic GeoLite2 file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        mmdb_path = write_fixture(Path(tmp) / "GeoLite2-City.mmdb", args.networks)
+        os.environ.update(GEOIP_DATABASE_PATH=str(mmdb_path), GEOIP_MIN_SIZE_MB="0")
+        db_path = Path(tmp) / "visitors.db"
+
+        fresh_database(db_path, args.rows)
+        start = time.perf_counter()
+        version = asyncio.run(run_enricher(db_path))
+        elapsed = time.perf_counter() - start
+        results.append({"job": "GeoEnricher", "workers": 1, "seconds": round(elapsed, 2),
+                        "rows_per_second": round(args.rows / elapsed), "stale_after": stale_rows(db_path, version)})
+        print(f"  {results[-1]}", file=sys.stderr)
+
+        for workers in (int(n) for n in args.workers.split(",")):
+            fresh_database(db_path, args.rows)
+            start = time.perf_counter()
+            run_backfill(db_path, workers, dict(os.environ))
+            elapsed = time.perf_counter() - start
+            results.append({"job": "geo_backfill.py", "workers": workers, "seconds": round(elapsed, 2),
+                            "rows_per_second": round(args.rows / elapsed), "stale_after": stale_rows(db_path, version)})
+            print(f"  {results[-1]}", file=sys.stderr)
+
+    print(json.dumps({"rows": args.rows, "cpus": os.cpu_count(), "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
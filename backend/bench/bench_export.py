@@ -0,0 +1,190 @@
+"""
+Benchmark /api/visitors/export: throughput and server memory while streaming.
+
+Builds a scratch visitors database with synthetic rows, starts the app
+under uvicorn in a subprocess pointed at it (VISITORS_DB_PATH), streams
+the export and samples the server's resident memory from /proc while
+the download runs. Memory should stay flat as --rows grows.
+
+Run from the backend directory:
+    python bench/bench_export.py [--rows 1000000] [--format ndjson|csv] [--compare-all]
+
+--compare-all also fetches /api/visitors?all=true (which builds the whole
+response in memory) for comparison; it is slow and memory hungry at 1M rows.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import httpx
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+from database import VisitorDatabase  # noqa: E402
+from geostats import geohash_encode  # noqa: E402
+
+
+def create_database(path: Path, rows: int, geo_source: str = "bench"):
+    """
+    Scratch visitors database with `rows` enriched visitors. Pass the GeoLite2
+    build the app will load as geo_source, or its enricher re-enriches every row.
+    """
+    async def create_schema():
+        db = VisitorDatabase(path, reader_count=0)
+        await db.open()
+        await db.close()
+    asyncio.run(create_schema())
+
+    conn = sqlite3.connect(str(path))
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+
+    geohash = geohash_encode(19.07, 72.88)
+
+    def generate():
+        for i in range(rows):
+            ip = f"{1 + i // 16777216 % 223}.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}"
+            yield (
+                ip, 1 + i % 97, "2025-01-01T00:00:00", f"2025-06-{1 + i % 28:02d}T12:00:00",
+                "https://vmattoo.dev/trace", 19.07, 72.88, "Mumbai", "Maharashtra", "India", "IN",
+                "Marine Drive", geo_source, "2025-06-01T00:00:00", geohash,
+            )
+
+    conn.executemany(
+        """INSERT INTO visitors (ip, visit_count, first_visit, last_visit, last_referer,
+                                 lat, lng, city, region, country, country_code, street_location,
+                                 geo_source, geo_enriched_at, geohash)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        generate(),
+    )
+    conn.commit()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+class MemorySampler(threading.Thread):
+    def __init__(self, pid: int, interval: float = 0.05):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0.0
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.is_set():
+            self.peak = max(self.peak, rss_mb(self.pid))
+            time.sleep(self.interval)
+
+    def stop(self) -> float:
+        self._done.set()
+        self.join()
+        return round(self.peak, 1)
+
+
+def start_server(db_path: Path, port: int, env: Optional[dict] = None, workers: int = 1) -> subprocess.Popen:
+    env = dict(os.environ, **(env or {}), VISITORS_DB_PATH=str(db_path))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning", "--workers", str(workers)],
+        cwd=str(BACKEND_DIR), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/", timeout=1)
+            return server
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("uvicorn did not start")
+
+
+def measure(server: subprocess.Popen, url: str, stream: bool) -> dict:
+    baseline = rss_mb(server.pid)
+    sampler = MemorySampler(server.pid)
+    sampler.start()
+    start = time.perf_counter()
+    first_byte = None
+    size = 0
+    lines = 0
+    with httpx.stream("GET", url, timeout=None) as response:
+        response.raise_for_status()
+        for chunk in response.iter_bytes():
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            size += len(chunk)
+            if stream:
+                lines += chunk.count(b"\n")
+    elapsed = time.perf_counter() - start
+    peak = sampler.stop()
+    result = {
+        "seconds": round(elapsed, 2),
+        "time_to_first_byte_ms": round((first_byte or 0) * 1000, 1),
+        "bytes": size,
+        "mb_per_second": round(size / (1024 * 1024) / elapsed, 1),
+        "server_rss_before_mb": round(baseline, 1),
+        "server_rss_peak_mb": peak,
+        "server_rss_growth_mb": round(peak - baseline, 1),
+    }
+    if stream:
+        result["lines"] = lines
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--format", choices=["ndjson", "csv"], default="ndjson")
+    parser.add_argument("--compare-all", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "visitors.db"
+        start = time.perf_counter()
+        create_database(db_path, args.rows)
+        print(f"Created {args.rows} rows in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+        port = free_port()
+        server = start_server(db_path, port)
+        try:
+            results = {"rows": args.rows}
+            results["export"] = measure(
+                server, f"http://127.0.0.1:{port}/api/visitors/export?format={args.format}", stream=True
+            )
+            if args.compare_all:
+                results["visitors_all"] = measure(
+                    server, f"http://127.0.0.1:{port}/api/visitors?all=true", stream=False
+                )
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
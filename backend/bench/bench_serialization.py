@@ -0,0 +1,143 @@
+"""
+Microbenchmark: serializing a /api/visitors page of --visitors rows.
+
+Compares the path a plain dict response takes through FastAPI
+(jsonable_encoder + stdlib json, as JSONResponse renders it) against
+stdlib json without jsonable_encoder, and the records + serialization.dumps
+path the endpoints use now (orjson when installed). Each case starts from
+the SQLite row tuples, so building the dicts/records is included.
+
+Reports median and p95 time per response and peak traced memory
+(tracemalloc) while building one, and checks that every case encodes
+the same JSON.
+
+Run from the backend directory:
+    python bench/bench_serialization.py [--visitors 10000] [--repeat 30]
+"""
+import argparse
+import gc
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+from fastapi.encoders import jsonable_encoder
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from records import VisitorRecord  # noqa: E402
+from serialization import dumps, orjson  # noqa: E402
+
+CITIES = [
+    (19.0728, 72.8826, "Mumbai", "Maharashtra", "India", "IN", "Marine Drive, Mumbai"),
+    (37.3388, -121.8914, "San Jose", "California", "United States", "US", None),
+    (51.5085, -0.1257, "London", "England", "United Kingdom", "GB", "Strand, London"),
+]
+
+
+def make_rows(count: int):
+    rows = []
+    for i in range(count):
+        lat, lng, city, region, country, code, street = CITIES[i % len(CITIES)]
+        enriched = i % 10 != 0
+        rows.append((
+            f"{1 + i // 65536 % 223}.{i // 256 % 256}.{i % 256}.{i % 251}",
+            1 + i % 97,
+            "2025-01-01T00:00:00.000000",
+            f"2025-06-{1 + i % 28:02d}T12:00:00.000000",
+            lat if enriched else None, lng if enriched else None,
+            city if enriched else None, region if enriched else None,
+            country if enriched else None, code if enriched else None,
+            street if enriched else None,
+        ))
+    return rows
+
+
+def visitor_row_to_dict(row) -> dict:
+    """The ad-hoc dict /api/visitors used to build per row"""
+    return {
+        "ip": row[0],
+        "visit_count": row[1],
+        "first_visit": row[2],
+        "last_visit": row[3],
+        "geo": {
+            "lat": row[4],
+            "lng": row[5],
+            "city": row[6],
+            "region": row[7],
+            "country": row[8],
+            "countryCode": row[9],
+        } if row[8] is not None else None,
+        "streetLocation": row[10]
+    }
+
+
+def fastapi_default(rows) -> bytes:
+    content = {"visitors": [visitor_row_to_dict(row) for row in rows], "total": len(rows), "next_cursor": None}
+    return json.dumps(
+        jsonable_encoder(content), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def stdlib_json(rows) -> bytes:
+    content = {"visitors": [visitor_row_to_dict(row) for row in rows], "total": len(rows), "next_cursor": None}
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def records_dumps(rows) -> bytes:
+    content = {"visitors": [VisitorRecord.from_row(row) for row in rows], "total": len(rows), "next_cursor": None}
+    return dumps(content)
+
+
+CASES = {
+    "fastapi_jsonable_encoder": fastapi_default,
+    "stdlib_json_dicts": stdlib_json,
+    "records_" + ("orjson" if orjson is not None else "stdlib"): records_dumps,
+}
+
+
+def measure(fn, rows, repeat: int) -> dict:
+    fn(rows)  # Warm up
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(rows)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+
+    gc.collect()
+    tracemalloc.start()
+    body = fn(rows)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "median_ms": round(statistics.median(timings), 2),
+        "p95_ms": round(timings[int(len(timings) * 0.95) - 1], 2),
+        "peak_traced_kb": round(peak / 1024, 1),
+        "bytes": len(body),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--visitors", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=30)
+    args = parser.parse_args()
+
+    rows = make_rows(args.visitors)
+    expected = json.loads(fastapi_default(rows))
+    for name, fn in CASES.items():
+        if json.loads(fn(rows)) != expected:
+            raise SystemExit(f"{name} does not produce the same JSON")
+
+    results = {"visitors": args.visitors}
+    for name, fn in CASES.items():
+        results[name] = measure(fn, rows, args.repeat)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Benchmark visit tracking: SQL statements and latency per /api/geolocation visit.
+
+Compares three implementations against a scratch database:
+  legacy        the old track_visitor + get_visitor_info pair (fresh connection per
+                call, SELECT -> UPDATE/INSERT -> COMMIT -> SELECT, then another SELECT)
+  upsert        one INSERT ... ON CONFLICT DO UPDATE ... RETURNING on the shared writer
+  write_behind  in-memory counting with batched background flushes
+
+It also fires concurrent visits from a single IP at each implementation and
+reports how many of them actually ended up in the database.
+
+Run from the backend directory:
+    python bench/bench_visit_upsert.py [--visits 2000] [--ips 200] [--concurrency 50]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import aiosqlite
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from database import VisitorDatabase  # noqa: E402
+from visits import VisitAccumulator  # noqa: E402
+
+
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, statement):
+        self.count += 1
+
+
+async def legacy_visit(path: Path, ip: str, referer: str, counter: StatementCounter):
+    """The pre-upsert code path, kept here only for comparison"""
+    db = await aiosqlite.connect(str(path))
+    await db.set_trace_callback(counter)
+    try:
+        await db.execute("PRAGMA journal_mode=WAL")
+        await db.execute("PRAGMA synchronous=NORMAL")
+        cursor = await db.execute("SELECT visit_count, first_visit FROM visitors WHERE ip = ?", (ip,))
+        row = await cursor.fetchone()
+        now = datetime.utcnow().isoformat()
+        if row:
+            await db.execute(
+                "UPDATE visitors SET visit_count = ?, last_visit = ?, last_referer = ? WHERE ip = ?",
+                (row[0] + 1, now, referer, ip),
+            )
+        else:
+            await db.execute(
+                "INSERT INTO visitors (ip, visit_count, first_visit, last_visit, last_referer) VALUES (?, ?, ?, ?, ?)",
+                (ip, 1, now, now, referer),
+            )
+        await db.commit()
+        cursor = await db.execute("SELECT visit_count FROM visitors WHERE ip = ?", (ip,))
+        await cursor.fetchone()
+    finally:
+        await db.close()
+
+    db = await aiosqlite.connect(str(path))
+    await db.set_trace_callback(counter)
+    try:
+        cursor = await db.execute("SELECT visit_count, last_referer FROM visitors WHERE ip = ?", (ip,))
+        await cursor.fetchone()
+    finally:
+        await db.close()
+
+
+async def open_database(path: Path, counter: StatementCounter) -> VisitorDatabase:
+    db = VisitorDatabase(path)
+    await db.open()
+    await db._writer.set_trace_callback(counter)
+    for reader in db._all_readers:
+        await reader.set_trace_callback(counter)
+    return db
+
+
+def summarize(latencies, statements, visits):
+    latencies = sorted(latencies)
+    return {
+        "statements_per_visit": round(statements / visits, 2),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 4),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 4),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 4),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 4),
+    }
+
+
+async def persisted_count(path: Path, ip: str) -> int:
+    async with aiosqlite.connect(str(path)) as db:
+        cursor = await db.execute("SELECT visit_count FROM visitors WHERE ip = ?", (ip,))
+        row = await cursor.fetchone()
+    return row[0] if row else 0
+
+
+async def bench_legacy(path: Path, ips, concurrency: int):
+    db = VisitorDatabase(path)
+    await db.open()  # Only used to create the schema
+    await db.close()
+
+    counter = StatementCounter()
+    latencies = []
+    for ip in ips:
+        start = time.perf_counter()
+        await legacy_visit(path, ip, "https://example.com/", counter)
+        latencies.append(time.perf_counter() - start)
+    result = summarize(latencies, counter.count, len(ips))
+
+    async def attempt():
+        try:
+            await legacy_visit(path, "203.0.113.99", "", StatementCounter())
+        except Exception:
+            pass  # "database is locked" counts as a lost visit
+    await asyncio.gather(*(attempt() for _ in range(concurrency)))
+    result["concurrent_visits_persisted"] = await persisted_count(path, "203.0.113.99")
+    return result
+
+
+async def bench_accumulator(path: Path, ips, concurrency: int, write_behind: bool):
+    counter = StatementCounter()
+    db = await open_database(path, counter)
+    accumulator = VisitAccumulator(db, write_behind=write_behind)
+    accumulator.start()
+
+    latencies = []
+    for ip in ips:
+        start = time.perf_counter()
+        await accumulator.record(ip, "https://example.com/")
+        latencies.append(time.perf_counter() - start)
+
+    # Statements spent by the background flusher count against the visits too
+    await accumulator.flush()
+    result = summarize(latencies, counter.count, len(ips))
+
+    await asyncio.gather(*(accumulator.record("203.0.113.99", "") for _ in range(concurrency)))
+    await accumulator.stop()
+    await db.close()
+    result["concurrent_visits_persisted"] = await persisted_count(path, "203.0.113.99")
+    return result
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--visits", type=int, default=2000)
+    parser.add_argument("--ips", type=int, default=200, help="distinct visitor IPs")
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    ips = [f"198.51.100.{i % 250}" if args.ips <= 250 else f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}"
+           for i in range(args.ips)]
+    visits = [ips[i % len(ips)] for i in range(args.visits)]
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        results["legacy"] = await bench_legacy(Path(tmp) / "legacy.db", visits, args.concurrency)
+        results["upsert"] = await bench_accumulator(Path(tmp) / "upsert.db", visits, args.concurrency, False)
+        results["write_behind"] = await bench_accumulator(Path(tmp) / "behind.db", visits, args.concurrency, True)
+
+    for result in results.values():
+        result["concurrent_visits_sent"] = args.concurrency
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,205 @@
+"""
+Generate a synthetic GeoLite2-City style .mmdb file for benchmarks.
+
+Only what the backend reads is written: city, country, subdivisions and
+location, for IPv4 networks. Records come from a small set of cities, so
+many networks share the same coordinates the way real city-level GeoLite2
+data does.
+
+    python bench/mmdb_fixture.py out.mmdb [--networks 65536] [--prefix 24]
+
+Fixture IPs are handed out by fixture_ips(): the first host of each
+generated network, starting at 1.0.0.0.
+"""
+import argparse
+import ipaddress
+import struct
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+CITIES = [
+    ("Mumbai", "Maharashtra", "India", "IN", 19.0728, 72.8826, "Asia/Kolkata"),
+    ("Delhi", "National Capital Territory of Delhi", "India", "IN", 28.6519, 77.2315, "Asia/Kolkata"),
+    ("Bengaluru", "Karnataka", "India", "IN", 12.9634, 77.5855, "Asia/Kolkata"),
+    ("San Jose", "California", "United States", "US", 37.3388, -121.8914, "America/Los_Angeles"),
+    ("Ashburn", "Virginia", "United States", "US", 39.0469, -77.4903, "America/New_York"),
+    ("New York", "New York", "United States", "US", 40.7128, -74.0060, "America/New_York"),
+    ("London", "England", "United Kingdom", "GB", 51.5085, -0.1257, "Europe/London"),
+    ("Frankfurt am Main", "Hesse", "Germany", "DE", 50.1155, 8.6842, "Europe/Berlin"),
+    ("Amsterdam", "North Holland", "Netherlands", "NL", 52.3740, 4.8897, "Europe/Amsterdam"),
+    ("Singapore", "Singapore", "Singapore", "SG", 1.2897, 103.8501, "Asia/Singapore"),
+    ("Tokyo", "Tokyo", "Japan", "JP", 35.6895, 139.6917, "Asia/Tokyo"),
+    ("Sydney", "New South Wales", "Australia", "AU", -33.8678, 151.2073, "Australia/Sydney"),
+    ("Sao Paulo", "Sao Paulo", "Brazil", "BR", -23.5475, -46.6361, "America/Sao_Paulo"),
+    ("Toronto", "Ontario", "Canada", "CA", 43.7064, -79.3986, "America/Toronto"),
+    ("Paris", "Ile-de-France", "France", "FR", 48.8534, 2.3488, "Europe/Paris"),
+    ("Seoul", "Seoul", "South Korea", "KR", 37.5660, 126.9784, "Asia/Seoul"),
+]
+
+METADATA_MARKER = b"\xab\xcd\xefMaxMind.com"
+
+
+class Encoder:
+    """Encodes values in the MaxMind DB data section format"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self._offsets: Dict[str, int] = {}
+
+    def add(self, key: str, value) -> int:
+        """Append value once per key and return its offset in the data section"""
+        offset = self._offsets.get(key)
+        if offset is None:
+            offset = len(self.buffer)
+            self.buffer += encode(value)
+            self._offsets[key] = offset
+        return offset
+
+
+class Uint:
+    """Integer written with an explicit MaxMind DB type (libmaxminddb checks metadata types)"""
+
+    def __init__(self, type_number: int, value: int):
+        self.type_number = type_number
+        self.value = value
+
+
+def _control(type_number: int, size: int) -> bytes:
+    if type_number > 7:
+        first, extended = 0, bytes([type_number - 7])
+    else:
+        first, extended = type_number << 5, b""
+    if size < 29:
+        return bytes([first | size]) + extended
+    if size < 285:
+        return bytes([first | 29]) + extended + bytes([size - 29])
+    if size < 65821:
+        return bytes([first | 30]) + extended + (size - 285).to_bytes(2, "big")
+    return bytes([first | 31]) + extended + (size - 65821).to_bytes(3, "big")
+
+
+def _uint(type_number: int, value: int) -> bytes:
+    payload = value.to_bytes((value.bit_length() + 7) // 8, "big") if value else b""
+    return _control(type_number, len(payload)) + payload
+
+
+def encode(value) -> bytes:
+    if isinstance(value, Uint):
+        return _uint(value.type_number, value.value)
+    if isinstance(value, str):
+        payload = value.encode("utf-8")
+        return _control(2, len(payload)) + payload
+    if isinstance(value, bool):
+        return _control(14, int(value))
+    if isinstance(value, float):
+        return _control(3, 8) + struct.pack(">d", value)
+    if isinstance(value, int):
+        if value < 0:
+            raise ValueError("negative integers are not needed by the fixture")
+        return _uint(6 if value < 2 ** 32 else 9, value)
+    if isinstance(value, dict):
+        out = bytearray(_control(7, len(value)))
+        for key, item in value.items():
+            out += encode(key) + encode(item)
+        return bytes(out)
+    if isinstance(value, list):
+        out = bytearray(_control(11, len(value)))
+        for item in value:
+            out += encode(item)
+        return bytes(out)
+    raise TypeError(f"cannot encode {type(value)!r}")
+
+
+def city_record(index: int) -> dict:
+    city, region, country, code, lat, lng, time_zone = CITIES[index % len(CITIES)]
+    return {
+        "city": {"names": {"en": city}},
+        "continent": {"names": {"en": "Earth"}},
+        "country": {"iso_code": code, "names": {"en": country}},
+        "location": {"latitude": lat, "longitude": lng, "time_zone": time_zone},
+        "subdivisions": [{"names": {"en": region}}],
+    }
+
+
+def fixture_networks(count: int, prefix: int = 24) -> Iterator[ipaddress.IPv4Network]:
+    start = int(ipaddress.IPv4Address("1.0.0.0"))
+    step = 1 << (32 - prefix)
+    for i in range(count):
+        yield ipaddress.IPv4Network((start + i * step, prefix))
+
+
+def fixture_ips(count: int, networks: int, prefix: int = 24) -> List[str]:
+    """count IPs spread over the generated networks (first host of each, cycling)"""
+    nets = list(fixture_networks(networks, prefix))
+    return [str(nets[i % len(nets)].network_address + 1 + (i // len(nets)) % 200) for i in range(count)]
+
+
+def write_fixture(path: Path, networks: int = 65536, prefix: int = 24, build_epoch: Optional[int] = None) -> Path:
+    """Write a GeoLite2-City style database with `networks` networks of size /prefix"""
+    encoder = Encoder()
+    # Each node is [left, right]; a record is ("node", index), ("data", offset) or None
+    nodes: List[list] = [[None, None]]
+
+    for i, network in enumerate(fixture_networks(networks, prefix)):
+        offset = encoder.add(str(i % len(CITIES)), city_record(i))
+        bits = int(network.network_address)
+        node = 0
+        for depth in range(prefix):
+            bit = (bits >> (31 - depth)) & 1
+            if depth == prefix - 1:
+                nodes[node][bit] = ("data", offset)
+                break
+            record = nodes[node][bit]
+            if record is None:
+                nodes.append([None, None])
+                record = ("node", len(nodes) - 1)
+                nodes[node][bit] = record
+            node = record[1]
+
+    node_count = len(nodes)
+
+    def resolve(record) -> int:
+        if record is None:
+            return node_count
+        kind, value = record
+        return value if kind == "node" else node_count + 16 + value
+
+    tree = bytearray()
+    for left, right in nodes:
+        tree += resolve(left).to_bytes(3, "big") + resolve(right).to_bytes(3, "big")
+
+    metadata = {
+        "binary_format_major_version": Uint(5, 2),
+        "binary_format_minor_version": Uint(5, 0),
+        "build_epoch": Uint(9, build_epoch if build_epoch is not None else int(time.time())),
+        "database_type": "GeoLite2-City",
+        "description": {"en": "Synthetic benchmark fixture"},
+        "ip_version": Uint(5, 4),
+        "languages": ["en"],
+        "node_count": Uint(6, node_count),
+        "record_size": Uint(5, 24),
+    }
+
+    path = Path(path)
+    with open(path, "wb") as f:
+        f.write(tree)
+        f.write(b"\x00" * 16)
+        f.write(encoder.buffer)
+        f.write(METADATA_MARKER)
+        f.write(encode(metadata))
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("output", type=Path)
+    parser.add_argument("--networks", type=int, default=65536)
+    parser.add_argument("--prefix", type=int, default=24)
+    args = parser.parse_args()
+    path = write_fixture(args.output, args.networks, args.prefix)
+    print(f"Wrote {args.networks} networks to {path} ({path.stat().st_size / (1024 * 1024):.2f} MB)")
+
+
+if __name__ == "__main__":
+    main()
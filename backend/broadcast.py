@@ -0,0 +1,250 @@
+"""
+In-process fan-out of live events to Server-Sent Events clients.
+
+Every SSE connection is one subscription: a small queue of encoded event
+frames plus one future the connection's task sleeps on. publish() encodes
+an event once and appends the same bytes to every queue, so an event
+costs a few bytes per subscriber however many there are, and an idle
+connection costs no CPU at all. Keep-alive comments come from one timer
+for the whole hub rather than one per connection.
+
+A client that can't keep up (its queue reaches queue_size because the
+socket isn't draining) is dropped: its stream ends and EventSource
+reconnects after the retry delay, then reloads the snapshot it missed.
+A client that disconnects is noticed through the ASGI receive channel,
+since uvicorn silently discards writes to a closed connection.
+
+uvicorn only runs the app's shutdown handlers once every open connection
+has finished, and a stream never finishes on its own. So the hub ends all
+streams itself as soon as the process gets SIGTERM or SIGINT, before
+passing the signal on to uvicorn's own handler.
+"""
+import asyncio
+import functools
+import signal
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from fastapi.responses import Response
+
+from logs import log
+
+# Event frames buffered per subscriber; a subscriber this far behind is dropped
+SUBSCRIBER_QUEUE_SIZE = 64
+
+# Most concurrent subscribers per process; more are refused
+MAX_SUBSCRIBERS = 10_000
+
+# Comment frame sent to everyone this often, so proxies keep idle streams open
+HEARTBEAT_INTERVAL_SECONDS = 15
+
+# Sent first on every stream: how long EventSource waits before reconnecting (ms)
+RETRY_FRAME = b"retry: 5000\n\n"
+HEARTBEAT_FRAME = b": keep-alive\n\n"
+
+# Signals uvicorn shuts down on; every open stream is ended when one arrives
+EXIT_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+
+class Subscription:
+    """One client's pending frames"""
+
+    __slots__ = ("_frames", "_waiter", "closed")
+
+    def __init__(self):
+        self._frames: Deque[bytes] = deque()
+        self._waiter: Optional[asyncio.Future] = None
+        self.closed = False
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def close(self):
+        """End the stream: pending frames are discarded and next_frames() returns None"""
+        self.closed = True
+        self._frames.clear()
+        self._wake()
+
+    def _push(self, frame: bytes, limit: int) -> bool:
+        """Queue a frame; returns False (and closes the subscription) if it is already limit frames behind"""
+        if len(self._frames) >= limit:
+            self.close()
+            return False
+        self._frames.append(frame)
+        self._wake()
+        return True
+
+    async def next_frames(self) -> Optional[bytes]:
+        """Every frame queued so far, waiting for one if there are none; None once closed"""
+        while not self._frames:
+            if self.closed:
+                return None
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        if self.closed:
+            return None
+        frames = b"".join(self._frames)
+        self._frames.clear()
+        return frames
+
+
+class BroadcastHub:
+    """Publishes events to every current subscriber of this process"""
+
+    def __init__(
+        self,
+        queue_size: int = SUBSCRIBER_QUEUE_SIZE,
+        max_subscribers: int = MAX_SUBSCRIBERS,
+        heartbeat_interval: float = HEARTBEAT_INTERVAL_SECONDS,
+    ):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.heartbeat_interval = heartbeat_interval
+        self._subscribers: Dict[Subscription, None] = {}
+        self._next_id = 1
+        self._task: Optional[asyncio.Task] = None
+        # Signal handlers that were installed before ours, put back by stop()
+        self._previous_handlers: Dict[int, object] = {}
+        self.closing = False
+        self.published = 0
+        self.dropped = 0
+        self.refused = 0
+        self.peak_subscribers = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._heartbeat())
+            self._install_exit_handlers(asyncio.get_running_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for sig, handler in self._previous_handlers.items():
+            signal.signal(sig, handler)
+        self._previous_handlers = {}
+        self.close_streams()
+
+    def close_streams(self):
+        """End every open stream and refuse new ones, so the server can shut down"""
+        self.closing = True
+        for subscription in list(self._subscribers):
+            subscription.close()
+        self._subscribers.clear()
+
+    def _install_exit_handlers(self, loop: asyncio.AbstractEventLoop):
+        # Chained in front of uvicorn's handlers, which only set a flag its main loop polls
+        for sig in EXIT_SIGNALS:
+            try:
+                previous = signal.getsignal(sig)
+                signal.signal(sig, functools.partial(self._on_exit_signal, loop, previous))
+            except ValueError:
+                continue  # Not on the main thread; streams end at the graceful shutdown timeout instead
+            self._previous_handlers[sig] = previous
+
+    def _on_exit_signal(self, loop: asyncio.AbstractEventLoop, previous, sig: int, frame):
+        # A signal handler can interrupt the event loop anywhere, so the streams are closed from the loop itself
+        loop.call_soon_threadsafe(self.close_streams)
+        if callable(previous):
+            previous(sig, frame)
+        elif previous == signal.SIG_DFL:
+            signal.signal(sig, signal.SIG_DFL)
+            signal.raise_signal(sig)
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    def subscribe(self) -> Optional[Subscription]:
+        """A new subscription, or None if the process already has max_subscribers or is shutting down"""
+        if self.closing or len(self._subscribers) >= self.max_subscribers:
+            self.refused += 1
+            return None
+        subscription = Subscription()
+        self._subscribers[subscription] = None
+        self.peak_subscribers = max(self.peak_subscribers, len(self._subscribers))
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self._subscribers.pop(subscription, None)
+
+    def publish(self, event: str, data: bytes):
+        """Send one event to every subscriber; data must be a single line (e.g. compact JSON)"""
+        if not self._subscribers:
+            return
+        frame = b"id: %d\nevent: %s\ndata: %s\n\n" % (self._next_id, event.encode(), data)
+        self._next_id += 1
+        self.published += 1
+        self._push(frame)
+
+    def _push(self, frame: bytes):
+        slow = [s for s in self._subscribers if not s._push(frame, self.queue_size)]
+        for subscription in slow:
+            self._subscribers.pop(subscription, None)
+        if slow:
+            self.dropped += len(slow)
+            log(f"Dropped {len(slow)} live stream subscriber(s) that fell {self.queue_size} events behind", level="warning")
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            if self._subscribers:
+                self._push(HEARTBEAT_FRAME)
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": len(self._subscribers),
+            "peak_subscribers": self.peak_subscribers,
+            "published": self.published,
+            "dropped": self.dropped,
+            "refused": self.refused,
+        }
+
+
+class EventStreamResponse(Response):
+    """
+    Streams a subscription as text/event-stream until the client disconnects
+    or is dropped, then unsubscribes. Written directly against ASGI so an
+    idle stream is just two parked tasks: the sender, waiting on its
+    subscription, and a watcher waiting for the disconnect message.
+    """
+
+    media_type = "text/event-stream"
+
+    def __init__(self, hub: BroadcastHub, subscription: Subscription):
+        self.hub = hub
+        self.subscription = subscription
+        self.status_code = 200
+        self.background = None
+        # X-Accel-Buffering stops nginx from holding events back in its proxy buffer
+        self.init_headers({"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    async def __call__(self, scope, receive, send):
+        watcher = asyncio.create_task(self._watch_disconnect(receive))
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            await send({"type": "http.response.body", "body": RETRY_FRAME, "more_body": True})
+            while True:
+                frames = await self.subscription.next_frames()
+                if frames is None:
+                    break
+                await send({"type": "http.response.body", "body": frames, "more_body": True})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        except OSError:
+            pass  # The client went away while we were writing
+        finally:
+            watcher.cancel()
+            self.hub.unsubscribe(self.subscription)
+
+    async def _watch_disconnect(self, receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        self.subscription.close()
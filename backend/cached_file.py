@@ -0,0 +1,203 @@
+import gzip
+import hashlib
+import os
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from fastapi import Request, Response
+
+from response_cache import etag_matches
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# How often the file is stat()ed to notice that it changed
+FILE_CHECK_INTERVAL_SECONDS = 5
+
+# A compressed variant is only kept if it is at least this much smaller
+MIN_COMPRESSION_SAVING = 0.05
+
+
+class FileSnapshot:
+    """One version of a file: its bytes, validators and precompressed variants"""
+
+    __slots__ = ("body", "etag", "last_modified", "mtime", "variants")
+
+    def __init__(self, body: bytes, mtime: float):
+        self.body = body
+        self.etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+        self.mtime = int(mtime)
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        # Content-Encoding -> (body, etag), best compression first
+        self.variants: Dict[str, Tuple[bytes, str]] = {}
+        for encoding, compress in (("br", brotli.compress if brotli else None), ("gzip", _gzip)):
+            if compress is None:
+                continue
+            compressed = compress(body)
+            if len(compressed) <= len(body) * (1 - MIN_COMPRESSION_SAVING):
+                self.variants[encoding] = (compressed, f'{self.etag[:-1]}-{encoding}"')
+
+
+def _gzip(body: bytes) -> bytes:
+    return gzip.compress(body, compresslevel=9, mtime=0)
+
+
+class CachedFile:
+    """
+    A small static file kept in memory with its content hash, so serving it
+    is a dict lookup rather than a stat, open and read per request. The file
+    is re-read when its mtime or size changes (checked at most every
+    FILE_CHECK_INTERVAL_SECONDS).
+    """
+
+    def __init__(self, path: Path, media_type: str, check_interval: float = FILE_CHECK_INTERVAL_SECONDS):
+        self.path = path
+        self.media_type = media_type
+        self.check_interval = check_interval
+        self._snapshot: Optional[FileSnapshot] = None
+        self._signature = None
+        self._checked_at = 0.0
+
+    def get(self) -> Optional[FileSnapshot]:
+        """Current contents, or None if the file doesn't exist"""
+        now = time.monotonic()
+        if self._snapshot is not None and now - self._checked_at < self.check_interval:
+            return self._snapshot
+        self._checked_at = now
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._snapshot = None
+            self._signature = None
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature != self._signature:
+            self._snapshot = FileSnapshot(self.path.read_bytes(), stat.st_mtime)
+            self._signature = signature
+        return self._snapshot
+
+
+def accepted_encodings(accept_encoding: Optional[str]) -> set:
+    """Content codings the client accepts (q=0 means refused)"""
+    accepted = set()
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        if not coding:
+            continue
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+def parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single "bytes=" range into inclusive (start, end).
+    Returns None when the header should be ignored (not bytes, several ranges,
+    or not a valid range at all, per RFC 9110 section 14.2) and raises
+    ValueError when a valid range can't be satisfied.
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start, dash, end = spec.strip().partition("-")
+    # Deliberately not a 416: RFC 9110 section 14.2 says a malformed Range is ignored
+    # and the whole file served with 200. Only a valid range past the end gets 416.
+    if not dash or (start and not start.isdigit()) or (end and not end.isdigit()) or not (start or end):
+        return None
+    if not start:
+        # Suffix range: the last `end` bytes
+        length = int(end)
+        if length == 0 or size == 0:
+            raise ValueError(f"range {range_header!r} not satisfiable for {size} bytes")
+        return max(size - length, 0), size - 1
+    first = int(start)
+    last = int(end) if end else size - 1
+    if end and last < first:
+        return None  # Malformed too (last byte before the first), so ignored the same way
+    if first >= size:
+        raise ValueError(f"range {range_header!r} not satisfiable for {size} bytes")
+    return first, min(last, size - 1)
+
+
+def not_modified(request: Request, snapshot: FileSnapshot, etag: str) -> bool:
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag) or etag_matches(if_none_match, snapshot.etag)
+    if_modified_since = request.headers.get("If-Modified-Since")
+    if if_modified_since:
+        try:
+            return snapshot.mtime <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def cached_file_response(
+    file: CachedFile,
+    request: Request,
+    cache_control: str,
+    content_disposition: Optional[str] = None,
+) -> Optional[Response]:
+    """
+    Serve a CachedFile with ETag/Last-Modified validators (answering 304),
+    single byte ranges (206/416, honouring If-Range) and a precompressed
+    variant when the client accepts one. Returns None if the file is missing.
+    """
+    snapshot = file.get()
+    if snapshot is None:
+        return None
+
+    headers = {
+        "Cache-Control": cache_control,
+        "Last-Modified": snapshot.last_modified,
+        "Accept-Ranges": "bytes",
+    }
+    if content_disposition:
+        headers["Content-Disposition"] = content_disposition
+    if snapshot.variants:
+        headers["Vary"] = "Accept-Encoding"
+
+    range_header = request.headers.get("Range")
+    body, etag = snapshot.body, snapshot.etag
+    if not range_header:
+        # Ranges always refer to the identity encoding, so only whole-file responses are compressed
+        accepted = accepted_encodings(request.headers.get("Accept-Encoding"))
+        for encoding, (compressed, compressed_etag) in snapshot.variants.items():
+            if encoding in accepted:
+                body, etag = compressed, compressed_etag
+                headers["Content-Encoding"] = encoding
+                break
+    headers["ETag"] = etag
+
+    if not_modified(request, snapshot, etag):
+        headers.pop("Content-Encoding", None)
+        return Response(status_code=304, headers=headers)
+
+    if range_header:
+        if_range = request.headers.get("If-Range")
+        # If-Range needs a strong match: the exact ETag, or exactly the Last-Modified date
+        if if_range is None or if_range.strip() in (snapshot.etag, snapshot.last_modified):
+            size = len(snapshot.body)
+            try:
+                byte_range = parse_range(range_header, size)
+            except ValueError:
+                headers["Content-Range"] = f"bytes */{size}"
+                return Response(status_code=416, headers=headers)
+            if byte_range is not None:
+                start, end = byte_range
+                headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+                return Response(
+                    snapshot.body[start:end + 1], status_code=206, media_type=file.media_type, headers=headers
+                )
+
+    return Response(body, media_type=file.media_type, headers=headers)
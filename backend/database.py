@@ -0,0 +1,512 @@
+import asyncio
+import os
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import aiosqlite
+
+from logs import log
+from metrics import stage
+
+# Number of read-only connections kept open for request handlers
+READER_POOL_SIZE = 4
+
+# Size of the per-connection prepared statement cache (sqlite3 default is 128)
+STATEMENT_CACHE_SIZE = 256
+
+# Pragmas applied once per connection when it is opened
+CONNECTION_PRAGMAS = [
+    "PRAGMA synchronous=NORMAL",  # Balance between safety and speed
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+]
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS visitors (
+        ip TEXT PRIMARY KEY,
+        visit_count INTEGER DEFAULT 1,
+        first_visit TEXT,
+        last_visit TEXT,
+        last_referer TEXT
+    )
+    """,
+    # Reverse geocoding results keyed by rounded "lat,lng"; street_location is NULL for negative results
+    """
+    CREATE TABLE IF NOT EXISTS geocode_cache (
+        coord_key TEXT PRIMARY KEY,
+        street_location TEXT,
+        expires_at REAL NOT NULL,
+        fetched_at REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_geocode_cache_fetched_at ON geocode_cache (fetched_at)",
+    # Append-only log of every visit; pruned after VISIT_RETENTION_DAYS once rolled up
+    """
+    CREATE TABLE IF NOT EXISTS visits (
+        id INTEGER PRIMARY KEY,
+        ts TEXT NOT NULL,
+        ip TEXT NOT NULL,
+        referer TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_visits_ts ON visits (ts)",
+    "CREATE INDEX IF NOT EXISTS idx_visits_ip_ts ON visits (ip, ts)",
+    # Visit counts per hour ("2025-06-01T13") and day ("2025-06-01") bucket
+    """
+    CREATE TABLE IF NOT EXISTS visit_rollups (
+        period TEXT NOT NULL,
+        bucket TEXT NOT NULL,
+        visits INTEGER NOT NULL,
+        unique_ips INTEGER NOT NULL,
+        PRIMARY KEY (period, bucket)
+    ) WITHOUT ROWID
+    """,
+    # The same buckets broken down by a dimension ("country" or "referer")
+    """
+    CREATE TABLE IF NOT EXISTS visit_rollup_dimensions (
+        period TEXT NOT NULL,
+        bucket TEXT NOT NULL,
+        dimension TEXT NOT NULL,
+        value TEXT NOT NULL,
+        visits INTEGER NOT NULL,
+        unique_ips INTEGER NOT NULL,
+        PRIMARY KEY (period, bucket, dimension, value)
+    ) WITHOUT ROWID
+    """,
+    # Visitor and visit counts per country, region and city (unused parts of the key are '')
+    """
+    CREATE TABLE IF NOT EXISTS geo_counts (
+        level TEXT NOT NULL,
+        country_code TEXT NOT NULL,
+        region TEXT NOT NULL,
+        city TEXT NOT NULL,
+        country TEXT,
+        visitors INTEGER NOT NULL,
+        visits INTEGER NOT NULL,
+        PRIMARY KEY (level, country_code, region, city)
+    ) WITHOUT ROWID
+    """,
+    # Visitors per geohash cell at each precision; lat/lng is a point inside the
+    # cell (for bounding box queries), lat_sum/lng_sum give the visitors' centroid
+    """
+    CREATE TABLE IF NOT EXISTS geo_cells (
+        precision INTEGER NOT NULL,
+        geohash TEXT NOT NULL,
+        lat REAL NOT NULL,
+        lng REAL NOT NULL,
+        visitors INTEGER NOT NULL,
+        visits INTEGER NOT NULL,
+        lat_sum REAL NOT NULL,
+        lng_sum REAL NOT NULL,
+        PRIMARY KEY (precision, geohash)
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_geo_cells_lat ON geo_cells (precision, lat)",
+    # Progress markers and counters for background jobs, e.g. the last visits.id rolled up
+    """
+    CREATE TABLE IF NOT EXISTS job_state (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )
+    """,
+    # Page views per IP counted from nginx access logs (access_logs.py), merged into visitors
+    """
+    CREATE TABLE IF NOT EXISTS access_log_visitors (
+        ip TEXT PRIMARY KEY,
+        visits INTEGER NOT NULL,
+        first_visit TEXT NOT NULL,
+        last_visit TEXT NOT NULL,
+        last_referer TEXT
+    )
+    """,
+    # Notes shown on the site, with an external-content FTS5 index kept in sync by triggers
+    """
+    CREATE TABLE IF NOT EXISTS notes (
+        id INTEGER PRIMARY KEY,
+        title TEXT NOT NULL,
+        date TEXT NOT NULL,
+        content TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_notes_date ON notes (date DESC, id DESC)",
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+        title, content, content='notes', content_rowid='id', tokenize='porter unicode61'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+        INSERT INTO notes_fts (rowid, title, content) VALUES (NEW.id, NEW.title, NEW.content);
+        INSERT INTO job_state (name, value) VALUES ('notes_version', 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN
+        INSERT INTO notes_fts (notes_fts, rowid, title, content) VALUES ('delete', OLD.id, OLD.title, OLD.content);
+        INSERT INTO job_state (name, value) VALUES ('notes_version', 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE ON notes BEGIN
+        INSERT INTO notes_fts (notes_fts, rowid, title, content) VALUES ('delete', OLD.id, OLD.title, OLD.content);
+        INSERT INTO notes_fts (rowid, title, content) VALUES (NEW.id, NEW.title, NEW.content);
+        INSERT INTO job_state (name, value) VALUES ('notes_version', 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + 1;
+    END
+    """,
+]
+
+# Columns added after the table first shipped; missing ones are added to existing databases on open
+MIGRATED_COLUMNS = [
+    # Geo enrichment, resolved once per IP by the background enricher
+    ("visitors", "lat", "REAL"),
+    ("visitors", "lng", "REAL"),
+    ("visitors", "city", "TEXT"),
+    ("visitors", "region", "TEXT"),
+    ("visitors", "country", "TEXT"),
+    ("visitors", "country_code", "TEXT"),
+    ("visitors", "street_location", "TEXT"),
+    ("visitors", "geo_source", "TEXT"),  # GeoLite2 build the row was enriched from
+    ("visitors", "geo_enriched_at", "TEXT"),
+    ("visitors", "geohash", "TEXT"),  # At GEOHASH_PRECISION, for map clustering
+]
+
+# Indexes that depend on migrated columns
+MIGRATED_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_visitors_unenriched ON visitors (ip) WHERE geo_enriched_at IS NULL",
+    # Located visitors still without a street location, whose reverse geocode the enricher retries
+    "CREATE INDEX IF NOT EXISTS idx_visitors_ungeocoded ON visitors (geo_enriched_at) "
+    "WHERE street_location IS NULL AND lat IS NOT NULL AND lng IS NOT NULL",
+    # Match the /api/visitors sort order so keyset pages are index range scans
+    "CREATE INDEX IF NOT EXISTS idx_visitors_rank ON visitors (visit_count DESC, last_visit DESC, ip DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_visitors_country_rank ON visitors (country_code, visit_count DESC, last_visit DESC, ip DESC)",
+]
+
+# Longest geohash stored on visitors, and the cell sizes geo_cells keeps counts for
+GEOHASH_PRECISION = 6
+GEO_CELL_PRECISIONS = range(2, GEOHASH_PRECISION + 1)
+
+# geo_counts key columns per level, as SQL expressions over a visitors row alias
+GEO_COUNT_LEVELS = {
+    "country": ("COALESCE({row}.country_code, '')", "''", "''"),
+    "region": ("COALESCE({row}.country_code, '')", "COALESCE({row}.region, '')", "''"),
+    "city": ("COALESCE({row}.country_code, '')", "COALESCE({row}.region, '')", "COALESCE({row}.city, '')"),
+}
+
+GEO_KEY_CHANGED = " OR ".join(
+    f"OLD.{column} IS NOT NEW.{column}" for column in ("country_code", "region", "city", "geohash", "lat", "lng")
+)
+
+
+def _geo_stats_add(row: str) -> List[str]:
+    """Statements that count a visitors row into geo_counts and geo_cells"""
+    statements = []
+    for level, key in GEO_COUNT_LEVELS.items():
+        country_code, region, city = (part.format(row=row) for part in key)
+        statements.append(f"""
+            INSERT INTO geo_counts (level, country_code, region, city, country, visitors, visits)
+            VALUES ('{level}', {country_code}, {region}, {city}, {row}.country, 1, {row}.visit_count)
+            ON CONFLICT (level, country_code, region, city) DO UPDATE SET
+                visitors = visitors + 1, visits = visits + excluded.visits,
+                country = COALESCE(excluded.country, country)""")
+    for precision in GEO_CELL_PRECISIONS:
+        statements.append(f"""
+            INSERT INTO geo_cells (precision, geohash, lat, lng, visitors, visits, lat_sum, lng_sum)
+            SELECT {precision}, substr({row}.geohash, 1, {precision}), {row}.lat, {row}.lng, 1, {row}.visit_count, {row}.lat, {row}.lng
+            WHERE {row}.geohash IS NOT NULL
+            ON CONFLICT (precision, geohash) DO UPDATE SET
+                visitors = visitors + 1, visits = visits + excluded.visits,
+                lat_sum = lat_sum + excluded.lat_sum, lng_sum = lng_sum + excluded.lng_sum""")
+    return statements
+
+
+def _geo_stats_remove(row: str) -> List[str]:
+    """Statements that take a visitors row back out of geo_counts and geo_cells"""
+    statements = []
+    for level, key in GEO_COUNT_LEVELS.items():
+        country_code, region, city = (part.format(row=row) for part in key)
+        statements.append(f"""
+            UPDATE geo_counts SET visitors = visitors - 1, visits = visits - {row}.visit_count
+            WHERE level = '{level}' AND country_code = {country_code} AND region = {region} AND city = {city}""")
+    for precision in GEO_CELL_PRECISIONS:
+        statements.append(f"""
+            UPDATE geo_cells SET visitors = visitors - 1, visits = visits - {row}.visit_count,
+                lat_sum = lat_sum - {row}.lat, lng_sum = lng_sum - {row}.lng
+            WHERE precision = {precision} AND geohash = substr({row}.geohash, 1, {precision})""")
+    return statements
+
+
+def _geo_stats_visits() -> List[str]:
+    """Statements that add a visitors row's visit_count change to its geo_counts rows"""
+    statements = []
+    for level, key in GEO_COUNT_LEVELS.items():
+        country_code, region, city = (part.format(row="NEW") for part in key)
+        statements.append(f"""
+            UPDATE geo_counts SET visits = visits + NEW.visit_count - OLD.visit_count
+            WHERE level = '{level}' AND country_code = {country_code} AND region = {region} AND city = {city}""")
+    return statements
+
+
+def _geo_cells_visits() -> List[str]:
+    """Statements that add a visitors row's visit_count change to its geo_cells rows"""
+    return [
+        f"""
+            UPDATE geo_cells SET visits = visits + NEW.visit_count - OLD.visit_count
+            WHERE precision = {precision} AND geohash = substr(NEW.geohash, 1, {precision})"""
+        for precision in GEO_CELL_PRECISIONS
+    ]
+
+
+def _trigger(name: str, event: str, statements: List[str], when: Optional[str] = None) -> str:
+    when = f" WHEN {when}" if when else ""
+    body = ";".join(statements)
+    return f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON visitors{when} BEGIN {body}; END"
+
+
+# Keep geo_counts and geo_cells in step with visitors inside the same transaction
+# as every write, so /api/visitors/stats never has to aggregate the visitors table
+GEO_STATS_TRIGGERS = [
+    _trigger("visitors_geo_stats_insert", "INSERT", _geo_stats_add("NEW")),
+    _trigger("visitors_geo_stats_delete", "DELETE", _geo_stats_remove("OLD")),
+    _trigger(
+        "visitors_geo_stats_move",
+        "UPDATE OF country_code, region, city, geohash, lat, lng, visit_count",
+        _geo_stats_remove("OLD") + _geo_stats_add("NEW"),
+        when=GEO_KEY_CHANGED,
+    ),
+    _trigger(
+        "visitors_geo_stats_visits",
+        "UPDATE OF visit_count",
+        _geo_stats_visits(),
+        when=f"NEW.visit_count IS NOT OLD.visit_count AND NOT ({GEO_KEY_CHANGED})",
+    ),
+    # Separate so visitors without a location (no geohash) skip the cell updates entirely
+    _trigger(
+        "visitors_geo_stats_cell_visits",
+        "UPDATE OF visit_count",
+        _geo_cells_visits(),
+        when=f"NEW.geohash IS NOT NULL AND NEW.visit_count IS NOT OLD.visit_count AND NOT ({GEO_KEY_CHANGED})",
+    ),
+]
+
+# Recount geo_counts and geo_cells from scratch; run once when the triggers are first created
+GEO_STATS_REBUILD = ["DELETE FROM geo_counts", "DELETE FROM geo_cells"] + [
+    f"""INSERT INTO geo_counts (level, country_code, region, city, country, visitors, visits)
+        SELECT '{level}', {key[0]}, {key[1]}, {key[2]}, MAX(country), COUNT(*), SUM(visit_count)
+        FROM visitors GROUP BY 2, 3, 4""".format(row="visitors")
+    for level, key in GEO_COUNT_LEVELS.items()
+] + [
+    f"""INSERT INTO geo_cells (precision, geohash, lat, lng, visitors, visits, lat_sum, lng_sum)
+        SELECT {precision}, substr(geohash, 1, {precision}), AVG(lat), AVG(lng),
+               COUNT(*), SUM(visit_count), SUM(lat), SUM(lng)
+        FROM visitors WHERE geohash IS NOT NULL GROUP BY 2"""
+    for precision in GEO_CELL_PRECISIONS
+]
+
+
+class VisitorDatabase:
+    """
+    Owns the long-lived connections to the visitors database.
+
+    There is a single writer connection (SQLite only allows one writer at a
+    time anyway) guarded by an asyncio lock, plus a small pool of read-only
+    connections. Pragmas are applied once when a connection is opened, and
+    since the connections live for the whole process the sqlite3 statement
+    cache keeps every query prepared after its first use.
+    """
+
+    def __init__(self, path: Path, reader_count: int = READER_POOL_SIZE):
+        self.path = path
+        self.reader_count = reader_count
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        # Separate connection for WAL checkpoints, so they never hold the writer lock
+        self._checkpointer: Optional[aiosqlite.Connection] = None
+        self._checkpoint_lock = asyncio.Lock()
+        # Bumped on every committed write transaction (monotonic clock for last_write)
+        self.commits = 0
+        self.last_write = time.monotonic()
+        # Bumped by writers whenever data served by the read endpoints changes
+        self.data_version = 0
+        self._readers: "asyncio.Queue[aiosqlite.Connection]" = asyncio.Queue()
+        self._all_readers: List[aiosqlite.Connection] = []
+
+    async def _connect(self, read_only: bool = False) -> aiosqlite.Connection:
+        if read_only:
+            database = f"{self.path.resolve().as_uri()}?mode=ro"
+            db = await aiosqlite.connect(database, uri=True, cached_statements=STATEMENT_CACHE_SIZE)
+            await db.execute("PRAGMA query_only=ON")
+        else:
+            db = await aiosqlite.connect(str(self.path), cached_statements=STATEMENT_CACHE_SIZE)
+            # WAL lets the readers keep working while the writer commits
+            await db.execute("PRAGMA journal_mode=WAL")
+        for pragma in CONNECTION_PRAGMAS:
+            await db.execute(pragma)
+        return db
+
+    async def open(self, read_only: bool = False):
+        """
+        Open the writer, create the schema and fill the reader pool.
+        With read_only only the reader pool is opened: the schema must already
+        exist, and writer() and checkpoint() raise. That's what the web workers
+        use when a separate visit writer process owns the writes.
+        """
+        if not read_only:
+            self._writer = await self._connect()
+            await self._enable_incremental_vacuum()
+            for statement in SCHEMA:
+                await self._writer.execute(statement)
+            await self._add_missing_columns()
+            for statement in MIGRATED_INDEXES:
+                await self._writer.execute(statement)
+            await self._create_geo_stats_triggers()
+            await self._writer.commit()
+
+        for _ in range(self.reader_count):
+            reader = await self._connect(read_only=True)
+            self._all_readers.append(reader)
+            self._readers.put_nowait(reader)
+        if not read_only:
+            self._checkpointer = await self._connect()
+
+    async def _enable_incremental_vacuum(self):
+        """Switch to auto_vacuum=INCREMENTAL so free pages can be returned in small steps"""
+        cursor = await self._writer.execute("PRAGMA auto_vacuum")
+        mode = (await cursor.fetchone())[0]
+        if mode == 2:
+            return
+        await self._writer.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        cursor = await self._writer.execute("SELECT COUNT(*) FROM sqlite_master")
+        if (await cursor.fetchone())[0]:
+            # Existing databases only pick the new mode up after a full VACUUM (once)
+            start = time.perf_counter()
+            await self._writer.execute("VACUUM")
+            log(f"Enabled incremental vacuum on {self.path} in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    async def _add_missing_columns(self):
+        existing = {}
+        for table, column, column_type in MIGRATED_COLUMNS:
+            if table not in existing:
+                cursor = await self._writer.execute(f"PRAGMA table_info({table})")
+                existing[table] = {row[1] for row in await cursor.fetchall()}
+            if column not in existing[table]:
+                await self._writer.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+                existing[table].add(column)
+                log(f"Added column {table}.{column}")
+
+    async def _create_geo_stats_triggers(self):
+        cursor = await self._writer.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'visitors_geo_stats_%'"
+        )
+        if (await cursor.fetchone())[0] == len(GEO_STATS_TRIGGERS):
+            return
+        for statement in GEO_STATS_TRIGGERS:
+            await self._writer.execute(statement)
+        for statement in GEO_STATS_REBUILD:
+            await self._writer.execute(statement)
+        log("Rebuilt visitor geo statistics")
+
+    async def close(self):
+        """Checkpoint the WAL into the main database file and close every connection"""
+        for reader in self._all_readers:
+            await reader.close()
+        self._all_readers.clear()
+        self._readers = asyncio.Queue()
+        if self._checkpointer is not None:
+            await self._checkpointer.close()
+            self._checkpointer = None
+
+        if self._writer is not None:
+            try:
+                await self._writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            finally:
+                await self._writer.close()
+                self._writer = None
+
+    @asynccontextmanager
+    async def writer(self):
+        """
+        Hold the writer connection for one transaction.
+        Commits when the block exits normally and rolls back on error.
+        """
+        if self._writer is None:
+            raise RuntimeError("Visitors database is not open for writing")
+        with stage("db_write_lock_wait"):
+            await self._write_lock.acquire()
+        try:
+            yield self._writer
+            await self._writer.commit()
+            self.commits += 1
+            self.last_write = time.monotonic()
+        except BaseException:
+            await self._writer.rollback()
+            raise
+        finally:
+            self._write_lock.release()
+
+    def bump_data_version(self):
+        """Mark cached responses built from the visitor tables as stale"""
+        self.data_version += 1
+
+    async def checkpoint(self, mode: str = "PASSIVE") -> Tuple[int, int, int]:
+        """
+        Run a WAL checkpoint on the dedicated checkpoint connection.
+        Returns SQLite's (busy, wal frames, frames checkpointed).
+        """
+        if self._checkpointer is None:
+            raise RuntimeError("Visitors database is not open")
+        async with self._checkpoint_lock:
+            cursor = await self._checkpointer.execute(f"PRAGMA wal_checkpoint({mode})")
+            return tuple(await cursor.fetchone())
+
+    def wal_size(self) -> int:
+        """Size of the -wal file in bytes (0 if there is none)"""
+        try:
+            return self.path.with_name(self.path.name + "-wal").stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    @asynccontextmanager
+    async def reader(self):
+        """Borrow a read-only connection from the pool"""
+        if not self._all_readers:
+            raise RuntimeError("Visitors database is not open")
+        with stage("db_reader_wait"):
+            db = await self._readers.get()
+        try:
+            with stage("db_read"):
+                yield db
+        finally:
+            self._readers.put_nowait(db)
+
+    @property
+    def idle_readers(self) -> int:
+        """Read connections not borrowed right now"""
+        return self._readers.qsize()
+
+
+def default_db_path() -> Path:
+    """The visitors database next to the code; VISITORS_DB_PATH overrides it, e.g. for benchmarks"""
+    return Path(os.environ.get("VISITORS_DB_PATH") or Path(__file__).parent / "visitors.db")
+
+
+def remove_if_corrupted(path: Path):
+    """Delete the database file if SQLite cannot read it"""
+    if not path.exists():
+        return
+    try:
+        conn = sqlite3.connect(str(path))
+        try:
+            conn.execute("SELECT 1")
+        finally:
+            conn.close()
+    except (sqlite3.DatabaseError, sqlite3.OperationalError) as e:
+        # File exists but is corrupted, delete it
+        log(f"Corrupted visitors database file detected ({e}), removing: {path}", level="error")
+        path.unlink()
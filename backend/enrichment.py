@@ -0,0 +1,207 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from database import VisitorDatabase
+from geocoding import GEOCODE_FAILURE_TTL_SECONDS
+from geoip import GeoIPCache
+from geostats import geohash_encode
+from logs import log
+from records import GeoLocation
+
+# Visitors enriched per transaction
+ENRICH_BATCH_SIZE = 200
+
+# Background pass interval when nothing wakes the enricher up
+ENRICH_INTERVAL_SECONDS = 60
+
+# Delay after a wake-up so the visit flusher has written the new visitor rows
+ENRICH_WAKE_DELAY_SECONDS = 1.0
+
+# Distinct coordinates reverse geocoded at once, and how long to wait for them.
+# This is a background job, so it can afford to wait out Nominatim's rate limit.
+ENRICH_GEOCODE_CHUNK = 16
+ENRICH_GEOCODE_DEADLINE_SECONDS = 60
+
+# Located visitors left without a street location (the lookup missed its deadline, found the
+# queue full or failed) are enriched again after this long; a failed lookup is cached as long
+ENRICH_GEOCODE_RETRY_SECONDS = GEOCODE_FAILURE_TTL_SECONDS
+
+UPDATE_GEO_SQL = """
+    UPDATE visitors
+    SET lat = ?, lng = ?, city = ?, region = ?, country = ?, country_code = ?,
+        street_location = ?, geo_source = ?, geo_enriched_at = ?, geohash = ?
+    WHERE ip = ?
+"""
+
+
+class GeoEnricher:
+    """
+    Resolves geo fields for visitors once and stores them on the visitors row.
+
+    New visitors are picked up through a partial index on rows that have
+    never been enriched. Rows enriched from an older GeoLite2 build (or while
+    no database was loaded) are re-enriched in the background whenever the
+    loaded build changes, so /api/visitors never has to do lookups itself.
+    Visitors whose reverse geocode failed are retried after a while.
+    """
+
+    def __init__(
+        self,
+        db: VisitorDatabase,
+        get_geoip: Callable,
+        get_geocoder: Callable,
+        is_private_ip: Callable[[str], bool],
+    ):
+        self.db = db
+        self.get_geoip = get_geoip
+        self.get_geocoder = get_geocoder
+        self.is_private_ip = is_private_ip
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # GeoLite2 build that every row has been checked against
+        self._reenriched_version: Optional[str] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        """Ask for an enrichment pass soon, e.g. after a new visitor was recorded"""
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await self.enrich_pending()
+            except Exception as e:
+                log(f"Error enriching visitors: {e}", level="error", exc_info=True)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=ENRICH_INTERVAL_SECONDS)
+                # Clear before the pass so a wake-up that arrives during it triggers another one
+                self._wakeup.clear()
+                await asyncio.sleep(ENRICH_WAKE_DELAY_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    async def enrich_pending(self) -> int:
+        """Enrich every visitor that is new or was enriched from a different GeoLite2 build"""
+        geoip = self.get_geoip()
+        if geoip is None:
+            return 0
+        version = geoip.version
+
+        total = 0
+        while True:
+            async with self.db.reader() as conn:
+                if self._reenriched_version != version:
+                    cursor = await conn.execute(
+                        # Also picks up rows enriched before geohashes were stored
+                        "SELECT ip FROM visitors WHERE geo_enriched_at IS NULL OR geo_source IS NOT ? "
+                        "OR (lat IS NOT NULL AND lng IS NOT NULL AND geohash IS NULL) LIMIT ?",
+                        (version, ENRICH_BATCH_SIZE)
+                    )
+                else:
+                    cursor = await conn.execute(
+                        "SELECT ip FROM visitors WHERE geo_enriched_at IS NULL LIMIT ?",
+                        (ENRICH_BATCH_SIZE,)
+                    )
+                ips = [row[0] for row in await cursor.fetchall()]
+            if not ips:
+                break
+            await self.enrich(ips, geoip)
+            total += len(ips)
+        total += await self._retry_geocoding(geoip)
+
+        if self._reenriched_version != version:
+            self._reenriched_version = version
+            if total:
+                log(f"Enriched {total} visitors from GeoLite2 build {version}")
+        return total
+
+    async def _retry_geocoding(self, geoip: GeoIPCache) -> int:
+        """
+        Enrich again the located visitors still without a street location, once
+        ENRICH_GEOCODE_RETRY_SECONDS have passed since their last attempt.
+        Coordinates Nominatim knows nothing about are answered from the geocode
+        cache, so only lookups that failed reach Nominatim again.
+        """
+        if not self.get_geocoder():
+            return 0
+        # Enriching a row moves geo_enriched_at past this, so each row is tried once per pass
+        retry_before = (datetime.utcnow() - timedelta(seconds=ENRICH_GEOCODE_RETRY_SECONDS)).isoformat()
+        total = 0
+        while True:
+            async with self.db.reader() as conn:
+                cursor = await conn.execute(
+                    "SELECT ip FROM visitors WHERE street_location IS NULL AND lat IS NOT NULL AND lng IS NOT NULL "
+                    "AND geo_enriched_at < ? LIMIT ?",
+                    (retry_before, ENRICH_BATCH_SIZE)
+                )
+                ips = [row[0] for row in await cursor.fetchall()]
+            if not ips:
+                return total
+            await self.enrich(ips, geoip)
+            total += len(ips)
+
+    async def enrich(self, ips: List[str], geoip: GeoIPCache):
+        """Resolve and store geo fields for the given IPs"""
+        version = geoip.version
+        geos: Dict[str, Optional[GeoLocation]] = {}
+        for ip in ips:
+            geos[ip] = self.lookup(ip, geoip)
+
+        street_locations = await self._reverse_geocode(
+            {(geo.lat, geo.lng) for geo in geos.values() if geo and geo.lat and geo.lng}
+        )
+
+        now = datetime.utcnow().isoformat()
+        rows = []
+        for ip, geo in geos.items():
+            if geo is None:
+                rows.append((None, None, None, None, None, None, None, version, now, None, ip))
+                continue
+            street_location = street_locations.get((geo.lat, geo.lng))
+            geohash = geohash_encode(geo.lat, geo.lng) if geo.lat is not None and geo.lng is not None else None
+            rows.append((
+                geo.lat, geo.lng, geo.city, geo.region, geo.country, geo.countryCode,
+                street_location, version, now, geohash, ip,
+            ))
+        async with self.db.writer() as conn:
+            await conn.executemany(UPDATE_GEO_SQL, rows)
+        self.db.bump_data_version()
+
+    def lookup(self, ip: str, geoip: GeoIPCache) -> Optional[GeoLocation]:
+        """Geo record for the IP, or None for private IPs and IPs the database doesn't know"""
+        if self.is_private_ip(ip):
+            return None
+        try:
+            return geoip.city(ip)
+        except ValueError:
+            return None
+        except Exception as e:
+            log(f"Error getting geolocation for {ip}: {e}", level="error")
+            return None
+
+    async def _reverse_geocode(self, coordinates) -> Dict[Tuple[float, float], Optional[str]]:
+        service = self.get_geocoder()
+        if not service or not coordinates:
+            return {}
+        coordinates = list(coordinates)
+        results = {}
+        for start in range(0, len(coordinates), ENRICH_GEOCODE_CHUNK):
+            chunk = coordinates[start:start + ENRICH_GEOCODE_CHUNK]
+            street_locations = await asyncio.gather(*(
+                service.reverse(lat, lng, deadline=ENRICH_GEOCODE_DEADLINE_SECONDS) for lat, lng in chunk
+            ))
+            results.update(zip(chunk, street_locations))
+        return results
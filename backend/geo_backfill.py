@@ -0,0 +1,410 @@
+"""
+Re-enrich every visitor's geo fields offline, e.g. after a GeoLite2 update
+or when importing a large batch of visitors:
+
+    python geo_backfill.py [--workers N] [--all] [--restart] [--no-geocode] [--db visitors.db]
+
+The app's enricher does the same work in the background, one batch at a
+time on the event loop. This job is for when there are far more rows than
+that can get through quickly. It has two phases:
+
+1. GeoIP. Visitors are read in rowid order, CHUNK_SIZE at a time, and the
+   chunks are spread over a process pool. Each worker opens the GeoLite2
+   file itself in mmap mode, so the pages are shared through the OS page
+   cache rather than copied per process, and keeps its own network cache.
+   Results are written back in one transaction per chunk. Rows whose geo
+   fields come out the same only have geo_source bumped, which leaves the
+   indexes and geo stats triggers alone. Without --all only rows the
+   enricher would pick up are read (never enriched, from another build, or
+   missing a geohash).
+
+2. Reverse geocoding. The distinct coordinates still without a street
+   location are looked up once each through the geocoding service (so the
+   geocode cache and Nominatim's rate limit apply), busiest first, and the
+   results are written to every visitor at those coordinates.
+
+Progress is logged every PROGRESS_INTERVAL_SECONDS with a rate and ETA.
+The GeoIP phase records the last rowid it wrote in job_state, per GeoLite2
+build and mode (--all or not), in the same transaction as the rows; an
+interrupted run resumes after it (--restart starts over), and the
+checkpoint is deleted once the phase completes. The geocoding phase resumes on its own:
+it only ever looks at rows that are still missing a street location, and
+coordinates Nominatim had nothing for are answered from the geocode cache.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import geoip2.database
+import maxminddb
+
+from database import VisitorDatabase, default_db_path
+from geocoding import GeocodingService
+from geoip import GeoIPCache, GeoIPDatabase
+from geostats import geohash_encode
+from ipranges import IPClassifier
+from logs import log
+
+# Visitors per chunk: one pool task and one write transaction each
+CHUNK_SIZE = 2000
+
+# Chunks waiting on the pool per worker, so workers never wait for the writer
+CHUNKS_IN_FLIGHT_PER_WORKER = 2
+
+# How often progress is logged
+PROGRESS_INTERVAL_SECONDS = 5
+
+# Distinct coordinates reverse geocoded at once, and how long to wait for them
+GEOCODE_CHUNK = 16
+GEOCODE_DEADLINE_SECONDS = 60
+
+# Street locations are written once this many are found, or this long after the last write
+GEOCODE_WRITE_BATCH = 500
+GEOCODE_WRITE_INTERVAL_SECONDS = 30
+
+# job_state name for the last rowid written, per GeoLite2 build
+STATE_PREFIX = "geo_backfill:"
+
+# Rows the app's enricher would pick up (see GeoEnricher.enrich_pending)
+STALE_FILTER = (
+    "(geo_enriched_at IS NULL OR geo_source IS NOT ? "
+    "OR (lat IS NOT NULL AND lng IS NOT NULL AND geohash IS NULL))"
+)
+
+# Geo fields in the order lookup_chunk() returns them
+GEO_COLUMNS = "lat, lng, city, region, country, country_code, geohash"
+
+UPDATE_GEO_SQL = """
+    UPDATE visitors
+    SET lat = ?, lng = ?, city = ?, region = ?, country = ?, country_code = ?, geohash = ?,
+        street_location = ?, geo_source = ?, geo_enriched_at = ?
+    WHERE rowid = ?
+"""
+
+MARK_ENRICHED_SQL = "UPDATE visitors SET geo_source = ?, geo_enriched_at = ? WHERE rowid = ?"
+
+SAVE_STATE_SQL = """
+    INSERT INTO job_state (name, value) VALUES (?, ?)
+    ON CONFLICT(name) DO UPDATE SET value = excluded.value
+"""
+
+CREATE_GEOCODED_TABLE_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS geocoded (
+        lat REAL NOT NULL,
+        lng REAL NOT NULL,
+        street_location TEXT NOT NULL,
+        PRIMARY KEY (lat, lng)
+    )
+"""
+
+APPLY_GEOCODED_SQL = """
+    UPDATE visitors SET street_location = g.street_location
+    FROM temp.geocoded AS g
+    WHERE visitors.lat = g.lat AND visitors.lng = g.lng AND visitors.street_location IS NULL
+"""
+
+GeoFields = Tuple[Optional[float], Optional[float], Optional[str], Optional[str], Optional[str], Optional[str], Optional[str]]
+NO_GEO: GeoFields = (None, None, None, None, None, None, None)
+
+# Per worker process (or the single lookup thread): the GeoLite2 reader and IP classifier
+_lookup: Optional[GeoIPCache] = None
+_classifier: Optional[IPClassifier] = None
+
+
+def open_worker(path: str):
+    """Pool initializer: open the GeoLite2 file memory-mapped, with the C extension if it is installed"""
+    global _lookup, _classifier
+    try:
+        reader = geoip2.database.Reader(path, mode=maxminddb.MODE_MMAP_EXT)
+    except Exception:
+        reader = geoip2.database.Reader(path, mode=maxminddb.MODE_MMAP)
+    _lookup = GeoIPCache(reader)
+    _classifier = IPClassifier.from_env()
+
+
+def lookup_chunk(ips: List[str]) -> List[GeoFields]:
+    """Geo fields for each IP; all None for private IPs and IPs the database doesn't know"""
+    results = []
+    for ip in ips:
+        if _classifier.is_special(ip):
+            results.append(NO_GEO)
+            continue
+        try:
+            geo = _lookup.city(ip)
+        except ValueError:
+            geo = None
+        except Exception as e:
+            log(f"Error getting geolocation for {ip}: {e}", level="error")
+            geo = None
+        if geo is None:
+            results.append(NO_GEO)
+            continue
+        geohash = geohash_encode(geo.lat, geo.lng) if geo.lat is not None and geo.lng is not None else None
+        results.append((geo.lat, geo.lng, geo.city, geo.region, geo.country, geo.countryCode, geohash))
+    return results
+
+
+def format_eta(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{seconds:02d}s"
+
+
+class Progress:
+    """Logs done/total, rate and ETA at most every PROGRESS_INTERVAL_SECONDS"""
+
+    def __init__(self, label: str, total: int):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.start = time.perf_counter()
+        self._logged_at = self.start
+
+    def advance(self, count: int, detail: str = "", force: bool = False):
+        self.done += count
+        now = time.perf_counter()
+        if not force and now - self._logged_at < PROGRESS_INTERVAL_SECONDS:
+            return
+        self._logged_at = now
+        rate = self.done / max(now - self.start, 1e-9)
+        percent = 100 * self.done / self.total if self.total else 100
+        eta = format_eta((self.total - self.done) / rate) if rate and self.total > self.done else "-"
+        log(f"{self.label}: {self.done}/{self.total} ({percent:.1f}%), {rate:.0f}/s, ETA {eta}"
+            + (f", {detail}" if detail else ""))
+
+
+class GeoBackfill:
+    """Runs the GeoIP and reverse geocoding phases against one visitors database"""
+
+    def __init__(
+        self,
+        db: VisitorDatabase,
+        geoip_path: Path,
+        version: Optional[str],
+        workers: int,
+        geocoder: Optional[GeocodingService] = None,
+        chunk_size: int = CHUNK_SIZE,
+        everything: bool = False,
+    ):
+        self.db = db
+        self.geoip_path = geoip_path
+        self.version = version
+        self.workers = workers
+        self.geocoder = geocoder
+        self.chunk_size = chunk_size
+        self.everything = everything
+        # A stale-rows run and an --all run cover different rows, so they resume separately
+        self.state_key = f"{STATE_PREFIX}{'all' if everything else 'stale'}:{version}"
+        # Street locations already known for coordinates, so each is looked up once per run
+        self._street_locations: Dict[Tuple[float, float], Optional[str]] = {}
+        self.enriched = 0
+        self.changed = 0
+        self.geocoded_coordinates = 0
+        self.street_locations_written = 0
+
+    def _filter(self) -> Tuple[str, tuple]:
+        if self.everything:
+            return "1", ()
+        return STALE_FILTER, (self.version,)
+
+    def _executor(self) -> Executor:
+        # Spawned rather than forked: this process already runs aiosqlite's threads
+        if self.workers > 1:
+            return ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn"),
+                initializer=open_worker, initargs=(str(self.geoip_path),),
+            )
+        # One worker: a single thread still overlaps lookups with SQLite reads and writes
+        return ThreadPoolExecutor(1, initializer=open_worker, initargs=(str(self.geoip_path),))
+
+    async def load_checkpoint(self) -> int:
+        async with self.db.reader() as conn:
+            cursor = await conn.execute("SELECT value FROM job_state WHERE name = ?", (self.state_key,))
+            row = await cursor.fetchone()
+        return row[0] if row else 0
+
+    async def clear_checkpoint(self):
+        async with self.db.writer() as conn:
+            await conn.execute("DELETE FROM job_state WHERE name = ?", (self.state_key,))
+
+    async def _read_chunk(self, after_rowid: int) -> List[tuple]:
+        where, params = self._filter()
+        async with self.db.reader() as conn:
+            cursor = await conn.execute(
+                f"SELECT rowid, ip, {GEO_COLUMNS}, street_location FROM visitors "
+                f"WHERE rowid > ? AND {where} ORDER BY rowid LIMIT ?",
+                (after_rowid, *params, self.chunk_size)
+            )
+            return await cursor.fetchall()
+
+    async def _street_location(self, lat: Optional[float], lng: Optional[float]) -> Optional[str]:
+        """Street location for coordinates from the geocode cache only; misses are left for phase 2"""
+        if lat is None or lng is None or self.geocoder is None:
+            return None
+        key = (lat, lng)
+        if key not in self._street_locations:
+            _, self._street_locations[key] = await self.geocoder.cache.get(GeocodingService.key(lat, lng))
+        return self._street_locations[key]
+
+    async def _write(self, rows: List[tuple], results: List[GeoFields]):
+        now = datetime.utcnow().isoformat()
+        updates = []
+        unchanged = []
+        for row, geo in zip(rows, results):
+            rowid, old_geo, old_street_location = row[0], tuple(row[2:9]), row[9]
+            if geo == old_geo:
+                unchanged.append((self.version, now, rowid))
+                continue
+            if geo[:2] == old_geo[:2] and old_street_location is not None:
+                street_location = old_street_location
+            else:
+                street_location = await self._street_location(geo[0], geo[1])
+            updates.append((*geo, street_location, self.version, now, rowid))
+        async with self.db.writer() as conn:
+            await conn.executemany(UPDATE_GEO_SQL, updates)
+            await conn.executemany(MARK_ENRICHED_SQL, unchanged)
+            await conn.execute(SAVE_STATE_SQL, (self.state_key, rows[-1][0]))
+        self.enriched += len(rows)
+        self.changed += len(updates)
+
+    async def run_geoip(self, restart: bool = False):
+        """Phase 1: look up every selected visitor and write back its geo fields"""
+        if restart:
+            await self.clear_checkpoint()
+        checkpoint = await self.load_checkpoint()
+        if checkpoint:
+            log(f"GeoIP backfill: resuming after rowid {checkpoint}")
+        where, params = self._filter()
+        async with self.db.reader() as conn:
+            cursor = await conn.execute(f"SELECT COUNT(*) FROM visitors WHERE rowid > ? AND {where}", (checkpoint, *params))
+            total = (await cursor.fetchone())[0]
+        log(f"GeoIP backfill: {total} visitors to enrich from build {self.version} with {self.workers} worker(s)")
+        progress = Progress("GeoIP backfill", total)
+
+        loop = asyncio.get_running_loop()
+        executor = self._executor()
+        # (rows, future of their lookups), in rowid order so the checkpoint only ever moves forward
+        pending = deque()
+        last_read = checkpoint
+        try:
+            while True:
+                rows = await self._read_chunk(last_read)
+                if rows:
+                    last_read = rows[-1][0]
+                    pending.append((rows, loop.run_in_executor(executor, lookup_chunk, [row[1] for row in rows])))
+                if pending and (not rows or len(pending) >= self.workers * CHUNKS_IN_FLIGHT_PER_WORKER):
+                    done_rows, future = pending.popleft()
+                    await self._write(done_rows, await future)
+                    progress.advance(len(done_rows), f"{self.changed} changed")
+                if not rows and not pending:
+                    break
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+        # Finished: the next run for this build starts from the beginning again
+        await self.clear_checkpoint()
+        progress.advance(0, f"{self.changed} changed", force=True)
+
+    async def run_geocode(self):
+        """Phase 2: reverse geocode each distinct coordinate still missing a street location"""
+        if self.geocoder is None:
+            log("Reverse geocoding skipped: geocoding service unavailable")
+            return
+        async with self.db.reader() as conn:
+            cursor = await conn.execute(
+                "SELECT lat, lng FROM visitors "
+                "WHERE street_location IS NULL AND lat IS NOT NULL AND lng IS NOT NULL "
+                "GROUP BY lat, lng ORDER BY COUNT(*) DESC"
+            )
+            coordinates = await cursor.fetchall()
+        log(f"Reverse geocoding: {len(coordinates)} distinct coordinates without a street location")
+        progress = Progress("Reverse geocoding", len(coordinates))
+
+        found: List[Tuple[float, float, str]] = []
+        written_at = time.monotonic()
+        for start in range(0, len(coordinates), GEOCODE_CHUNK):
+            chunk = coordinates[start:start + GEOCODE_CHUNK]
+            street_locations = await asyncio.gather(*(
+                self.geocoder.reverse(lat, lng, deadline=GEOCODE_DEADLINE_SECONDS) for lat, lng in chunk
+            ))
+            found.extend((lat, lng, street) for (lat, lng), street in zip(chunk, street_locations) if street)
+            self.geocoded_coordinates += len(chunk)
+            if len(found) >= GEOCODE_WRITE_BATCH or time.monotonic() - written_at >= GEOCODE_WRITE_INTERVAL_SECONDS:
+                await self._write_street_locations(found)
+                found = []
+                written_at = time.monotonic()
+            progress.advance(len(chunk), f"{self.street_locations_written} visitors updated")
+        await self._write_street_locations(found)
+        progress.advance(0, f"{self.street_locations_written} visitors updated", force=True)
+
+    async def _write_street_locations(self, found: List[Tuple[float, float, str]]):
+        """One pass over visitors for a whole batch of coordinates, instead of one UPDATE each"""
+        if not found:
+            return
+        async with self.db.writer() as conn:
+            await conn.execute(CREATE_GEOCODED_TABLE_SQL)
+            await conn.executemany("INSERT OR REPLACE INTO temp.geocoded VALUES (?, ?, ?)", found)
+            cursor = await conn.execute(APPLY_GEOCODED_SQL)
+            self.street_locations_written += cursor.rowcount
+            await conn.execute("DELETE FROM temp.geocoded")
+
+    def stats(self) -> dict:
+        return {
+            "enriched": self.enriched,
+            "changed": self.changed,
+            "geocoded_coordinates": self.geocoded_coordinates,
+            "street_locations_written": self.street_locations_written,
+        }
+
+
+async def run_backfill(args):
+    geoip = GeoIPDatabase(mode="MMAP_EXT")
+    if not geoip.load():
+        raise SystemExit(f"No GeoLite2 database: {geoip.health['error_message']}")
+    path, version = geoip.path, geoip.lookup.version
+    geoip.close()
+
+    db = VisitorDatabase(args.db, reader_count=1)
+    await db.open()
+    geocoder = None
+    try:
+        if not args.no_geocode:
+            try:
+                geocoder = GeocodingService.from_env(db)
+            except Exception as e:
+                log(f"Failed to initialize geopy: {e}", level="error")
+        backfill = GeoBackfill(
+            db, path, version, args.workers, geocoder, chunk_size=args.chunk_size, everything=args.all,
+        )
+        await backfill.run_geoip(restart=args.restart)
+        if not args.no_geocode:
+            await backfill.run_geocode()
+        log(f"Backfill finished: {backfill.stats()}")
+    finally:
+        if geocoder is not None:
+            geocoder.close()
+        await db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--db", type=Path,
+        default=default_db_path(),
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Lookup processes")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Visitors per chunk")
+    parser.add_argument("--all", action="store_true", help="Re-enrich every visitor, not just stale ones")
+    parser.add_argument("--restart", action="store_true", help="Ignore the saved checkpoint for this build and mode")
+    parser.add_argument("--no-geocode", action="store_true", help="Skip reverse geocoding")
+    asyncio.run(run_backfill(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from geopy.exc import GeocoderServiceError, GeocoderTimedOut
+from geopy.geocoders import Nominatim
+
+from database import VisitorDatabase
+from logs import log
+
+# Identifies the site to Nominatim, as its usage policy requires
+NOMINATIM_USER_AGENT = "vmattoo-dev-trace"
+
+# Nominatim's usage policy allows at most one request per second
+NOMINATIM_RATE_PER_SECOND = 1.0
+NOMINATIM_BURST = 1
+
+# Timeout for a single HTTP call to Nominatim
+NOMINATIM_TIMEOUT_SECONDS = 5
+
+# How long a request handler waits for a street location before answering without one
+GEOCODE_DEADLINE_SECONDS = 1.5
+
+# Threads used for the blocking geopy calls (the rate limit keeps them mostly idle)
+GEOCODE_WORKERS = 2
+
+# Lookups allowed to wait for the rate limiter; beyond this new lookups are skipped
+MAX_PENDING_LOOKUPS = 64
+
+# Coordinates are rounded to this many decimals to decide whether two lookups are the same
+COORDINATE_PRECISION = 4
+
+# Reverse geocoding cache: entries kept in memory, rows kept in SQLite, and how long they stay valid
+GEOCODE_MEMORY_CACHE_SIZE = 4096
+GEOCODE_DB_CACHE_ROWS = 100_000
+GEOCODE_CACHE_TTL_SECONDS = 30 * 24 * 3600
+# Nominatim found nothing for the coordinates
+GEOCODE_NEGATIVE_TTL_SECONDS = 7 * 24 * 3600
+# Nominatim timed out or returned an error
+GEOCODE_FAILURE_TTL_SECONDS = 15 * 60
+# Size-based eviction in SQLite runs after this many writes
+GEOCODE_EVICT_EVERY_WRITES = 100
+
+
+def format_street_location(address: dict) -> Optional[str]:
+    """Pick the most specific human-readable place from a Nominatim address"""
+    # Try to get street-level information
+    street = address.get('road') or address.get('street') or address.get('pedestrian')
+    house_number = address.get('house_number')
+
+    if street:
+        if house_number:
+            return f"{house_number} {street}"
+        return street
+
+    # Fallback to suburb/neighborhood if no street
+    suburb = address.get('suburb') or address.get('neighbourhood')
+    if suburb:
+        return suburb
+
+    # Last resort: city
+    return address.get('city') or address.get('town')
+
+
+class TokenBucket:
+    """Async token bucket: allows `rate` acquisitions per second with bursts of up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        # The lock makes waiters take tokens in arrival order
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+
+class GeocodeCache:
+    """
+    Two-tier cache of reverse geocoding results.
+
+    An in-process LRU sits in front of the geocode_cache SQLite table, so
+    results survive restarts and are shared between workers. Negative
+    results (nothing found, or the lookup failed) are cached as None with a
+    shorter TTL so a bad coordinate isn't retried on every request.
+    """
+
+    def __init__(
+        self,
+        db: Optional[VisitorDatabase] = None,
+        memory_size: int = GEOCODE_MEMORY_CACHE_SIZE,
+        max_rows: int = GEOCODE_DB_CACHE_ROWS,
+    ):
+        self.db = db
+        self.memory_size = memory_size
+        self.max_rows = max_rows
+        self._memory: "OrderedDict[str, Tuple[Optional[str], float]]" = OrderedDict()
+        self._writes_since_evict = 0
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def coord_key(key: Tuple[float, float]) -> str:
+        return f"{key[0]:.{COORDINATE_PRECISION}f},{key[1]:.{COORDINATE_PRECISION}f}"
+
+    def get_memory(self, key: Tuple[float, float]) -> Tuple[bool, Optional[str]]:
+        """(hit, street_location) from the in-process tier only"""
+        coord_key = self.coord_key(key)
+        entry = self._memory.get(coord_key)
+        if entry is None:
+            return False, None
+        street_location, expires_at = entry
+        if expires_at <= time.time():
+            del self._memory[coord_key]
+            return False, None
+        self._memory.move_to_end(coord_key)
+        self.memory_hits += 1
+        if street_location is None:
+            self.negative_hits += 1
+        return True, street_location
+
+    async def get(self, key: Tuple[float, float]) -> Tuple[bool, Optional[str]]:
+        """(hit, street_location) from memory, falling back to SQLite"""
+        hit, street_location = self.get_memory(key)
+        if hit:
+            return hit, street_location
+
+        if self.db is not None:
+            coord_key = self.coord_key(key)
+            try:
+                async with self.db.reader() as conn:
+                    cursor = await conn.execute(
+                        "SELECT street_location, expires_at FROM geocode_cache WHERE coord_key = ?",
+                        (coord_key,)
+                    )
+                    row = await cursor.fetchone()
+            except Exception as e:
+                log(f"Error reading geocode cache: {e}", level="error")
+                row = None
+            if row and row[1] > time.time():
+                self._remember(coord_key, row[0], row[1])
+                self.db_hits += 1
+                if row[0] is None:
+                    self.negative_hits += 1
+                return True, row[0]
+
+        self.misses += 1
+        return False, None
+
+    async def put(self, key: Tuple[float, float], street_location: Optional[str], ttl: float):
+        now = time.time()
+        coord_key = self.coord_key(key)
+        self._remember(coord_key, street_location, now + ttl)
+        if self.db is None:
+            return
+        try:
+            async with self.db.writer() as conn:
+                await conn.execute(
+                    """INSERT OR REPLACE INTO geocode_cache (coord_key, street_location, expires_at, fetched_at)
+                       VALUES (?, ?, ?, ?)""",
+                    (coord_key, street_location, now + ttl, now)
+                )
+                self._writes_since_evict += 1
+                if self._writes_since_evict >= GEOCODE_EVICT_EVERY_WRITES:
+                    self._writes_since_evict = 0
+                    await self._evict(conn, now)
+        except Exception as e:
+            log(f"Error writing geocode cache: {e}", level="error")
+
+    async def _evict(self, conn, now: float):
+        """Drop expired rows, then the oldest rows beyond max_rows"""
+        cursor = await conn.execute("DELETE FROM geocode_cache WHERE expires_at <= ?", (now,))
+        evicted = cursor.rowcount
+        cursor = await conn.execute(
+            """DELETE FROM geocode_cache WHERE coord_key IN (
+                   SELECT coord_key FROM geocode_cache ORDER BY fetched_at DESC LIMIT -1 OFFSET ?
+               )""",
+            (self.max_rows,)
+        )
+        evicted += cursor.rowcount
+        self.evictions += evicted
+
+    def _remember(self, coord_key: str, street_location: Optional[str], expires_at: float):
+        self._memory[coord_key] = (street_location, expires_at)
+        self._memory.move_to_end(coord_key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.db_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.memory_hits + self.db_hits) / lookups, 4) if lookups else None,
+            "memory_entries": len(self._memory),
+            "db_evictions": self.evictions,
+        }
+
+
+class GeocodingService:
+    """
+    Reverse geocoder that never blocks the event loop.
+
+    geopy's Nominatim client is synchronous, so calls run on a small thread
+    pool. A token bucket keeps us within Nominatim's rate limit, concurrent
+    lookups for the same coordinates share a single call, and callers stop
+    waiting after a deadline (the lookup itself carries on for the others).
+    Results, including negative ones, go through a GeocodeCache so only
+    coordinates we have never seen reach Nominatim.
+    """
+
+    def __init__(
+        self,
+        user_agent: str,
+        domain: Optional[str] = None,
+        scheme: Optional[str] = None,
+        rate_per_second: float = NOMINATIM_RATE_PER_SECOND,
+        burst: int = NOMINATIM_BURST,
+        timeout: float = NOMINATIM_TIMEOUT_SECONDS,
+        deadline: float = GEOCODE_DEADLINE_SECONDS,
+        workers: int = GEOCODE_WORKERS,
+        max_pending: int = MAX_PENDING_LOOKUPS,
+        cache: Optional[GeocodeCache] = None,
+    ):
+        options = {"user_agent": user_agent, "timeout": timeout}
+        if domain:
+            options["domain"] = domain
+        if scheme:
+            options["scheme"] = scheme
+        self.geolocator = Nominatim(**options)
+        self.deadline = deadline
+        self.max_pending = max_pending
+        self.cache = cache if cache is not None else GeocodeCache()
+        self.external_calls = 0
+        self.external_errors = 0
+        self._limiter = TokenBucket(rate_per_second, burst)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="geocode")
+        self._inflight: Dict[Tuple[float, float], asyncio.Task] = {}
+
+    @classmethod
+    def from_env(cls, db: Optional[VisitorDatabase] = None) -> "GeocodingService":
+        """
+        The site's Nominatim geocoder, caching in db (only in memory without one).
+        NOMINATIM_DOMAIN, NOMINATIM_SCHEME: another server, e.g. a local stub for testing
+        """
+        return cls(
+            NOMINATIM_USER_AGENT,
+            domain=os.environ.get("NOMINATIM_DOMAIN") or None,
+            scheme=os.environ.get("NOMINATIM_SCHEME") or None,
+            cache=GeocodeCache(db),
+        )
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def key(lat: float, lng: float) -> Tuple[float, float]:
+        return (round(lat, COORDINATE_PRECISION), round(lng, COORDINATE_PRECISION))
+
+    async def reverse(self, lat: float, lng: float, deadline: Optional[float] = None) -> Optional[str]:
+        """Street location for the coordinates, or None if unknown or not ready before the deadline"""
+        hit, street_location = self.cache.get_memory(self.key(lat, lng))
+        if hit:
+            return street_location
+        task = self.lookup(lat, lng)
+        if task is None:
+            return None
+        try:
+            # shield() keeps the shared lookup alive when this caller gives up
+            return await asyncio.wait_for(asyncio.shield(task), self.deadline if deadline is None else deadline)
+        except asyncio.TimeoutError:
+            return None
+
+    def lookup(self, lat: float, lng: float) -> Optional["asyncio.Task"]:
+        """Start (or join) the lookup for the coordinates; None if too many are already queued"""
+        key = self.key(lat, lng)
+        task = self._inflight.get(key)
+        if task is None:
+            if len(self._inflight) >= self.max_pending:
+                log(f"Geocoding queue full, skipping lookup for {key}", level="warning")
+                return None
+            task = asyncio.create_task(self._reverse(key))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+        return task
+
+    def _finished(self, key: Tuple[float, float], task: "asyncio.Task"):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    async def _reverse(self, key: Tuple[float, float]) -> Optional[str]:
+        hit, street_location = await self.cache.get(key)
+        if hit:
+            return street_location
+
+        await self._limiter.acquire()
+        loop = asyncio.get_running_loop()
+        self.external_calls += 1
+        try:
+            street_location = await loop.run_in_executor(self._executor, self._reverse_blocking, key)
+        except (GeocoderTimedOut, GeocoderServiceError) as e:
+            log(f"Geocoding error: {e}", level="error")
+            self.external_errors += 1
+            await self.cache.put(key, None, GEOCODE_FAILURE_TTL_SECONDS)
+            return None
+        except Exception as e:
+            log(f"Unexpected geocoding error: {e}", level="error")
+            self.external_errors += 1
+            return None
+
+        ttl = GEOCODE_CACHE_TTL_SECONDS if street_location else GEOCODE_NEGATIVE_TTL_SECONDS
+        await self.cache.put(key, street_location, ttl)
+        return street_location
+
+    def _reverse_blocking(self, key: Tuple[float, float]) -> Optional[str]:
+        location = self.geolocator.reverse(key, exactly_one=True)
+        if not location:
+            return None
+        return format_street_location(location.raw.get('address', {}))
+
+    def stats(self) -> dict:
+        return {
+            **self.cache.stats(),
+            "external_calls": self.external_calls,
+            "external_errors": self.external_errors,
+            "inflight": len(self._inflight),
+        }
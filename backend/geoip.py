@@ -0,0 +1,366 @@
+import asyncio
+import ipaddress
+import os
+import signal
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import geoip2.database
+import geoip2.errors
+import geoip2.models
+import maxminddb
+
+from logs import log
+from records import GeoLocation
+
+# Networks whose flattened geo record is kept in memory
+GEOIP_CACHE_SIZE = 20_000
+
+# How the .mmdb file is opened (GEOIP_OPEN_MODE): MMAP_EXT maps it and uses the C extension,
+# MEMORY reads the whole file into RAM, AUTO lets maxminddb pick
+GEOIP_OPEN_MODES = {
+    "AUTO": maxminddb.MODE_AUTO,
+    "MMAP_EXT": maxminddb.MODE_MMAP_EXT,
+    "MMAP": maxminddb.MODE_MMAP,
+    "MEMORY": maxminddb.MODE_MEMORY,
+    "FILE": maxminddb.MODE_FILE,
+}
+GEOIP_OPEN_MODE = os.environ.get("GEOIP_OPEN_MODE", "MMAP_EXT").upper()
+
+# A complete GeoLite2-City file is ~63 MB; anything much smaller is a broken download
+GEOIP_MIN_SIZE_MB = float(os.environ.get("GEOIP_MIN_SIZE_MB", "50"))
+
+# How often the database file is checked for a new version
+GEOIP_WATCH_INTERVAL_SECONDS = 30
+
+
+def city_to_geo(response: geoip2.models.City) -> GeoLocation:
+    """Flatten a GeoLite2 City record into the geo record the API returns"""
+    lat = response.location.latitude if response.location.latitude else None
+    lng = response.location.longitude if response.location.longitude else None
+    return GeoLocation(
+        lat=lat,
+        lng=lng,
+        city=response.city.names.get('en', 'Unknown') if response.city else 'Unknown',
+        region=response.subdivisions[0].names.get('en', 'Unknown') if response.subdivisions else 'Unknown',
+        country=response.country.names.get('en', 'Unknown') if response.country else 'Unknown',
+        countryCode=response.country.iso_code if response.country else 'XX',
+        timezone=response.location.time_zone if response.location.time_zone else 'UTC',
+        isp=response.traits.isp or response.traits.organization or 'Unknown' if response.traits else 'Unknown',
+        org=response.traits.organization or 'Unknown' if response.traits else 'Unknown',
+    )
+
+
+def database_version(reader) -> Optional[str]:
+    """Identify the loaded GeoLite2 build, so rows enriched from an older file can be found"""
+    if reader is None:
+        return None
+    try:
+        metadata = reader.metadata()
+        return f"{metadata.database_type}:{metadata.build_epoch}"
+    except Exception:
+        return None
+
+
+class GeoIPCache:
+    """
+    Geo lookups for one GeoLite2 reader, cached by the network each record covers.
+
+    MaxMind records apply to a whole network, so the first lookup for an IP
+    caches the flattened geo record under the network the database returned
+    (e.g. 1.2.3.0/24), and any other IP inside it is answered without
+    touching the MMDB. Addresses the database doesn't know are cached the
+    same way. A cache belongs to a single reader; build a new one whenever
+    the database is (re)loaded.
+    """
+
+    def __init__(self, reader, max_networks: int = GEOIP_CACHE_SIZE):
+        self.reader = reader
+        self.version = database_version(reader)
+        self.max_networks = max_networks
+        # (ip version, prefix length, network address as int) -> geo record, or None if not found
+        self._networks: "OrderedDict[Tuple[int, int, int], Optional[GeoLocation]]" = OrderedDict()
+        # How many cached networks there are per (ip version, prefix length)
+        self._prefix_lengths: Dict[Tuple[int, int], int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def city(self, ip: str) -> Optional[GeoLocation]:
+        """Geo record for ip (frozen and shared, so no copy is made), or None if the database has no record"""
+        address = ipaddress.ip_address(ip)
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        value = int(address)
+        bits = address.max_prefixlen
+
+        for version, prefix_len in self._prefix_lengths:
+            if version != address.version:
+                continue
+            key = (version, prefix_len, value >> (bits - prefix_len) << (bits - prefix_len))
+            if key in self._networks:
+                self._networks.move_to_end(key)
+                self.hits += 1
+                return self._networks[key]
+
+        self.misses += 1
+        try:
+            response = self.reader.city(str(address))
+        except geoip2.errors.AddressNotFoundError as e:
+            self._store(e.network, None)
+            return None
+        geo = city_to_geo(response)
+        self._store(response.traits.network, geo)
+        return geo
+
+    def _store(self, network, geo: Optional[GeoLocation]):
+        if network is None:
+            return
+        key = (network.version, network.prefixlen, int(network.network_address))
+        if key not in self._networks:
+            length_key = key[:2]
+            self._prefix_lengths[length_key] = self._prefix_lengths.get(length_key, 0) + 1
+        self._networks[key] = geo
+        self._networks.move_to_end(key)
+        while len(self._networks) > self.max_networks:
+            old_key, _ = self._networks.popitem(last=False)
+            length_key = old_key[:2]
+            self._prefix_lengths[length_key] -= 1
+            if not self._prefix_lengths[length_key]:
+                del self._prefix_lengths[length_key]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "networks": len(self._networks),
+            "prefix_lengths": len(self._prefix_lengths),
+        }
+
+
+def geolite2_search_paths() -> List[Path]:
+    """Locations checked for the GeoLite2 database file, in order"""
+    # Get the directory where this script is located
+    script_dir = Path(__file__).parent.resolve()
+    paths = [
+        # Relative to this file (most common in deployment)
+        script_dir / "data" / "GeoLite2-City.mmdb",
+        # Current working directory (for different execution contexts)
+        Path.cwd() / "data" / "GeoLite2-City.mmdb",
+        Path.cwd() / "backend" / "data" / "GeoLite2-City.mmdb",
+        # Deployment path
+        Path("/home/opc/backend/data/GeoLite2-City.mmdb"),
+        # Development paths
+        Path("/home/fuckotheclown/Public/socials/website/yourinfo/data/GeoLite2-City.mmdb"),
+        Path("/home/fuckotheclown/Public/socials/website/backend/data/GeoLite2-City.mmdb"),
+    ]
+    # An explicit path (e.g. a benchmark fixture) takes precedence
+    if os.environ.get("GEOIP_DATABASE_PATH"):
+        paths.insert(0, Path(os.environ["GEOIP_DATABASE_PATH"]))
+    return paths
+
+
+def find_geolite2_database(paths: List[Path]) -> Optional[Path]:
+    """Find the GeoLite2 database file in common locations"""
+    log(f"Searching for GeoLite2 database...")
+    log(f"Script directory: {Path(__file__).parent.resolve()}")
+    log(f"Current working directory: {Path.cwd()}")
+
+    for db_path in paths:
+        if db_path.exists():
+            file_size = db_path.stat().st_size / (1024 * 1024)  # Size in MB
+            log(f"Found GeoLite2 database at: {db_path} ({file_size:.2f} MB)")
+            return db_path
+        else:
+            log(f"  Not found: {db_path}", level="warning")
+
+    log("ERROR: GeoLite2 database not found in any of these locations:", level="error")
+    for path in paths:
+        log(f"  - {path}")
+    return None
+
+
+class GeoIPDatabase:
+    """
+    Owns the GeoLite2 reader for the life of the app.
+
+    The database is opened eagerly at startup in the configured maxminddb
+    mode. A background task watches the file (inode, size and mtime) and
+    reloads it when it changes; SIGHUP reloads it unconditionally, e.g. for
+    a file rewritten in place with the same signature. A new reader is
+    opened first and only then swapped in, together with a fresh GeoIPCache, so
+    requests always see either the old database or the new one. If the new
+    file fails to open, the old reader stays in service.
+
+    The outcome of the last load attempt is kept in `health`, which is what
+    requests report when no database is loaded, instead of re-validating the
+    file on every request.
+    """
+
+    def __init__(self, mode: str = GEOIP_OPEN_MODE, min_size_mb: float = GEOIP_MIN_SIZE_MB):
+        if mode not in GEOIP_OPEN_MODES:
+            log(f"Unknown GEOIP_OPEN_MODE {mode!r}, using MMAP_EXT", level="error")
+            mode = "MMAP_EXT"
+        self.mode = mode
+        self.min_size_mb = min_size_mb
+        self.search_paths = geolite2_search_paths()
+        self.path: Optional[Path] = None
+        self.lookup: Optional[GeoIPCache] = None
+        self.health: dict = self._health()
+        self.reloads = 0
+        # Called after a new reader has been swapped in
+        self.on_reload: Optional[Callable[[], None]] = None
+        self._signature = None
+        self._task: Optional[asyncio.Task] = None
+        self._reload_requested: Optional[asyncio.Event] = None
+
+    def _health(self, error_message: Optional[str] = None) -> dict:
+        size_mb = None
+        if self.path is not None:
+            try:
+                size_mb = round(self.path.stat().st_size / (1024 * 1024), 2)
+            except OSError:
+                pass
+        return {
+            "database_found": self.path is not None and self.path.exists(),
+            "database_loaded": self.lookup is not None,
+            "database_path": str(self.path) if self.path else None,
+            "database_size_mb": size_mb,
+            "database_version": self.lookup.version if self.lookup else None,
+            "open_mode": self.mode,
+            "searched_paths": [str(p) for p in self.search_paths],
+            "error_message": error_message,
+            "script_directory": str(Path(__file__).parent.resolve()),
+            "working_directory": str(Path.cwd()),
+        }
+
+    @staticmethod
+    def _file_signature(path: Path):
+        st = path.stat()
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def load(self) -> bool:
+        """Open (or re-open) the database file and swap it in; returns True if a new reader is in use"""
+        return self._swap(*self._open())
+
+    def _open(self):
+        """Open the database file. Returns (reader or None, file signature, error message)."""
+        if self.path is None or not self.path.exists():
+            self.path = find_geolite2_database(self.search_paths)
+        if self.path is None:
+            return None, None, "Database file not found in any searched location"
+
+        try:
+            signature = self._file_signature(self.path)
+        except OSError as e:
+            return None, None, f"Error checking database file: {e}"
+
+        # Check file size first - should be around 63 MB
+        file_size_mb = signature[1] / (1024 * 1024)
+        if file_size_mb < self.min_size_mb:
+            log(f"ERROR: GeoLite2 database file is too small ({file_size_mb:.2f} MB). Expected ~63 MB.", level="error")
+            log(f"File may be corrupted or incomplete: {self.path}", level="error")
+            return None, signature, (
+                f"Database file is too small ({file_size_mb:.2f} MB). Expected ~63 MB. "
+                "File may be corrupted or incomplete during deployment."
+            )
+
+        try:
+            reader = geoip2.database.Reader(str(self.path), mode=GEOIP_OPEN_MODES[self.mode])
+        except Exception as e:
+            log(f"Failed to load GeoLite2 database from {self.path}: {e}", level="error")
+            return None, signature, f"Database file exists but failed to load: {e}"
+        return reader, signature, None
+
+    def _swap(self, reader, signature, error_message: Optional[str]) -> bool:
+        """
+        Put a newly opened reader in service and close the old one.
+        Lookups run synchronously on the event loop thread, so doing this on
+        that thread means no lookup can be using the old reader as it closes.
+        """
+        if signature is not None:
+            # Don't retry the same broken file on every check
+            self._signature = signature
+        if reader is None:
+            if self.lookup is None:
+                self.health = self._health(error_message)
+            return False
+
+        old = self.lookup
+        self.lookup = GeoIPCache(reader)
+        self.health = self._health()
+        if old is not None:
+            self.reloads += 1
+            old.reader.close()
+        log(f"GeoLite2 database loaded successfully from: {self.path}")
+        log(f"Database file size: {self.health['database_size_mb']} MB, mode {self.mode}, build {self.lookup.version}")
+        if self.on_reload is not None:
+            self.on_reload()
+        return True
+
+    def changed_on_disk(self) -> bool:
+        """True when the file differs from the one loaded (or no database is loaded yet)"""
+        if self.path is None or not self.path.exists():
+            # Not found yet (or moved away): look again, unless we're serving a loaded copy
+            if self.lookup is not None:
+                return False
+            self.path = None
+            return any(path.exists() for path in self.search_paths)
+        try:
+            return self._file_signature(self.path) != self._signature
+        except OSError:
+            return False
+
+    def start(self):
+        """Watch the database file, and reload on SIGHUP"""
+        if self._task is not None:
+            return
+        self._reload_requested = asyncio.Event()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self._reload_requested.set)
+        except (NotImplementedError, RuntimeError, ValueError, AttributeError):
+            pass  # No SIGHUP on this platform, or not on the main thread; the file watch still works
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            try:
+                asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+            except (NotImplementedError, RuntimeError, ValueError, AttributeError):
+                pass
+
+    def close(self):
+        if self.lookup is not None:
+            self.lookup.reader.close()
+            self.lookup = None
+
+    async def _watch(self):
+        while True:
+            # SIGHUP skips the signature check and reloads whatever is on disk
+            forced = False
+            try:
+                await asyncio.wait_for(self._reload_requested.wait(), timeout=GEOIP_WATCH_INTERVAL_SECONDS)
+                forced = True
+            except asyncio.TimeoutError:
+                pass
+            self._reload_requested.clear()
+            if not forced and not self.changed_on_disk():
+                continue
+            try:
+                if forced:
+                    log("SIGHUP received, reloading GeoLite2 database")
+                else:
+                    log(f"GeoLite2 database file changed on disk, reloading: {self.path}")
+                # Opening a 63 MB file in MEMORY mode takes a moment; keep it off the event loop
+                opened = await asyncio.to_thread(self._open)
+                self._swap(*opened)
+            except Exception as e:
+                log(f"Error reloading GeoLite2 database: {e}", level="error")
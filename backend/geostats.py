@@ -0,0 +1,154 @@
+from typing import List, Optional, Tuple
+
+from database import GEO_CELL_PRECISIONS, GEOHASH_PRECISION, VisitorDatabase
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# Map zoom level (web map tiles, 0 = whole world) -> geohash precision used to cluster points.
+# Each step is roughly a constant number of cells per screen, so payloads stay flat.
+ZOOM_PRECISIONS = [(2, 2), (4, 3), (7, 4), (10, 5)]
+
+# Upper bounds on what /api/visitors/stats returns
+MAX_CLUSTERS = 2000
+TOP_PLACES = 50
+
+# (west, south, east, north) covering the whole map
+WORLD_BBOX = (-180.0, -90.0, 180.0, 90.0)
+
+
+def geohash_encode(lat: float, lng: float, precision: int = GEOHASH_PRECISION) -> str:
+    """Standard base32 geohash of a coordinate"""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lng_range[0] + lng_range[1]) / 2
+            if lng >= mid:
+                value = (value << 1) | 1
+                lng_range[0] = mid
+            else:
+                value <<= 1
+                lng_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if lat >= mid:
+                value = (value << 1) | 1
+                lat_range[0] = mid
+            else:
+                value <<= 1
+                lat_range[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits = 0
+            value = 0
+    return "".join(chars)
+
+
+def precision_for_zoom(zoom: int) -> int:
+    for max_zoom, precision in ZOOM_PRECISIONS:
+        if zoom <= max_zoom:
+            return precision
+    return max(GEO_CELL_PRECISIONS)
+
+
+def parse_bbox(bbox: Optional[str]) -> Tuple[float, float, float, float]:
+    """Parse "west,south,east,north"; raises ValueError if it isn't four numbers in range"""
+    if not bbox:
+        return WORLD_BBOX
+    parts = [float(part) for part in bbox.split(",")]
+    if len(parts) != 4:
+        raise ValueError("bbox must be west,south,east,north")
+    west, south, east, north = parts
+    if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+        raise ValueError("bbox is out of range")
+    return west, south, east, north
+
+
+class GeoStats:
+    """
+    Read side of the geo_counts and geo_cells tables.
+
+    The counters are maintained by triggers on the visitors table (see
+    database.py), so every query here reads at most a few thousand
+    pre-aggregated rows no matter how many visitors there are.
+    """
+
+    def __init__(self, db: VisitorDatabase):
+        self.db = db
+
+    async def summary(
+        self,
+        zoom: int = 0,
+        bbox: Tuple[float, float, float, float] = WORLD_BBOX,
+        country: Optional[str] = None,
+    ) -> dict:
+        precision = precision_for_zoom(zoom)
+        async with self.db.reader() as conn:
+            countries = await (await conn.execute(
+                """SELECT country_code, country, visitors, visits FROM geo_counts
+                   WHERE level = 'country' AND visitors > 0
+                   ORDER BY visitors DESC, country_code"""
+            )).fetchall()
+            regions = await self._top_places(conn, "region", country)
+            cities = await self._top_places(conn, "city", country)
+            clusters = await self._clusters(conn, precision, bbox)
+
+        located = [row for row in countries if row[0]]
+        return {
+            "total_visitors": sum(row[2] for row in countries),
+            "total_visits": sum(row[3] for row in countries),
+            "unlocated_visitors": sum(row[2] for row in countries if not row[0]),
+            "countries": [
+                {"country_code": row[0], "country": row[1], "visitors": row[2], "visits": row[3]}
+                for row in located
+            ],
+            "regions": regions,
+            "cities": cities,
+            "clusters": {"zoom": zoom, "precision": precision, "points": clusters},
+        }
+
+    async def _top_places(self, conn, level: str, country: Optional[str]) -> List[dict]:
+        query = """SELECT country_code, country, region, city, visitors, visits FROM geo_counts
+                   WHERE level = ? AND country_code != '' AND visitors > 0"""
+        params = [level]
+        if country:
+            query += " AND country_code = ?"
+            params.append(country.upper())
+        query += " ORDER BY visitors DESC, visits DESC LIMIT ?"
+        params.append(TOP_PLACES)
+        rows = await (await conn.execute(query, params)).fetchall()
+        places = []
+        for row in rows:
+            place = {"country_code": row[0], "country": row[1], "region": row[2] or None}
+            if level == "city":
+                place["city"] = row[3] or None
+            place["visitors"] = row[4]
+            place["visits"] = row[5]
+            places.append(place)
+        return places
+
+    async def _clusters(self, conn, precision: int, bbox: Tuple[float, float, float, float]) -> List[dict]:
+        west, south, east, north = bbox
+        query = """SELECT geohash, lat_sum / visitors, lng_sum / visitors, visitors, visits FROM geo_cells
+                   WHERE precision = ? AND visitors > 0 AND lat BETWEEN ? AND ?"""
+        params = [precision, south, north]
+        if west <= east:
+            query += " AND lng BETWEEN ? AND ?"
+            params.extend([west, east])
+        else:
+            # Box crosses the antimeridian
+            query += " AND (lng >= ? OR lng <= ?)"
+            params.extend([west, east])
+        query += " ORDER BY visitors DESC LIMIT ?"
+        params.append(MAX_CLUSTERS)
+        rows = await (await conn.execute(query, params)).fetchall()
+        return [
+            {"geohash": row[0], "lat": round(row[1], 4), "lng": round(row[2], 4), "visitors": row[3], "visits": row[4]}
+            for row in rows
+        ]
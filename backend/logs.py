@@ -0,0 +1,48 @@
+"""
+Log output for the backend.
+
+By default messages are written to stdout as plain lines, exactly what the
+print() calls they replace used to write. With LOG_FORMAT=json every
+message becomes one JSON object per line with a timestamp, level, the ID
+of the request being handled (when there is one) and any extra fields.
+"""
+import contextvars
+import json
+import os
+import sys
+import traceback
+from datetime import datetime, timezone
+from typing import Optional
+
+# "text" (default) or "json"
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+JSON_LOGS = LOG_FORMAT == "json"
+
+# ID of the request being handled, set by RequestMetricsMiddleware; tasks started
+# while handling a request inherit it
+request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+
+
+def log(message: str, level: str = "info", exc_info: bool = False, **fields):
+    """
+    Write one log message. exc_info adds the traceback of the exception
+    being handled; fields are only included in JSON logs.
+    """
+    if not JSON_LOGS:
+        print(message)
+        if exc_info:
+            traceback.print_exc()
+        return
+    record = {
+        "ts": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+        "level": level,
+        "message": message,
+    }
+    current_request = request_id.get()
+    if current_request is not None:
+        record["request_id"] = current_request
+    record.update(fields)
+    if exc_info:
+        record["exception"] = traceback.format_exc()
+    # A single write, so lines from concurrent threads don't interleave
+    sys.stdout.write(json.dumps(record, default=str) + "\n")
@@ -1,86 +1,215 @@
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
-from typing import List, Optional
+from fastapi.responses import StreamingResponse
+from typing import Optional
 from pathlib import Path
-import geoip2.database
-import geoip2.errors
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut, GeocoderServiceError
-import aiosqlite
+import os
 import asyncio
-from datetime import datetime
+import base64
+import csv
+import dataclasses
+import io
+import json
+import time
+from datetime import datetime, timedelta
+from database import VisitorDatabase, default_db_path, remove_if_corrupted
+from visits import VisitAccumulator
+from visit_writer import VisitWriterClient
+from geocoding import GeocodingService
+from geoip import GeoIPCache, GeoIPDatabase
+from enrichment import GeoEnricher
+from maintenance import DatabaseMaintenance
+from rollups import VisitRollups
+from geostats import GeoStats, parse_bbox
+from response_cache import ResponseCache, cached_json_response
+from cached_file import CachedFile, cached_file_response
+from broadcast import BroadcastHub, EventStreamResponse
+from records import VisitorRecord
+from serialization import FastJSONResponse, dumps
+from logs import log
+from ipranges import IPClassifier
+from ratelimit import RateLimiter, RateLimitMiddleware
+from metrics import CONTENT_TYPE, Counter, Gauge, LoopLagMonitor, RequestMetricsMiddleware, render as render_metrics, stage
+from notes import NOTES_MAX_PAGE_SIZE, NOTES_PAGE_SIZE, NOTES_SEARCH_LIMIT, NotesStore, decode_note_cursor
 
 app = FastAPI()
 
 # Visitors database path (SQLite)
-VISITORS_DB_PATH = Path(__file__).parent / "visitors.db"
+VISITORS_DB_PATH = default_db_path()
+
+# Long-lived connections to the visitors database, opened on startup
+visitor_db: Optional[VisitorDatabase] = None
+
+def get_visitor_db() -> VisitorDatabase:
+    """Return the open visitors database, or raise if startup failed to open it"""
+    if visitor_db is None:
+        raise RuntimeError("Visitors database is not initialized")
+    return visitor_db
+
+# Batch visit writes in the background (False writes each visit with one upsert in the request)
+VISIT_WRITE_BEHIND = True
+
+# In-memory visit counts, written to the visitors database in batches
+visit_accumulator: Optional[VisitAccumulator] = None
+
+def get_visit_accumulator() -> VisitAccumulator:
+    """Return the running visit accumulator, or raise if startup failed to create it"""
+    if visit_accumulator is None:
+        raise RuntimeError("Visit tracking is not initialized")
+    return visit_accumulator
+
+# Unix socket of the visit writer process (visit_writer.py). When set, this process
+# is one of several uvicorn workers: it opens the database read-only and forwards
+# visits and reverse geocoding to the writer, which runs every background job.
+VISIT_WRITER_SOCKET = os.environ.get("VISIT_WRITER_SOCKET") or None
+
+# How long a worker waits at startup for the writer to be listening
+VISIT_WRITER_STARTUP_TIMEOUT_SECONDS = 30
+
+# Connection to the visit writer in multi-worker mode
+visit_writer: Optional[VisitWriterClient] = None
+
+# Background job that stores geo fields on visitor rows
+geo_enricher: Optional[GeoEnricher] = None
+
+# Background WAL checkpoints, PRAGMA optimize and incremental vacuum
+db_maintenance: Optional[DatabaseMaintenance] = None
+
+# Hourly/daily visit rollups maintained from the visits event log
+visit_rollups: Optional[VisitRollups] = None
+
+# Serialized responses of the read endpoints, invalidated whenever visitor data changes
+response_cache = ResponseCache(lambda: visitor_db.data_version if visitor_db is not None else -1)
+
+# Notes, stored in the visitors database with a full-text index
+notes_store: Optional[NotesStore] = None
+
+# Serialized notes responses; separate so visits don't invalidate them
+notes_cache = ResponseCache(lambda: notes_store.version if notes_store is not None else -1)
+
+# Live visitor events for /api/visitors/stream; subscribers are per process, so in
+# multi-worker mode events travel through the visit writer to every worker's hub
+visitor_events = BroadcastHub()
 
 # Initialize database on startup
 @app.on_event("startup")
 async def init_db():
     """Initialize the visitors database"""
+    global visitor_db, visit_accumulator, geo_enricher, db_maintenance, visit_rollups, notes_store
+    if VISIT_WRITER_SOCKET:
+        await init_worker_db()
+        return
     try:
         # Check if file exists and is corrupted, delete it if so
-        if VISITORS_DB_PATH.exists():
-            try:
-                # Try to open and verify it's a valid database using sync sqlite3 first
-                import sqlite3
-                conn = sqlite3.connect(str(VISITORS_DB_PATH))
-                conn.execute("SELECT 1")
-                conn.close()
-            except (sqlite3.DatabaseError, sqlite3.OperationalError) as e:
-                # File exists but is corrupted, delete it
-                print(f"Corrupted visitors database file detected ({e}), removing: {VISITORS_DB_PATH}")
-                VISITORS_DB_PATH.unlink()
+        remove_if_corrupted(VISITORS_DB_PATH)
+        
+        # Create or connect to database, keeping the connections open for the app's lifetime
+        db = VisitorDatabase(VISITORS_DB_PATH)
+        await db.open()
+        visitor_db = db
+        log(f"Visitors database initialized successfully: {VISITORS_DB_PATH}")
         
-        # Create or connect to database
-        async with aiosqlite.connect(str(VISITORS_DB_PATH)) as db:
-            # Enable WAL mode for better concurrency and durability
-            await db.execute("PRAGMA journal_mode=WAL")
-            await db.execute("PRAGMA synchronous=NORMAL")
-            
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS visitors (
-                    ip TEXT PRIMARY KEY,
-                    visit_count INTEGER DEFAULT 1,
-                    first_visit TEXT,
-                    last_visit TEXT,
-                    last_referer TEXT
-                )
-            """)
-            await db.commit()
-            print(f"Visitors database initialized successfully: {VISITORS_DB_PATH}")
-            
-            # Test that we can read from it
-            cursor = await db.execute("SELECT COUNT(*) FROM visitors")
+        # Notes (the old hard-coded ones are inserted the first time)
+        store = NotesStore(db)
+        await store.seed()
+        notes_store = store
+        
+        # Start batching visit writes in the background
+        visit_accumulator = VisitAccumulator(db, write_behind=VISIT_WRITE_BEHIND)
+        visit_accumulator.start()
+        
+        # Resolve geo fields for new (and re-enrich stale) visitors in the background
+        geo_enricher = GeoEnricher(db, get_geoip_lookup, get_geocoder, is_private_ip)
+        geo_enricher.start()
+        
+        # Fold visit events into the hourly/daily rollups and prune old events
+        visit_rollups = VisitRollups(db)
+        visit_rollups.start()
+        
+        # Checkpoint the WAL in the background instead of inside commits
+        db_maintenance = DatabaseMaintenance(db)
+        await db_maintenance.start()
+        
+        # Test that we can read from it
+        async with db.reader() as conn:
+            cursor = await conn.execute("SELECT COUNT(*) FROM visitors")
             count = await cursor.fetchone()
-            print(f"Current visitors in database: {count[0]}")
-            
-            # Verify database file exists and is writable
-            if VISITORS_DB_PATH.exists():
-                file_size = VISITORS_DB_PATH.stat().st_size
-                print(f"Visitors database file size: {file_size} bytes")
+        log(f"Current visitors in database: {count[0]}")
+        
+        # Verify database file exists and is writable
+        if VISITORS_DB_PATH.exists():
+            file_size = VISITORS_DB_PATH.stat().st_size
+            log(f"Visitors database file size: {file_size} bytes")
     except Exception as e:
-        print(f"Error initializing visitors database: {e}")
-        import traceback
-        traceback.print_exc()
+        log(f"Error initializing visitors database: {e}", level="error", exc_info=True)
         # If database initialization fails, the app will still run but tracking won't work
 
+async def init_worker_db():
+    """Multi-worker mode: connect to the visit writer, then open read-only connections"""
+    global visitor_db, visit_writer, visit_rollups, notes_store
+    try:
+        # Each change the writer reports invalidates this worker's cached responses
+        client = VisitWriterClient(
+            Path(VISIT_WRITER_SOCKET),
+            on_version=lambda version: visitor_db.bump_data_version() if visitor_db is not None else None,
+            on_event=publish_visitor_event,
+        )
+        client.start()
+        visit_writer = client
+        # The writer only listens once the schema exists, so wait for it before opening the readers
+        if not await client.wait_connected(VISIT_WRITER_STARTUP_TIMEOUT_SECONDS):
+            log(f"Visit writer not reachable at {VISIT_WRITER_SOCKET}, still trying in the background", level="error")
+        
+        db = VisitorDatabase(VISITORS_DB_PATH)
+        await db.open(read_only=True)
+        visitor_db = db
+        notes_store = NotesStore(db)
+        # Only used for reads here; the writer process keeps the rollups up to date
+        visit_rollups = VisitRollups(db)
+        log(f"Visitors database opened read-only: {VISITORS_DB_PATH} (writes go to {VISIT_WRITER_SOCKET})")
+    except Exception as e:
+        log(f"Error initializing visitors database: {e}", level="error", exc_info=True)
+
 @app.on_event("shutdown")
 async def shutdown_db():
     """Ensure database is properly closed on shutdown"""
+    global visitor_db, visit_accumulator, geo_enricher, db_maintenance, visit_rollups, notes_store, visit_writer
     try:
-        # Force a checkpoint on all connections before shutdown
-        import sqlite3
-        if VISITORS_DB_PATH.exists():
-            conn = sqlite3.connect(str(VISITORS_DB_PATH))
-            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
-            conn.close()
-            print("Visitors database checkpointed on shutdown")
+        if visit_writer is not None:
+            await visit_writer.stop()
+            visit_writer = None
+        if db_maintenance is not None:
+            await db_maintenance.stop()
+            db_maintenance = None
+        if visit_rollups is not None:
+            await visit_rollups.stop()
+            visit_rollups = None
+        if geo_enricher is not None:
+            await geo_enricher.stop()
+            geo_enricher = None
+        # Write out any visits still pending before the connections close
+        if visit_accumulator is not None:
+            await visit_accumulator.stop()
+            visit_accumulator = None
+        if visitor_db is not None:
+            # Checkpoints the WAL before closing the connections
+            notes_store = None
+            await visitor_db.close()
+            visitor_db = None
+            log("Visitors database checkpointed on shutdown")
     except Exception as e:
-        print(f"Error during database shutdown: {e}")
+        log(f"Error during database shutdown: {e}", level="error")
+
+# --- TRAFFIC FILTERING ---
+# Special-purpose ranges, user blocklist/bot ranges and trusted reverse proxies (see ipranges.py)
+ip_classifier = IPClassifier.from_env()
+
+# Per-client token buckets for the API routes (RATE_LIMITS configures them)
+rate_limiter = RateLimiter.from_env()
+
+# Blocked IPs, bots on the tracking routes and clients over their limit are answered
+# here, before any database or GeoIP work (inside CORS, so the answers carry its headers)
+app.add_middleware(RateLimitMiddleware, classifier=ip_classifier, limiter=rate_limiter)
 
 # --- IMPORTANT: CORS SETUP ---
 # This allows your React app (running on localhost:5173)
@@ -95,31 +224,37 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-
-# --- DATA MODELS ---
-class Note(BaseModel):
-    id: int
-    title: str
-    date: str
-    content: str
+# Outermost, so request timings and IDs cover everything (including CORS preflights)
+app.add_middleware(RequestMetricsMiddleware)
 
 
 # --- ROUTES ---
 
 
 # Route 1: Serve the Resume File (Inline View)
+# The PDF is held in memory with its hash and re-read when the file changes
+resume_file = CachedFile(Path(__file__).parent / "resume.pdf", media_type="application/pdf")
+
+# Browsers reuse the resume for a while, then revalidate it with a cheap 304
+RESUME_CACHE_CONTROL = "public, max-age=3600"
+
 # CHANGED: Added /api/ prefix to avoid conflict with frontend route
 @app.get("/api/resume")
-def get_resume():
-    # Use absolute path relative to this file's directory
-    resume_path = Path(__file__).parent / "resume.pdf"
-    if not resume_path.exists():
-        raise FileNotFoundError(f"Resume file not found at {resume_path}")
-    return FileResponse(
-        str(resume_path),
-        media_type="application/pdf",
-        content_disposition_type="inline",  # <--- THIS IS KEY
+def get_resume(request: Request):
+    """
+    Serve the resume inline, with ETag/Last-Modified (304 for repeat viewers),
+    byte ranges for PDF viewers that load it in chunks, and a compressed
+    variant when the client accepts one.
+    """
+    response = cached_file_response(
+        resume_file,
+        request,
+        cache_control=RESUME_CACHE_CONTROL,
+        content_disposition='inline; filename="resume.pdf"',  # <--- THIS IS KEY
     )
+    if response is None:
+        raise HTTPException(status_code=404, detail=f"Resume file not found at {resume_file.path}")
+    return response
 
 
 @app.get("/")
@@ -131,352 +266,325 @@ def read_root():
 
 
 # Route 2: Get Notes (JSON Data)
-@app.get("/api/notes", response_model=List[Note])
-def get_notes():
-    # In a real app, you would fetch this from a database (SQLite)
-    return [
-        {
-            "id": 1,
-            "title": "Oracle Cloud Architecture",
-            "date": "2025-12-20",
-            "content": "Deploying a split-stack architecture on ARM instances...",
-        },
-        {
-            "id": 2,
-            "title": "React vs. Vanilla JS",
-            "date": "2025-12-18",
-            "content": "Why component-based state management wins for dashboards...",
-        },
-    ]
-
-
-# Initialize GeoLite2 database reader
-# Try multiple possible paths for the database file
-def find_geolite2_database():
-    """Find the GeoLite2 database file in common locations"""
-    # Get the directory where this script is located
-    script_dir = Path(__file__).parent.resolve()
-    
-    possible_paths = [
-        # Relative to this file (most common in deployment)
-        script_dir / "data" / "GeoLite2-City.mmdb",
-        # Current working directory (for different execution contexts)
-        Path.cwd() / "data" / "GeoLite2-City.mmdb",
-        Path.cwd() / "backend" / "data" / "GeoLite2-City.mmdb",
-        # Deployment path
-        Path("/home/opc/backend/data/GeoLite2-City.mmdb"),
-        # Development paths
-        Path("/home/fuckotheclown/Public/socials/website/yourinfo/data/GeoLite2-City.mmdb"),
-        Path("/home/fuckotheclown/Public/socials/website/backend/data/GeoLite2-City.mmdb"),
-    ]
-    
-    print(f"Searching for GeoLite2 database...")
-    print(f"Script directory: {script_dir}")
-    print(f"Current working directory: {Path.cwd()}")
-    
-    for db_path in possible_paths:
-        if db_path.exists():
-            file_size = db_path.stat().st_size / (1024 * 1024)  # Size in MB
-            print(f"Found GeoLite2 database at: {db_path} ({file_size:.2f} MB)")
-            return db_path
-        else:
-            print(f"  Not found: {db_path}")
-    
-    print("ERROR: GeoLite2 database not found in any of these locations:")
-    for path in possible_paths:
-        print(f"  - {path}")
-    return None
+def get_notes_store() -> NotesStore:
+    """Return the notes store, or raise if startup failed to open the database"""
+    if notes_store is None:
+        raise RuntimeError("Notes store is not initialized")
+    return notes_store
 
-geoip_reader = None
-DB_PATH = None
+@app.get("/api/notes")
+async def get_notes(
+    request: Request,
+    limit: int = Query(NOTES_PAGE_SIZE, ge=1, le=NOTES_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+):
+    """
+    Notes, newest first. Pass back next_cursor to get the next page.
+    Pages are served as cached JSON bytes until a note changes.
+    """
+    if cursor:
+        try:
+            decode_note_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    try:
+        store = get_notes_store()
+        await store.check_version()
+        return await cached_json_response(notes_cache, request, lambda: store.page(limit, cursor))
+    except Exception as e:
+        log(f"Error getting notes: {e}", level="error", exc_info=True)
+        return {"notes": [], "total": 0, "next_cursor": None, "error": str(e)}
 
-def get_geoip_reader():
-    """Lazy load the GeoIP database reader"""
-    global geoip_reader, DB_PATH
-    
-    if geoip_reader is None:
-        # Find the database file
-        if DB_PATH is None:
-            DB_PATH = find_geolite2_database()
+@app.get("/api/notes/search")
+async def search_notes(
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(NOTES_SEARCH_LIMIT, ge=1, le=NOTES_MAX_PAGE_SIZE),
+):
+    """Full-text search over note titles and content (FTS5, best matches first)"""
+    try:
+        store = get_notes_store()
+        await store.check_version()
         
-        if DB_PATH and DB_PATH.exists():
-            # Check file size first - should be around 63 MB
-            file_size_mb = DB_PATH.stat().st_size / (1024 * 1024)
-            if file_size_mb < 50:
-                print(f"ERROR: GeoLite2 database file is too small ({file_size_mb:.2f} MB). Expected ~63 MB.")
-                print(f"File may be corrupted or incomplete: {DB_PATH}")
-                geoip_reader = None
-            else:
-                try:
-                    geoip_reader = geoip2.database.Reader(str(DB_PATH))
-                    print(f"GeoLite2 database loaded successfully from: {DB_PATH}")
-                    print(f"Database file size: {file_size_mb:.2f} MB")
-                except Exception as e:
-                    print(f"Failed to load GeoLite2 database from {DB_PATH}: {e}")
-                    import traceback
-                    traceback.print_exc()
-                    geoip_reader = None
-        else:
-            print(f"GeoLite2 database file not found. Searched in multiple locations.")
-            if DB_PATH:
-                print(f"Expected location: {DB_PATH}")
-    
-    return geoip_reader
-
-def get_geoip_error_details():
-    """Get detailed error information about GeoIP database loading"""
-    global DB_PATH
-    
-    error_details = {
-        "database_found": False,
-        "database_path": None,
-        "database_size_mb": None,
-        "searched_paths": [],
-        "error_message": None,
-        "script_directory": str(Path(__file__).parent.resolve()),
-        "working_directory": str(Path.cwd()),
-    }
-    
-    # Get searched paths
-    script_dir = Path(__file__).parent.resolve()
-    possible_paths = [
-        script_dir / "data" / "GeoLite2-City.mmdb",
-        Path.cwd() / "data" / "GeoLite2-City.mmdb",
-        Path.cwd() / "backend" / "data" / "GeoLite2-City.mmdb",
-        Path("/home/opc/backend/data/GeoLite2-City.mmdb"),
-        Path("/home/fuckotheclown/Public/socials/website/yourinfo/data/GeoLite2-City.mmdb"),
-        Path("/home/fuckotheclown/Public/socials/website/backend/data/GeoLite2-City.mmdb"),
-    ]
-    
-    error_details["searched_paths"] = [str(p) for p in possible_paths]
-    
-    # Check if database exists
-    if DB_PATH is None:
-        DB_PATH = find_geolite2_database()
-    
-    if DB_PATH and DB_PATH.exists():
-        error_details["database_found"] = True
-        error_details["database_path"] = str(DB_PATH)
-        try:
-            error_details["database_size_mb"] = round(DB_PATH.stat().st_size / (1024 * 1024), 2)
-        except:
-            pass
+        async def build():
+            return {"query": q, "notes": await store.search(q, limit)}
         
-        # Check file size
-        try:
-            file_size_mb = DB_PATH.stat().st_size / (1024 * 1024)
-            error_details["database_size_mb"] = round(file_size_mb, 2)
-            
-            if file_size_mb < 50:
-                error_details["error_message"] = f"Database file is too small ({file_size_mb:.2f} MB). Expected ~63 MB. File may be corrupted or incomplete during deployment."
-            else:
-                # Try to load it to see if there are any errors
-                try:
-                    test_reader = geoip2.database.Reader(str(DB_PATH))
-                    test_reader.close()
-                except Exception as e:
-                    error_details["error_message"] = f"Database file exists but failed to load: {str(e)}"
-        except Exception as e:
-            error_details["error_message"] = f"Error checking database file: {str(e)}"
-    else:
-        error_details["error_message"] = "Database file not found in any searched location"
-        if DB_PATH:
-            error_details["database_path"] = str(DB_PATH)
-    
-    return error_details
+        return await cached_json_response(notes_cache, request, build)
+    except Exception as e:
+        log(f"Error searching notes: {e}", level="error", exc_info=True)
+        return {"query": q, "notes": [], "error": str(e)}
+
+
+# GeoLite2 database, opened at startup and reloaded when the file changes (or on SIGHUP)
+geoip_database = GeoIPDatabase()
 
-# Initialize geopy geocoder
-geolocator = None
+def get_geoip_lookup() -> Optional[GeoIPCache]:
+    """Cached geo lookups for the currently loaded GeoLite2 database, or None if none is loaded"""
+    return geoip_database.lookup
+
+def on_geoip_reload():
+    """A newly loaded GeoLite2 build means visitor rows need (re-)enriching"""
+    if geo_enricher is not None:
+        geo_enricher.wake()
+
+geoip_database.on_reload = on_geoip_reload
+
+@app.on_event("startup")
+async def init_geoip():
+    """Open the GeoLite2 database before the first request and start watching it for updates"""
+    try:
+        geoip_database.load()
+    except Exception as e:
+        log(f"Error loading GeoLite2 database: {e}", level="error", exc_info=True)
+    geoip_database.start()
 
-def get_geolocator():
-    """Lazy load the geopy geocoder"""
-    global geolocator
-    if geolocator is None:
+@app.on_event("shutdown")
+async def shutdown_geoip():
+    await geoip_database.stop()
+    geoip_database.close()
+
+# Reverse geocoder (Nominatim)
+geocoder: Optional[GeocodingService] = None
+
+def get_geocoder() -> Optional[GeocodingService]:
+    """Lazy load the reverse geocoding service"""
+    global geocoder
+    if geocoder is None:
         try:
-            geolocator = Nominatim(user_agent="vmattoo-dev-trace")
+            # Caches only in memory if the visitors database failed to open
+            geocoder = GeocodingService.from_env(visitor_db)
         except Exception as e:
-            print(f"Failed to initialize geopy: {e}")
-    return geolocator
+            log(f"Failed to initialize geopy: {e}", level="error")
+    return geocoder
 
-def reverse_geocode(lat: float, lng: float) -> Optional[str]:
-    """Reverse geocode coordinates to approximate street location"""
+@app.on_event("shutdown")
+async def shutdown_geocoder():
+    """Stop the geocoding worker threads"""
+    global geocoder
+    if geocoder is not None:
+        geocoder.close()
+        geocoder = None
+
+async def reverse_geocode(lat: float, lng: float) -> Optional[str]:
+    """Reverse geocode coordinates to approximate street location (None if it misses the deadline)"""
     try:
-        locator = get_geolocator()
-        if not locator:
+        if visit_writer is not None:
+            # One geocoder (and one Nominatim rate limit) for all workers, in the writer process
+            return await visit_writer.reverse(lat, lng)
+        service = get_geocoder()
+        if not service:
             return None
-        
-        # Use reverse geocoding with timeout
-        location = locator.reverse((lat, lng), timeout=5, exactly_one=True)
-        
-        if location:
-            address = location.raw.get('address', {})
-            # Try to get street-level information
-            street = address.get('road') or address.get('street') or address.get('pedestrian')
-            house_number = address.get('house_number')
-            
-            if street:
-                if house_number:
-                    return f"{house_number} {street}"
-                return street
-            
-            # Fallback to suburb/neighborhood if no street
-            suburb = address.get('suburb') or address.get('neighbourhood')
-            if suburb:
-                return suburb
-                
-            # Last resort: city
-            city = address.get('city') or address.get('town')
-            if city:
-                return city
-                
-    except (GeocoderTimedOut, GeocoderServiceError) as e:
-        print(f"Geocoding error: {e}")
-        return None
+        return await service.reverse(lat, lng)
     except Exception as e:
-        print(f"Unexpected geocoding error: {e}")
+        log(f"Unexpected geocoding error: {e}", level="error")
         return None
-    
-    return None
 
-async def track_visitor(ip: str, referer: Optional[str] = None):
-    """Track visitor by IP address - persists to disk"""
+@app.get("/api/geoip/stats")
+def get_geoip_stats():
+    """Hit/miss counters for the network-keyed GeoIP lookup cache"""
+    geoip = get_geoip_lookup()
+    if not geoip:
+        return {"error": "GeoLite2 database not loaded", "health": geoip_database.health}
+    return {**geoip.stats(), "reloads": geoip_database.reloads, "health": geoip_database.health}
+
+async def get_writer_stats(section: str) -> Optional[dict]:
+    """One section of the visit writer's stats (the jobs that write run there in multi-worker mode)"""
     try:
-        # Use aiosqlite with explicit connection management to ensure writes are flushed
-        db = await aiosqlite.connect(str(VISITORS_DB_PATH))
-        try:
-            # Enable WAL mode for better concurrency and ensure writes are durable
-            await db.execute("PRAGMA journal_mode=WAL")
-            await db.execute("PRAGMA synchronous=NORMAL")  # Balance between safety and speed
-            
-            # Check if visitor exists
-            cursor = await db.execute(
-                "SELECT visit_count, first_visit FROM visitors WHERE ip = ?",
-                (ip,)
-            )
-            row = await cursor.fetchone()
-            
-            now = datetime.utcnow().isoformat()
-            
-            if row:
-                # Update existing visitor
-                visit_count = row[0] + 1
-                await db.execute(
-                    """UPDATE visitors 
-                       SET visit_count = ?, last_visit = ?, last_referer = ?
-                       WHERE ip = ?""",
-                    (visit_count, now, referer or '', ip)
-                )
-            else:
-                # Insert new visitor
-                await db.execute(
-                    """INSERT INTO visitors (ip, visit_count, first_visit, last_visit, last_referer)
-                       VALUES (?, ?, ?, ?, ?)""",
-                    (ip, 1, now, now, referer or '')
-                )
-            
-            # Commit and ensure it's written to disk
-            await db.commit()
-            
-            # Get updated visit count
-            cursor = await db.execute(
-                "SELECT visit_count FROM visitors WHERE ip = ?",
-                (ip,)
-            )
-            row = await cursor.fetchone()
-            visit_count = row[0] if row else 1
-            
-            # Force a checkpoint periodically (every 10th visit) to ensure WAL is written to main database
-            # This balances performance with durability
-            if visit_count % 10 == 0:
-                await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
-            
-            return visit_count
-        finally:
-            await db.close()
+        return (await visit_writer.stats())[section]
     except Exception as e:
-        print(f"Error tracking visitor: {e}")
-        import traceback
-        traceback.print_exc()
-        return 1
+        return {"error": f"Visit writer unavailable: {e}"}
+
+@app.get("/api/db/maintenance")
+async def get_db_maintenance_stats():
+    """WAL size and timings of the background checkpoint, optimize and vacuum runs"""
+    if visit_writer is not None:
+        return await get_writer_stats("maintenance") or {"error": "Database maintenance not running"}
+    if db_maintenance is None:
+        return {"error": "Database maintenance not running"}
+    return db_maintenance.stats()
+
+@app.get("/api/cache/stats")
+def get_response_cache_stats():
+    """Hit/miss counters for the cached read endpoints"""
+    return response_cache.stats()
 
-async def get_visitor_info(ip: str):
-    """Get visitor information from database"""
+@app.get("/api/ratelimit/stats")
+def get_rate_limit_stats():
+    """Rate limit rules with their allowed/throttled counts, and how many buckets are held"""
+    return {**rate_limiter.stats(), "ip_ranges": ip_classifier.stats()}
+
+@app.get("/api/geocode/stats")
+async def get_geocode_stats():
+    """Reverse geocoding cache hit/miss counters and how many calls reached Nominatim"""
+    if visit_writer is not None:
+        return await get_writer_stats("geocode") or {"error": "Geocoder not initialized"}
+    service = get_geocoder()
+    if not service:
+        return {"error": "Geocoder not initialized"}
+    return service.stats()
+
+@app.get("/api/writer/stats")
+async def get_visit_writer_stats():
+    """Multi-worker mode: the visit writer's request counts, pending visits and commits"""
+    if visit_writer is None:
+        return {"error": "Not running with a visit writer (VISIT_WRITER_SOCKET is unset)"}
     try:
-        db = await aiosqlite.connect(str(VISITORS_DB_PATH))
-        try:
-            cursor = await db.execute(
-                "SELECT visit_count, last_referer FROM visitors WHERE ip = ?",
-                (ip,)
-            )
-            row = await cursor.fetchone()
-            if row:
-                return {
-                    "visit_count": row[0],
-                    "last_referer": row[1] or None
-                }
-            return {
-                "visit_count": 0,
-                "last_referer": None
-            }
-        finally:
-            await db.close()
+        return {**await visit_writer.stats(), "reconnects": visit_writer.reconnects}
+    except Exception as e:
+        return {"error": str(e), "reconnects": visit_writer.reconnects}
+
+# --- METRICS ---
+# Request and stage timings are recorded as they happen (metrics.py); the
+# counters and queue depths below are read from the components when scraped
+
+def collect_cache_requests() -> dict:
+    values = {}
+    for cache, stats in (("responses", response_cache.stats()), ("notes", notes_cache.stats())):
+        values[(cache, "hit")] = stats["hits"]
+        values[(cache, "stale_hit")] = stats["stale_hits"]
+        values[(cache, "miss")] = stats["misses"]
+    geoip = get_geoip_lookup()
+    if geoip:
+        stats = geoip.stats()
+        values[("geoip", "hit")] = stats["hits"]
+        values[("geoip", "miss")] = stats["misses"]
+    if geocoder is not None:
+        stats = geocoder.stats()
+        values[("geocode", "hit")] = stats["memory_hits"] + stats["db_hits"]
+        values[("geocode", "miss")] = stats["misses"]
+    return values
+
+def collect_queue_depths() -> dict:
+    values = {("response_builds",): response_cache.stats()["building"]}
+    if visit_accumulator is not None:
+        values[("visits_pending",)] = visit_accumulator.pending_visitors
+        values[("visit_events_pending",)] = visit_accumulator.pending_events
+    if geocoder is not None:
+        values[("geocode_inflight",)] = geocoder.stats()["inflight"]
+    if visit_writer is not None:
+        values[("visit_writer_in_flight",)] = visit_writer.in_flight
+    if visitor_db is not None:
+        values[("db_idle_readers",)] = visitor_db.idle_readers
+    return values
+
+Counter(
+    "app_cache_requests_total", "Lookups in the in-process caches by result",
+    ("cache", "result"), collect=collect_cache_requests,
+)
+Gauge("app_queue_depth", "Work waiting in the in-process queues and pools", ("queue",), collect=collect_queue_depths)
+Counter(
+    "app_visitors_db_commits_total", "Committed write transactions on the visitors database",
+    collect=lambda: visitor_db.commits if visitor_db is not None else None,
+)
+Gauge("app_visitor_streams", "Open /api/visitors/stream connections", collect=lambda: visitor_events.subscribers)
+Counter(
+    "app_visitor_stream_drops_total", "Live visitor streams closed for falling behind",
+    collect=lambda: visitor_events.dropped,
+)
+
+loop_lag_monitor = LoopLagMonitor()
+
+@app.on_event("startup")
+async def start_loop_lag_monitor():
+    loop_lag_monitor.start()
+
+@app.on_event("shutdown")
+async def stop_loop_lag_monitor():
+    await loop_lag_monitor.stop()
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Prometheus scrape endpoint"""
+    return Response(render_metrics(), media_type=CONTENT_TYPE)
+
+async def record_visit(ip: str, referer: Optional[str] = None):
+    """Track a visit from ip and return its visit count and last referer"""
+    try:
+        recorder = visit_writer if visit_writer is not None else get_visit_accumulator()
+        visit_count, last_referer = await recorder.record(ip, referer)
+        return {
+            "visit_count": visit_count,
+            "last_referer": last_referer
+        }
     except Exception as e:
-        print(f"Error getting visitor info: {e}")
-        import traceback
-        traceback.print_exc()
+        log(f"Error tracking visitor: {e}", level="error", exc_info=True)
         return {
-            "visit_count": 0,
-            "last_referer": None
+            "visit_count": 1,
+            "last_referer": referer or None
         }
 
+# SSE event sent for every /api/geolocation request; its data has the shape of a /api/visitors entry
+VISITOR_EVENT = "visitor"
+
+def visitor_event(payload: dict) -> dict:
+    """The visitor a /api/geolocation payload describes, as it looks right after this visit"""
+    now = datetime.utcnow().isoformat()
+    geo = payload["geo"]
+    return {
+        "ip": payload["ip"],
+        "visit_count": payload["visit_count"],
+        # Only known here for a first visit; clients keep the one they already have
+        "first_visit": now if payload["visit_count"] == 1 else None,
+        "last_visit": now,
+        "geo": {
+            "lat": geo.lat, "lng": geo.lng, "city": geo.city, "region": geo.region,
+            "country": geo.country, "countryCode": geo.countryCode,
+        } if geo is not None else None,
+        "streetLocation": geo.streetLocation if geo is not None else None,
+    }
+
+def publish_visitor(payload: dict):
+    """Announce a tracked visit on the live visitor streams of every worker"""
+    if visit_writer is not None:
+        visit_writer.publish(visitor_event(payload))
+    elif visitor_events.subscribers:
+        publish_visitor_event(visitor_event(payload))
+
+def publish_visitor_event(event: dict):
+    """Send a visitor event to this process's subscribers (encoded once for all of them)"""
+    visitor_events.publish(VISITOR_EVENT, dumps(event))
+
 def is_private_ip(ip: str) -> bool:
-    """Check if an IP is private/localhost"""
-    if ip in ['127.0.0.1', 'localhost', 'unknown']:
-        return True
-    if ip.startswith('10.') or ip.startswith('192.168.'):
-        return True
-    if ip.startswith('172.'):
-        try:
-            parts = ip.split('.')
-            if len(parts) >= 2:
-                second_octet = int(parts[1])
-                if 16 <= second_octet <= 31:
-                    return True
-        except (ValueError, IndexError):
-            pass
-    if ip.startswith('169.254.'):
-        return True
-    if ip in ['::1', '::ffff:127.0.0.1']:
-        return True
-    return False
+    """Check if an IP is private/localhost (or any other address that can't be geolocated)"""
+    return ip_classifier.is_special(ip)
 
 # Route 3: Get Geolocation from IP using local GeoLite2 database
-@app.get("/api/geolocation")
+@app.get("/api/geolocation", response_class=FastJSONResponse)
 async def get_geolocation(request: Request):
     """
     Get geolocation information from the client's IP address.
     Uses local MaxMind GeoLite2 database - no rate limits!
     Also tracks visitor visits and referer.
     """
-    # Get client IP from request
-    client_ip = request.client.host
+    payload = await locate_client(request)
+    try:
+        publish_visitor(payload)
+    except Exception as e:
+        log(f"Error publishing visitor event: {e}", level="error")
+    # Returned as a response so the geo record skips jsonable_encoder
+    return FastJSONResponse(payload)
+
+async def locate_client(request: Request) -> dict:
+    """Track the visit and look up the client's geolocation; returns the /api/geolocation payload"""
+    # Get client IP from request, believing X-Forwarded-For only from trusted proxies
+    client_ip = ip_classifier.client_ip(
+        request.client.host if request.client else None, request.headers.get("X-Forwarded-For")
+    )
     
-    # Check for forwarded IP (in case behind proxy/load balancer)
-    forwarded_for = request.headers.get("X-Forwarded-For")
-    if forwarded_for:
-        client_ip = forwarded_for.split(",")[0].strip()
+    # Blocked and bot clients never get here (RateLimitMiddleware answers them)
+    ip_class = ip_classifier.classify(client_ip)
     
     # Get referer from request
     referer = request.headers.get("Referer") or request.headers.get("Referrer")
     
     # Track visitor (even if private IP, we still track it)
-    visit_count = await track_visitor(client_ip, referer)
-    
-    # Get visitor info
-    visitor_info = await get_visitor_info(client_ip)
+    visitor_info = await record_visit(client_ip, referer)
+    if visitor_info["visit_count"] == 1 and geo_enricher is not None:
+        # First visit from this IP: store its geo fields in the background
+        geo_enricher.wake()
     
     # Skip private IPs for geolocation
-    if is_private_ip(client_ip):
+    if ip_class is not None:
         return {
             "ip": client_ip,
             "geo": None,
@@ -485,10 +593,10 @@ async def get_geolocation(request: Request):
         }
     
     # Use local GeoLite2 database
-    reader = get_geoip_reader()
-    if not reader:
-        # Get detailed error information
-        error_details = get_geoip_error_details()
+    geoip = get_geoip_lookup()
+    if not geoip:
+        # Outcome of the last load attempt (re-checked in the background, not per request)
+        error_details = geoip_database.health
         return {
             "ip": client_ip,
             "geo": None,
@@ -499,52 +607,40 @@ async def get_geolocation(request: Request):
         }
     
     try:
-        response = reader.city(client_ip)
-        
-        lat = response.location.latitude if response.location.latitude else None
-        lng = response.location.longitude if response.location.longitude else None
+        with stage("geoip_lookup"):
+            geo = geoip.city(client_ip)
+        if geo is None:
+            # IP not found in database
+            log(f"IP not found in GeoLite2 database: {client_ip}", level="warning")
+            return {
+                "ip": client_ip,
+                "geo": None,
+                "visit_count": visitor_info["visit_count"],
+                "referer": visitor_info["last_referer"],
+                "error": "IP not found in database"
+            }
         
         # Reverse geocode to get approximate street location
         street_location = None
-        if lat and lng:
+        if geo.lat and geo.lng:
             try:
-                street_location = reverse_geocode(lat, lng)
+                with stage("reverse_geocode"):
+                    street_location = await reverse_geocode(geo.lat, geo.lng)
             except Exception as e:
-                print(f"Reverse geocoding error: {e}")
+                log(f"Reverse geocoding error: {e}", level="error")
                 street_location = None
+        # Approximate street location from reverse geocoding (the cached record is shared, so copy it)
+        geo = dataclasses.replace(geo, streetLocation=street_location)
         
         return {
             "ip": client_ip,
-            "geo": {
-                "lat": lat,
-                "lng": lng,
-                "city": response.city.names.get('en', 'Unknown') if response.city else 'Unknown',
-                "region": response.subdivisions[0].names.get('en', 'Unknown') if response.subdivisions else 'Unknown',
-                "country": response.country.names.get('en', 'Unknown') if response.country else 'Unknown',
-                "countryCode": response.country.iso_code if response.country else 'XX',
-                "timezone": response.location.time_zone if response.location.time_zone else 'UTC',
-                "isp": response.traits.isp or response.traits.organization or 'Unknown' if response.traits else 'Unknown',
-                "org": response.traits.organization or 'Unknown' if response.traits else 'Unknown',
-                "streetLocation": street_location,  # Approximate street location from reverse geocoding
-            },
+            "geo": geo,
             "visit_count": visitor_info["visit_count"],
             "referer": visitor_info["last_referer"]
         }
-    except geoip2.errors.AddressNotFoundError as e:
-        # IP not found in database
-        print(f"IP not found in GeoLite2 database: {client_ip} - {e}")
-        return {
-            "ip": client_ip,
-            "geo": None,
-            "visit_count": visitor_info["visit_count"],
-            "referer": visitor_info["last_referer"],
-            "error": "IP not found in database"
-        }
     except Exception as e:
         # Other errors
-        print(f"Geolocation lookup error for IP {client_ip}: {e}")
-        import traceback
-        traceback.print_exc()
+        log(f"Geolocation lookup error for IP {client_ip}: {e}", level="error", exc_info=True)
         return {
             "ip": client_ip,
             "geo": None,
@@ -553,86 +649,284 @@ async def get_geolocation(request: Request):
             "error": str(e)
         }
 
+# Pagination for /api/visitors
+VISITORS_PAGE_SIZE = 100
+VISITORS_MAX_PAGE_SIZE = 1000
+# How long a COUNT(*) for a given set of filters is reused (at most until the data version changes)
+VISITORS_TOTAL_TTL_SECONDS = 30
+
+VISITOR_COLUMNS = """ip, visit_count, first_visit, last_visit,
+                     lat, lng, city, region, country, country_code, street_location"""
+
+visitor_totals = {}
+# Data version the cached totals were counted at, so a rebuilt page never reports an older total
+visitor_totals_version = None
+
+def encode_visitor_cursor(row) -> str:
+    """Opaque cursor pointing just after row in (visit_count, last_visit, ip) order"""
+    payload = json.dumps([row[1], row[3], row[0]], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+def decode_visitor_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        visit_count, last_visit, ip = json.loads(base64.urlsafe_b64decode(padded))
+        return int(visit_count), str(last_visit), str(ip)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def count_visitors(conn, where: str, params: list) -> int:
+    """COUNT(*) for the filters, cached for a short while (and one data version) since it scans the index"""
+    global visitor_totals_version
+    version = get_visitor_db().data_version
+    if version != visitor_totals_version:
+        visitor_totals.clear()
+        visitor_totals_version = version
+    key = (where, tuple(params))
+    cached = visitor_totals.get(key)
+    now = time.monotonic()
+    if cached and cached[1] > now:
+        return cached[0]
+    cursor = await conn.execute(f"SELECT COUNT(*) FROM visitors {where}", params)
+    total = (await cursor.fetchone())[0]
+    if len(visitor_totals) >= 256:
+        visitor_totals.clear()
+    visitor_totals[key] = (total, now + VISITORS_TOTAL_TTL_SECONDS)
+    return total
+
 # Route 4: Get all visitors with their geolocation
 @app.get("/api/visitors")
-async def get_all_visitors():
+async def get_all_visitors(
+    request: Request,
+    limit: int = Query(VISITORS_PAGE_SIZE, ge=1, le=VISITORS_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    country: Optional[str] = Query(None, description="ISO country code, e.g. IN"),
+    since: Optional[str] = Query(None, description="Only visitors seen at or after this ISO timestamp"),
+    include_all: bool = Query(False, alias="all", description="Return every visitor in one response (the old unpaginated shape)"),
+):
     """
-    Get all visitors from the database with their geolocation information.
-    Returns a list of visitors sorted by visit count (descending).
+    Get visitors from the database with their geolocation information,
+    sorted by visit count (descending), then last visit.
+    Geo fields are resolved once per visitor by the background enricher, so
+    this is a single query; visitors not enriched yet have no geo.
+    Pages are fetched with keyset pagination: pass back next_cursor to get the next page.
     """
     try:
-        # Get all visitors from database
-        db = await aiosqlite.connect(str(VISITORS_DB_PATH))
-        try:
-            cursor = await db.execute(
-                "SELECT ip, visit_count, first_visit, last_visit FROM visitors ORDER BY visit_count DESC, last_visit DESC"
-            )
-            rows = await cursor.fetchall()
-            
-            visitors = []
-            reader = get_geoip_reader()
-            
-            for row in rows:
-                ip = row[0]
-                visit_count = row[1]
-                first_visit = row[2]
-                last_visit = row[3]
-                
-                visitor_data = {
-                    "ip": ip,
-                    "visit_count": visit_count,
-                    "first_visit": first_visit,
-                    "last_visit": last_visit,
-                    "geo": None,
-                    "streetLocation": None
-                }
-                
-                # Skip geolocation for private IPs
-                if not is_private_ip(ip) and reader:
-                    try:
-                        response = reader.city(ip)
-                        
-                        lat = response.location.latitude if response.location.latitude else None
-                        lng = response.location.longitude if response.location.longitude else None
-                        
-                        # Reverse geocode to get approximate street location
-                        street_location = None
-                        if lat and lng:
-                            try:
-                                street_location = reverse_geocode(lat, lng)
-                            except Exception as e:
-                                print(f"Reverse geocoding error for {ip}: {e}")
-                                street_location = None
-                        
-                        visitor_data["geo"] = {
-                            "lat": lat,
-                            "lng": lng,
-                            "city": response.city.names.get('en', 'Unknown') if response.city else 'Unknown',
-                            "region": response.subdivisions[0].names.get('en', 'Unknown') if response.subdivisions else 'Unknown',
-                            "country": response.country.names.get('en', 'Unknown') if response.country else 'Unknown',
-                            "countryCode": response.country.iso_code if response.country else 'XX',
-                        }
-                        visitor_data["streetLocation"] = street_location
-                    except geoip2.errors.AddressNotFoundError:
-                        visitor_data["geo"] = None
-                    except Exception as e:
-                        print(f"Error getting geolocation for {ip}: {e}")
-                        visitor_data["geo"] = None
-                
-                visitors.append(visitor_data)
-            
-            return {
-                "visitors": visitors,
-                "total": len(visitors)
+        conditions = []
+        params = []
+        if country:
+            conditions.append("country_code = ?")
+            params.append(country.upper())
+        if since:
+            conditions.append("last_visit >= ?")
+            params.append(since)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        
+        page_conditions = list(conditions)
+        page_params = list(params)
+        if cursor and not include_all:
+            page_conditions.append("(visit_count, last_visit, ip) < (?, ?, ?)")
+            page_params.extend(decode_visitor_cursor(cursor))
+        page_where = f"WHERE {' AND '.join(page_conditions)}" if page_conditions else ""
+        
+        query = f"""SELECT {VISITOR_COLUMNS} FROM visitors {page_where}
+                    ORDER BY visit_count DESC, last_visit DESC, ip DESC"""
+        if not include_all:
+            # One extra row tells us whether there is another page
+            query += " LIMIT ?"
+            page_params.append(limit + 1)
+        
+        async def build():
+            async with get_visitor_db().reader() as conn:
+                rows = await (await conn.execute(query, page_params)).fetchall()
+                if include_all:
+                    total = len(rows)
+                else:
+                    total = await count_visitors(conn, where, params)
+        
+            next_cursor = None
+            if not include_all and len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = encode_visitor_cursor(rows[-1])
+        
+            response = {
+                "visitors": [VisitorRecord.from_row(row) for row in rows],
+                "total": total
             }
-        finally:
-            await db.close()
+            if not include_all:
+                response["next_cursor"] = next_cursor
+            return response
+        
+        return await cached_json_response(response_cache, request, build)
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error getting all visitors: {e}")
-        import traceback
-        traceback.print_exc()
+        log(f"Error getting all visitors: {e}", level="error", exc_info=True)
         return {
             "visitors": [],
             "total": 0,
             "error": str(e)
         }
+
+@app.on_event("startup")
+async def start_visitor_events():
+    visitor_events.start()
+
+@app.on_event("shutdown")
+async def stop_visitor_events():
+    await visitor_events.stop()
+
+@app.get("/api/visitors/stream")
+async def stream_visitors():
+    """
+    Live visits as Server-Sent Events: a `visitor` event for every request to
+    /api/geolocation, with the fields of a /api/visitors entry. Load
+    /api/visitors first and merge events into it by ip. A client that falls
+    too far behind is disconnected; after any reconnect, load it again.
+    """
+    subscription = visitor_events.subscribe()
+    if subscription is None:
+        raise HTTPException(status_code=503, detail="Too many live visitor streams")
+    return EventStreamResponse(visitor_events, subscription)
+
+@app.get("/api/visitors/stats")
+async def get_visitor_stats(
+    request: Request,
+    zoom: int = Query(0, ge=0, le=22, description="Map zoom level; picks the cluster size"),
+    bbox: Optional[str] = Query(None, description="west,south,east,north; defaults to the whole world"),
+    country: Optional[str] = Query(None, description="ISO country code to restrict the region and city lists to"),
+):
+    """
+    Aggregated visitor geography for the Trace map: visitor and visit counts
+    by country, the top regions and cities, and geohash clusters for the
+    requested zoom level and bounding box. Everything is read from counters
+    kept up to date by triggers, so the response size doesn't grow with the
+    number of visitors.
+    """
+    try:
+        box = parse_bbox(bbox)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid bbox: {e}")
+    try:
+        return await cached_json_response(
+            response_cache, request, lambda: GeoStats(get_visitor_db()).summary(zoom, box, country)
+        )
+    except Exception as e:
+        log(f"Error getting visitor stats: {e}", level="error", exc_info=True)
+        return {"error": str(e)}
+
+# Default time ranges for the rollup endpoints
+TIMESERIES_DEFAULT_DAYS = {"hour": 2, "day": 30}
+TOP_DEFAULT_DAYS = 7
+
+def get_visit_rollups() -> VisitRollups:
+    """Return the running visit rollups, or raise if startup failed to create them"""
+    if visit_rollups is None:
+        raise RuntimeError("Visit rollups are not initialized")
+    return visit_rollups
+
+@app.get("/api/visits/timeseries")
+async def get_visits_timeseries(
+    request: Request,
+    period: str = Query("hour", pattern="^(hour|day)$"),
+    since: Optional[str] = Query(None, description="ISO timestamp; defaults to 2 days ago for hours, 30 days for days"),
+    until: Optional[str] = Query(None, description="ISO timestamp, inclusive"),
+):
+    """
+    Visits and unique IPs per hour or day, read from the rollup tables.
+    Events from the last couple of minutes are not rolled up yet.
+    """
+    try:
+        if not since:
+            since = (datetime.utcnow() - timedelta(days=TIMESERIES_DEFAULT_DAYS[period])).isoformat()
+        
+        async def build():
+            buckets = await get_visit_rollups().timeseries(period, since, until)
+            return {"period": period, "buckets": buckets}
+        
+        return await cached_json_response(response_cache, request, build)
+    except Exception as e:
+        log(f"Error getting visit timeseries: {e}", level="error", exc_info=True)
+        return {"period": period, "buckets": [], "error": str(e)}
+
+@app.get("/api/visits/top")
+async def get_visits_top(
+    request: Request,
+    dimension: str = Query("referer", pattern="^(country|referer)$"),
+    days: int = Query(TOP_DEFAULT_DAYS, ge=1, le=366),
+    limit: int = Query(10, ge=1, le=100),
+):
+    """Top countries or referers over the last `days` days, from the daily rollups"""
+    try:
+        since = (datetime.utcnow() - timedelta(days=days - 1)).isoformat()
+        
+        async def build():
+            top = await get_visit_rollups().top(dimension, "day", since, limit)
+            return {"dimension": dimension, "days": days, "top": top}
+        
+        return await cached_json_response(response_cache, request, build)
+    except Exception as e:
+        log(f"Error getting top {dimension}s: {e}", level="error", exc_info=True)
+        return {"dimension": dimension, "days": days, "top": [], "error": str(e)}
+
+# Rows fetched per query while streaming an export
+EXPORT_CHUNK_SIZE = 1000
+
+EXPORT_COLUMNS = [
+    "ip", "visit_count", "first_visit", "last_visit", "last_referer",
+    "lat", "lng", "city", "region", "country", "country_code", "street_location",
+]
+
+async def iter_visitor_chunks(chunk_size: int = EXPORT_CHUNK_SIZE):
+    """
+    Yield every visitor row in rowid order, chunk_size rows at a time.
+    Each chunk borrows a reader only for its own query, so a slow client
+    never holds a pooled connection (or a WAL snapshot) for the whole export.
+    """
+    last_rowid = 0
+    while True:
+        async with get_visitor_db().reader() as conn:
+            cursor = await conn.execute(
+                f"SELECT rowid, {', '.join(EXPORT_COLUMNS)} FROM visitors WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (last_rowid, chunk_size)
+            )
+            rows = await cursor.fetchall()
+        if not rows:
+            return
+        last_rowid = rows[-1][0]
+        yield [row[1:] for row in rows]
+
+async def export_ndjson():
+    async for rows in iter_visitor_chunks():
+        yield b"".join(dumps(dict(zip(EXPORT_COLUMNS, row))) + b"\n" for row in rows)
+
+async def export_csv():
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    async for rows in iter_visitor_chunks():
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+# Route 5: Stream the whole visitors table for offline analysis
+@app.get("/api/visitors/export")
+async def export_visitors(format: str = Query("ndjson", pattern="^(ndjson|csv)$")):
+    """
+    Stream every visitor as NDJSON (one object per line) or CSV.
+    Rows are read and written in fixed-size chunks, so memory use does not
+    grow with the size of the table.
+    """
+    get_visitor_db()  # Fail before the response starts if the database isn't open
+    if format == "csv":
+        body, media_type = export_csv(), "text/csv"
+    else:
+        body, media_type = export_ndjson(), "application/x-ndjson"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="visitors.{format}"'},
+    )
@@ -0,0 +1,205 @@
+import asyncio
+import time
+from typing import Dict, Optional
+
+from database import VisitorDatabase
+from logs import log
+
+# How often the scheduler wakes up to look at the WAL
+MAINTENANCE_TICK_SECONDS = 5
+
+# Checkpoint (PASSIVE) once the WAL file reaches this size...
+WAL_CHECKPOINT_BYTES = 4 * 1024 * 1024
+# ...or when writes have been waiting this long, whichever comes first
+WAL_CHECKPOINT_INTERVAL_SECONDS = 60
+
+# With no writes for this long the database counts as idle and the WAL is truncated
+IDLE_SECONDS = 30
+
+# PRAGMA optimize refreshes query planner statistics that have drifted
+OPTIMIZE_INTERVAL_SECONDS = 6 * 60 * 60
+
+# Incremental vacuum runs while idle, returning at most this many free pages per pass
+VACUUM_INTERVAL_SECONDS = 60 * 60
+VACUUM_MIN_FREE_PAGES = 256
+VACUUM_MAX_PAGES = 2048
+
+
+class OperationTimings:
+    """Run count and durations for one kind of maintenance operation"""
+
+    __slots__ = ("runs", "errors", "total_ms", "max_ms", "last_ms", "last_run", "last_result")
+
+    def __init__(self):
+        self.runs = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_ms: Optional[float] = None
+        self.last_run: Optional[float] = None
+        self.last_result = None
+
+    def record(self, elapsed_ms: float, result=None):
+        self.runs += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.last_ms = round(elapsed_ms, 2)
+        self.last_run = time.time()
+        self.last_result = result
+
+    def to_dict(self) -> dict:
+        return {
+            "runs": self.runs,
+            "errors": self.errors,
+            "avg_ms": round(self.total_ms / self.runs, 2) if self.runs else None,
+            "max_ms": round(self.max_ms, 2),
+            "last_ms": self.last_ms,
+            "last_run": self.last_run,
+            "last_result": self.last_result,
+        }
+
+
+class DatabaseMaintenance:
+    """
+    Background housekeeping for the visitors database.
+
+    SQLite's automatic checkpoint runs inside whichever commit pushes the WAL
+    past 1000 pages, so it is switched off and checkpoints happen here instead,
+    on the database's dedicated checkpoint connection. A PASSIVE checkpoint
+    runs when the WAL grows past WAL_CHECKPOINT_BYTES or writes have been
+    waiting for WAL_CHECKPOINT_INTERVAL_SECONDS; it never waits on readers
+    or the writer. Once writes stop for IDLE_SECONDS a TRUNCATE checkpoint
+    shrinks the WAL file back to zero. PRAGMA optimize and incremental vacuum
+    run on the same schedule, and every operation's timings are kept for
+    /api/db/maintenance.
+    """
+
+    def __init__(self, db: VisitorDatabase, tick_seconds: float = MAINTENANCE_TICK_SECONDS):
+        self.db = db
+        self.tick_seconds = tick_seconds
+        self.timings: Dict[str, OperationTimings] = {
+            "checkpoint_passive": OperationTimings(),
+            "checkpoint_truncate": OperationTimings(),
+            "optimize": OperationTimings(),
+            "incremental_vacuum": OperationTimings(),
+        }
+        self._task: Optional[asyncio.Task] = None
+        # Commit count covered by the last checkpoint, and when it ran
+        self._checkpointed_commits = db.commits
+        self._last_checkpoint = time.monotonic()
+        self._truncated = False
+        self._last_optimize: Optional[float] = None
+        self._last_vacuum = time.monotonic()
+
+    async def start(self):
+        if self._task is None:
+            async with self.db.writer() as conn:
+                await conn.execute("PRAGMA wal_autocheckpoint=0")
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                log(f"Error during database maintenance: {e}", level="error", exc_info=True)
+            await asyncio.sleep(self.tick_seconds)
+
+    async def run_once(self):
+        """Run whatever maintenance is due right now"""
+        now = time.monotonic()
+        idle = now - self.db.last_write >= IDLE_SECONDS
+
+        if self.db.commits != self._checkpointed_commits:
+            self._truncated = False
+            if idle:
+                await self.checkpoint("TRUNCATE")
+            elif (
+                self.db.wal_size() >= WAL_CHECKPOINT_BYTES
+                or now - self._last_checkpoint >= WAL_CHECKPOINT_INTERVAL_SECONDS
+            ):
+                await self.checkpoint("PASSIVE")
+        elif idle and not self._truncated and self.db.wal_size() > 0:
+            # A PASSIVE checkpoint copied everything back but left the file at full size
+            await self.checkpoint("TRUNCATE")
+
+        if self._last_optimize is None:
+            # Once per connection lifetime, with analysis limits suited to a fresh connection
+            await self.optimize("PRAGMA optimize=0x10002")
+        elif now - self._last_optimize >= OPTIMIZE_INTERVAL_SECONDS:
+            await self.optimize()
+
+        if idle and now - self._last_vacuum >= VACUUM_INTERVAL_SECONDS:
+            await self.incremental_vacuum()
+
+    async def checkpoint(self, mode: str = "PASSIVE"):
+        commits = self.db.commits
+        timings = self.timings[f"checkpoint_{mode.lower()}"]
+        start = time.perf_counter()
+        try:
+            busy, wal_frames, checkpointed = await self.db.checkpoint(mode)
+        except Exception:
+            timings.errors += 1
+            raise
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        timings.record(elapsed_ms, {"busy": busy, "wal_frames": wal_frames, "checkpointed": checkpointed})
+        self._last_checkpoint = time.monotonic()
+        if not busy and wal_frames == checkpointed:
+            # Everything up to `commits` is in the main database file now
+            self._checkpointed_commits = commits
+            self._truncated = mode == "TRUNCATE"
+        if mode == "TRUNCATE" or elapsed_ms >= 100:
+            log(f"WAL checkpoint {mode}: {checkpointed}/{wal_frames} frames in {elapsed_ms:.1f} ms")
+
+    async def optimize(self, statement: str = "PRAGMA optimize"):
+        timings = self.timings["optimize"]
+        start = time.perf_counter()
+        try:
+            async with self.db.writer() as conn:
+                await conn.execute(statement)
+        except Exception:
+            timings.errors += 1
+            raise
+        finally:
+            self._last_optimize = time.monotonic()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        timings.record(elapsed_ms)
+        log(f"PRAGMA optimize finished in {elapsed_ms:.1f} ms")
+
+    async def incremental_vacuum(self):
+        timings = self.timings["incremental_vacuum"]
+        self._last_vacuum = time.monotonic()
+        start = time.perf_counter()
+        try:
+            async with self.db.writer() as conn:
+                cursor = await conn.execute("PRAGMA freelist_count")
+                free_pages = (await cursor.fetchone())[0]
+                if free_pages < VACUUM_MIN_FREE_PAGES:
+                    return
+                pages = min(free_pages, VACUUM_MAX_PAGES)
+                # Each step of the statement frees one page; executescript steps it to completion
+                await conn.executescript(f"PRAGMA incremental_vacuum({pages});")
+        except Exception:
+            timings.errors += 1
+            raise
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        timings.record(elapsed_ms, {"free_pages": free_pages, "released": pages})
+        log(f"Incremental vacuum released {pages} of {free_pages} free pages in {elapsed_ms:.1f} ms")
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "wal_bytes": self.db.wal_size(),
+            "seconds_since_write": round(now - self.db.last_write, 1),
+            "seconds_since_checkpoint": round(now - self._last_checkpoint, 1),
+            "operations": {name: timings.to_dict() for name, timings in self.timings.items()},
+        }
@@ -0,0 +1,273 @@
+"""
+Process metrics, served at /metrics in the Prometheus text format (0.0.4).
+
+A small built-in implementation rather than prometheus_client, which isn't
+a dependency: recording a value is a dict lookup and a couple of additions
+on the event loop thread, cheap enough to leave on for every request.
+Metrics can also be read from a callback when /metrics is scraped, which is
+how the counters the caches already keep are exposed without counting twice.
+"""
+import asyncio
+import math
+import re
+import time
+import uuid
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, Optional, Sequence, Tuple
+
+from logs import JSON_LOGS, log, request_id
+
+# Latency buckets in seconds, from sub-millisecond cache hits to Nominatim timeouts
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+
+# How often the event loop lag probe runs
+LOOP_LAG_INTERVAL_SECONDS = 0.5
+
+# Incoming X-Request-ID values are kept if they look like IDs, otherwise a new one is generated
+REQUEST_ID_PATTERN = re.compile(r"[A-Za-z0-9._-]{1,64}")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# By name; registering a metric again (e.g. when main is reloaded) replaces it
+REGISTRY: Dict[str, "Metric"] = {}
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    """
+    A metric family with fixed label names. When collect is given it is
+    called at scrape time and returns the value (or a {label values: value}
+    dict, or None to skip the metric) instead of values recorded in-process.
+    """
+
+    type = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        collect: Optional[Callable[[], object]] = None,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+        self._values: Dict[LabelValues, float] = {}
+        REGISTRY[name] = self
+
+    def _label_text(self, values: LabelValues, extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def _collected(self) -> Dict[LabelValues, float]:
+        if self.collect is None:
+            return self._values
+        values = self.collect()
+        if values is None:
+            return {}
+        return values if isinstance(values, dict) else {(): values}
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        for values, value in self._collected().items():
+            yield f"{self.name}{self._label_text(values)} {_format_value(value)}"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *label_values: str, amount: float = 1.0):
+        self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, *label_values: str):
+        self._values[label_values] = value
+
+    def inc(self, *label_values: str, amount: float = 1.0):
+        self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+
+class Timer:
+    """Observes the time spent inside a with block in a histogram"""
+
+    __slots__ = ("histogram", "label_values", "start")
+
+    def __init__(self, histogram: "Histogram", label_values: LabelValues):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self) -> "Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # Per label values: [non-cumulative bucket counts (last one is +Inf), sum]
+        self._series: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, *label_values: str):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def time(self, *label_values: str) -> Timer:
+        return Timer(self, label_values)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        for values, (counts, total) in list(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{self._label_text(values, le)} {cumulative}"
+            yield f"{self.name}_sum{self._label_text(values)} {_format_value(total)}"
+            yield f"{self.name}_count{self._label_text(values)} {cumulative}"
+
+
+def render() -> str:
+    """Every registered metric in the Prometheus text format"""
+    lines = []
+    for metric in list(REGISTRY.values()):
+        try:
+            lines.extend(metric.render())
+        except Exception as e:
+            log(f"Error collecting metric {metric.name}: {e}", level="error")
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time from receiving a request to sending the last byte of the response",
+    ("method", "route", "status"),
+)
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "Requests being handled")
+
+STAGE_SECONDS = Histogram(
+    "app_stage_duration_seconds",
+    "Time spent in each stage of request handling and background work",
+    ("stage",),
+)
+
+LOOP_LAG_SECONDS = Histogram(
+    "app_event_loop_lag_seconds",
+    f"How late a {LOOP_LAG_INTERVAL_SECONDS}s sleep on the event loop woke up",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+LOOP_LAG_LAST = Gauge("app_event_loop_lag_last_seconds", "Lag measured by the most recent probe")
+
+
+def stage(name: str) -> Timer:
+    """with stage("geoip_lookup"): ... records the block's duration in app_stage_duration_seconds"""
+    return Timer(STAGE_SECONDS, (name,))
+
+
+class RequestMetricsMiddleware:
+    """
+    ASGI middleware that times every HTTP request by route template and
+    status, and gives it a request ID: the client's X-Request-ID when it
+    looks like one, otherwise a new one. The ID is echoed in the response,
+    set in logs.request_id for the request's log lines, and with JSON logs
+    each request also gets an access log line.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        incoming = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                incoming = value.decode("latin-1")
+                break
+        current_id = incoming if incoming and REQUEST_ID_PATTERN.fullmatch(incoming) else uuid.uuid4().hex
+        token = request_id.set(current_id)
+        status = 500
+
+        async def send_with_request_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [*message.get("headers", ()), (b"x-request-id", current_id.encode())]
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc(amount=1)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            elapsed = time.perf_counter() - start
+            REQUESTS_IN_FLIGHT.inc(amount=-1)
+            # The route template, not the path, so IDs and query strings don't multiply series
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            REQUEST_SECONDS.observe(elapsed, scope["method"], route, str(status))
+            if JSON_LOGS:
+                log(
+                    "request", method=scope["method"], path=scope["path"], route=route,
+                    status=status, duration_ms=round(elapsed * 1000, 2),
+                )
+            request_id.reset(token)
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop runs a short sleep (time blocked by synchronous work)"""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL_SECONDS):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - start - self.interval)
+            LOOP_LAG_SECONDS.observe(lag)
+            LOOP_LAG_LAST.set(lag)
@@ -0,0 +1,236 @@
+"""
+Notes store backed by the notes table and its FTS5 index.
+
+Notes are edited from the command line (the API is read-only):
+
+    python notes.py add --title "..." --date 2025-12-20 --content "..."
+    python notes.py update ID [--title ...] [--date ...] [--content ...]
+    python notes.py delete ID
+    python notes.py list
+"""
+import argparse
+import asyncio
+import base64
+import json
+import re
+import time
+from datetime import date
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from database import VisitorDatabase, default_db_path
+
+NOTES_PAGE_SIZE = 20
+NOTES_MAX_PAGE_SIZE = 100
+NOTES_SEARCH_LIMIT = 20
+
+# How often the notes_version counter is re-read, so edits made by another
+# process (e.g. this CLI) show up without a restart
+NOTES_VERSION_CHECK_SECONDS = 2
+
+# Notes that used to be hard-coded in main.py; inserted once into an empty store
+SEED_NOTES = [
+    {
+        "title": "Oracle Cloud Architecture",
+        "date": "2025-12-20",
+        "content": "Deploying a split-stack architecture on ARM instances...",
+    },
+    {
+        "title": "React vs. Vanilla JS",
+        "date": "2025-12-18",
+        "content": "Why component-based state management wins for dashboards...",
+    },
+]
+
+NOTE_COLUMNS = "id, title, date, content"
+
+
+def note_row_to_dict(row) -> dict:
+    return {"id": row[0], "title": row[1], "date": row[2], "content": row[3]}
+
+
+def encode_note_cursor(row) -> str:
+    """Opaque cursor pointing just after row in (date, id) descending order"""
+    payload = json.dumps([row[2], row[0]], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_note_cursor(cursor: str) -> Tuple[str, int]:
+    """Raises ValueError for anything that isn't a cursor from encode_note_cursor"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        note_date, note_id = json.loads(base64.urlsafe_b64decode(padded))
+        return str(note_date), int(note_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def fts_query(text: str) -> Optional[str]:
+    """
+    Turn free text into an FTS5 query: every word must match, the last one
+    as a prefix (search-as-you-type). Words are quoted, so FTS5 syntax in
+    the input can't cause errors. None if there are no words.
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+class NotesStore:
+    """
+    Reads and writes notes. version changes whenever a note is added, edited
+    or removed (a trigger bumps notes_version in job_state), which is what
+    the cached /api/notes responses are keyed on.
+    """
+
+    def __init__(self, db: VisitorDatabase):
+        self.db = db
+        self.version = -1
+        self._checked_at = 0.0
+
+    async def seed(self):
+        """Insert SEED_NOTES the first time the store is opened"""
+        async with self.db.writer() as conn:
+            cursor = await conn.execute("SELECT 1 FROM job_state WHERE name = 'notes_seeded'")
+            if await cursor.fetchone():
+                return
+            cursor = await conn.execute("SELECT COUNT(*) FROM notes")
+            if (await cursor.fetchone())[0] == 0:
+                await conn.executemany(
+                    "INSERT INTO notes (title, date, content) VALUES (?, ?, ?)",
+                    [(note["title"], note["date"], note["content"]) for note in SEED_NOTES],
+                )
+            await conn.execute("INSERT INTO job_state (name, value) VALUES ('notes_seeded', 1)")
+        self._checked_at = 0.0
+
+    async def check_version(self) -> int:
+        """Re-read notes_version if it hasn't been checked for NOTES_VERSION_CHECK_SECONDS"""
+        now = time.monotonic()
+        if now - self._checked_at >= NOTES_VERSION_CHECK_SECONDS:
+            async with self.db.reader() as conn:
+                cursor = await conn.execute("SELECT value FROM job_state WHERE name = 'notes_version'")
+                row = await cursor.fetchone()
+            self.version = row[0] if row else 0
+            self._checked_at = now
+        return self.version
+
+    async def page(self, limit: int = NOTES_PAGE_SIZE, cursor: Optional[str] = None) -> dict:
+        """Notes newest first, limit per page; raises ValueError for a bad cursor"""
+        query = f"SELECT {NOTE_COLUMNS} FROM notes"
+        params: list = []
+        if cursor:
+            query += " WHERE (date, id) < (?, ?)"
+            params.extend(decode_note_cursor(cursor))
+        query += " ORDER BY date DESC, id DESC LIMIT ?"
+        params.append(limit + 1)
+        async with self.db.reader() as conn:
+            rows = await (await conn.execute(query, params)).fetchall()
+            total = (await (await conn.execute("SELECT COUNT(*) FROM notes")).fetchone())[0]
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_note_cursor(rows[-1])
+        return {"notes": [note_row_to_dict(row) for row in rows], "total": total, "next_cursor": next_cursor}
+
+    async def search(self, text: str, limit: int = NOTES_SEARCH_LIMIT) -> List[dict]:
+        """Best matches first (bm25, title weighted over content), with a highlighted snippet"""
+        match = fts_query(text)
+        if match is None:
+            return []
+        async with self.db.reader() as conn:
+            rows = await (await conn.execute(
+                """SELECT notes.id, notes.title, notes.date, notes.content,
+                          snippet(notes_fts, 1, '<mark>', '</mark>', '...', 16)
+                   FROM notes_fts JOIN notes ON notes.id = notes_fts.rowid
+                   WHERE notes_fts MATCH ?
+                   ORDER BY bm25(notes_fts, 5.0, 1.0)
+                   LIMIT ?""",
+                (match, limit),
+            )).fetchall()
+        return [{**note_row_to_dict(row), "snippet": row[4]} for row in rows]
+
+    async def add(self, title: str, note_date: str, content: str) -> int:
+        async with self.db.writer() as conn:
+            cursor = await conn.execute(
+                "INSERT INTO notes (title, date, content) VALUES (?, ?, ?)", (title, note_date, content)
+            )
+            note_id = cursor.lastrowid
+        self._checked_at = 0.0
+        return note_id
+
+    async def update(self, note_id: int, **fields) -> bool:
+        fields = {name: value for name, value in fields.items() if value is not None}
+        if not fields:
+            return False
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        async with self.db.writer() as conn:
+            cursor = await conn.execute(
+                f"UPDATE notes SET {assignments} WHERE id = ?", [*fields.values(), note_id]
+            )
+            updated = cursor.rowcount > 0
+        self._checked_at = 0.0
+        return updated
+
+    async def delete(self, note_id: int) -> bool:
+        async with self.db.writer() as conn:
+            cursor = await conn.execute("DELETE FROM notes WHERE id = ?", (note_id,))
+            deleted = cursor.rowcount > 0
+        self._checked_at = 0.0
+        return deleted
+
+
+async def run_command(args):
+    db = VisitorDatabase(args.db, reader_count=1)
+    await db.open()
+    try:
+        store = NotesStore(db)
+        await store.seed()
+        if args.command == "add":
+            note_id = await store.add(args.title, args.date, args.content)
+            print(f"Added note {note_id}")
+        elif args.command == "update":
+            if not await store.update(args.id, title=args.title, date=args.date, content=args.content):
+                print(f"Note {args.id} not found (or nothing to change)")
+        elif args.command == "delete":
+            if not await store.delete(args.id):
+                print(f"Note {args.id} not found")
+        elif args.command == "list":
+            cursor = None
+            while True:
+                page = await store.page(NOTES_MAX_PAGE_SIZE, cursor)
+                for note in page["notes"]:
+                    print(f"{note['id']:>5}  {note['date']}  {note['title']}")
+                cursor = page["next_cursor"]
+                if cursor is None:
+                    break
+    finally:
+        await db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--db", type=Path,
+        default=default_db_path(),
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add")
+    add.add_argument("--title", required=True)
+    add.add_argument("--date", default=date.today().isoformat())
+    add.add_argument("--content", required=True)
+    update = commands.add_parser("update")
+    update.add_argument("id", type=int)
+    update.add_argument("--title")
+    update.add_argument("--date")
+    update.add_argument("--content")
+    delete = commands.add_parser("delete")
+    delete.add_argument("id", type=int)
+    commands.add_parser("list")
+    asyncio.run(run_command(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+Per-client rate limiting and bot shedding, in front of the routes.
+
+Limits are token buckets per client and rule, kept as GCRA state: one
+float per bucket (the time the bucket will be full again), which is
+equivalent to tracking tokens and a refill timestamp. A bucket whose time
+has passed is full, so dropping it loses nothing; buckets are kept in
+last-use order and full ones are evicted from the front as requests come in.
+
+IPv6 clients are limited per /64, the smallest block one subscriber
+usually gets, so rotating through addresses in it doesn't reset the limit.
+"""
+import math
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from ipranges import BLOCKED, BOT, IPClassifier, pack_ip
+from logs import log
+from metrics import Counter
+from serialization import dumps
+
+# "path prefix=requests per second:burst", comma-separated; RATE_LIMITS overrides, "off" disables
+DEFAULT_RATE_LIMITS = "/api/geolocation=0.5:10,/api/visitors=2:30,/api/notes=5:30"
+
+# Buckets kept at most; the least recently used go first when there are more
+RATE_LIMIT_MAX_BUCKETS = int(os.environ.get("RATE_LIMIT_MAX_BUCKETS", "100000"))
+
+# Routes that record visits: bots get an empty answer there instead of being tracked
+TRACKING_PATHS = ("/api/geolocation",)
+
+# User agents of crawlers, monitors and scripts (matched case-insensitively);
+# an empty User-Agent counts as a bot too
+BOT_USER_AGENT_PATTERN = re.compile(
+    r"bot\b|bot/|crawl|spider|slurp|scrap|fetch|monitor|preview|archiver|headless|phantomjs|lighthouse"
+    r"|curl/|wget/|httpie|python-requests|python-urllib|aiohttp|go-http-client|java/|okhttp|libwww"
+    r"|facebookexternalhit|embedly",
+    re.IGNORECASE,
+)
+
+RATE_LIMIT_REQUESTS = Counter(
+    "app_rate_limit_requests_total", "Requests checked against a rate limit rule", ("rule", "result")
+)
+SHED_REQUESTS = Counter("app_requests_shed_total", "Requests answered early without reaching a route", ("reason",))
+
+
+def is_bot_user_agent(user_agent: Optional[str]) -> bool:
+    return not user_agent or BOT_USER_AGENT_PATTERN.search(user_agent) is not None
+
+
+class RateLimitRule:
+    __slots__ = ("path", "rate", "burst", "interval", "tolerance")
+
+    def __init__(self, path: str, rate: float, burst: int):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        # GCRA: each request pushes the bucket's full time back by interval,
+        # and it may run at most burst intervals ahead of now
+        self.interval = 1.0 / rate
+        self.tolerance = burst * self.interval
+
+
+def parse_rate_limits(value: str) -> List[RateLimitRule]:
+    """Rules from "path=rate:burst,..."; invalid entries are logged and skipped"""
+    if value.strip().lower() == "off":
+        return []
+    rules = []
+    for entry in value.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        try:
+            path, limit = entry.split("=", 1)
+            rate, burst = limit.split(":", 1)
+            rule = RateLimitRule(path.strip(), float(rate), int(burst))
+            if rule.rate <= 0 or rule.burst < 1:
+                raise ValueError("rate and burst must be positive")
+        except ValueError as e:
+            log(f"Ignoring invalid rate limit {entry!r}: {e}", level="warning")
+            continue
+        rules.append(rule)
+    return rules
+
+
+class RateLimiter:
+    """Token buckets per (rule, client); the first rule whose path prefix matches applies"""
+
+    def __init__(self, rules: Sequence[RateLimitRule], max_buckets: int = RATE_LIMIT_MAX_BUCKETS):
+        self.rules = list(rules)
+        self.max_buckets = max_buckets
+        # (rule index, client key) -> time the bucket is full again
+        self._buckets: "OrderedDict[Tuple[int, bytes], float]" = OrderedDict()
+        self.evictions = 0
+        self.allowed: Dict[str, int] = {rule.path: 0 for rule in self.rules}
+        self.throttled: Dict[str, int] = {rule.path: 0 for rule in self.rules}
+
+    @classmethod
+    def from_env(cls) -> "RateLimiter":
+        return cls(parse_rate_limits(os.environ.get("RATE_LIMITS", DEFAULT_RATE_LIMITS)))
+
+    def rule_for(self, path: str) -> Optional[Tuple[int, RateLimitRule]]:
+        for index, rule in enumerate(self.rules):
+            if path.startswith(rule.path):
+                return index, rule
+        return None
+
+    @staticmethod
+    def client_key(client_ip: str) -> bytes:
+        """Packed IPv4 address or IPv6 /64; the raw string for anything else"""
+        address = pack_ip(client_ip)
+        if address is None:
+            return client_ip.encode()
+        version, packed = address
+        return packed if version == 4 else packed[:8]
+
+    def check(self, path: str, client_ip: str) -> Optional[float]:
+        """None if the request may go ahead, otherwise seconds until it would be allowed"""
+        match = self.rule_for(path)
+        if match is None:
+            return None
+        index, rule = match
+        now = time.monotonic()
+        self._evict(now)
+
+        key = (index, self.client_key(client_ip))
+        full_at = max(self._buckets.get(key, now), now) + rule.interval
+        wait = full_at - now - rule.tolerance
+        if wait > 0:
+            self.throttled[rule.path] += 1
+            RATE_LIMIT_REQUESTS.inc(rule.path, "throttled")
+            return wait
+        self._buckets[key] = full_at
+        self._buckets.move_to_end(key)
+        self.allowed[rule.path] += 1
+        RATE_LIMIT_REQUESTS.inc(rule.path, "allowed")
+        return None
+
+    def _evict(self, now: float):
+        buckets = self._buckets
+        while buckets:
+            key, full_at = next(iter(buckets.items()))
+            if full_at > now and len(buckets) < self.max_buckets:
+                break
+            del buckets[key]
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "rules": [
+                {
+                    "path": rule.path,
+                    "rate_per_second": rule.rate,
+                    "burst": rule.burst,
+                    "allowed": self.allowed[rule.path],
+                    "throttled": self.throttled[rule.path],
+                }
+                for rule in self.rules
+            ],
+            "buckets": len(self._buckets),
+            "max_buckets": self.max_buckets,
+            "evictions": self.evictions,
+        }
+
+
+class RateLimitMiddleware:
+    """
+    ASGI middleware that answers junk traffic before routing, without any
+    database, GeoIP or geocoder work:
+      - blocklisted IPs get 403 everywhere
+      - bots (by IP range or User-Agent) get an empty, untracked answer on
+        the tracking routes
+      - clients over a rate limit get 429 with Retry-After
+    """
+
+    def __init__(self, app, classifier: IPClassifier, limiter: RateLimiter):
+        self.app = app
+        self.classifier = classifier
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+
+        forwarded_for = None
+        user_agent = None
+        for name, value in scope["headers"]:
+            if name == b"x-forwarded-for":
+                forwarded_for = value.decode("latin-1")
+            elif name == b"user-agent":
+                user_agent = value.decode("latin-1")
+        peer = scope["client"][0] if scope.get("client") else None
+        client_ip = self.classifier.client_ip(peer, forwarded_for)
+        path = scope["path"]
+
+        ip_class = self.classifier.classify(client_ip)
+        if ip_class == BLOCKED:
+            SHED_REQUESTS.inc("blocked")
+            await send_json(send, 403, b'{"detail":"Forbidden"}')
+            return
+        if path.startswith(TRACKING_PATHS):
+            reason = "bot_range" if ip_class == BOT else "bot_user_agent" if is_bot_user_agent(user_agent) else None
+            if reason is not None:
+                SHED_REQUESTS.inc(reason)
+                body = dumps({"ip": client_ip, "geo": None, "visit_count": 0, "referer": None})
+                await send_json(send, 200, body)
+                return
+
+        wait = self.limiter.check(path, client_ip)
+        if wait is not None:
+            SHED_REQUESTS.inc("rate_limited")
+            await send_json(send, 429, b'{"detail":"Too Many Requests"}', [(b"retry-after", str(math.ceil(wait)).encode())])
+            return
+        await self.app(scope, receive, send)
+
+
+async def send_json(send, status: int, body: bytes, headers: Sequence[Tuple[bytes, bytes]] = ()):
+    """Send a complete JSON response straight through ASGI"""
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            *headers,
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
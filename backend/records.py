@@ -0,0 +1,55 @@
+"""
+Typed records for the payloads the hot endpoints return.
+
+They are slotted dataclasses rather than dicts: smaller per instance,
+attribute access instead of string lookups, and orjson serializes
+dataclasses natively without building an intermediate dict. Field names
+are the JSON keys, hence the camelCase ones the frontend already uses.
+"""
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass(frozen=True, slots=True)
+class GeoLocation:
+    """A GeoLite2 City record flattened to what /api/geolocation returns"""
+
+    lat: Optional[float]
+    lng: Optional[float]
+    city: str
+    region: str
+    country: str
+    countryCode: str
+    timezone: str
+    isp: str
+    org: str
+    streetLocation: Optional[str] = None
+
+
+@dataclass(slots=True)
+class VisitorGeo:
+    lat: Optional[float]
+    lng: Optional[float]
+    city: Optional[str]
+    region: Optional[str]
+    country: Optional[str]
+    countryCode: Optional[str]
+
+
+@dataclass(slots=True)
+class VisitorRecord:
+    ip: str
+    visit_count: int
+    first_visit: Optional[str]
+    last_visit: Optional[str]
+    geo: Optional[VisitorGeo]
+    streetLocation: Optional[str]
+
+    @classmethod
+    def from_row(cls, row) -> "VisitorRecord":
+        """Build from a VISITOR_COLUMNS row; visitors that aren't enriched yet have no geo"""
+        return cls(
+            row[0], row[1], row[2], row[3],
+            VisitorGeo(row[4], row[5], row[6], row[7], row[8], row[9]) if row[8] is not None else None,
+            row[10],
+        )
@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional
+
+from fastapi import Request, Response
+
+from logs import log
+from serialization import dumps_response
+
+# Distinct responses (path + query string) kept in memory
+RESPONSE_CACHE_SIZE = 256
+
+# Bodies larger than this are served but not kept (e.g. /api/visitors?all=true)
+RESPONSE_CACHE_MAX_BODY_BYTES = 1024 * 1024
+
+# A stale entry is served while it is regenerated, for at most this long after it was built
+STALE_WHILE_REVALIDATE_SECONDS = 30
+
+
+class CachedResponse:
+    """Serialized response body and the data version it was built from"""
+
+    __slots__ = ("body", "etag", "version", "built_at")
+
+    def __init__(self, body: bytes, version: int):
+        self.body = body
+        self.etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+        self.version = version
+        self.built_at = time.monotonic()
+
+
+class ResponseCache:
+    """
+    In-memory cache of serialized JSON responses, keyed by request and
+    invalidated by a data version counter that writers bump.
+
+    An entry built from the current version is served as is. An entry built
+    from an older version is still served (stale-while-revalidate) while one
+    background task rebuilds it, and a request that finds no usable entry
+    waits on that same task, so a burst of misses for one key builds the
+    response once.
+    """
+
+    def __init__(
+        self,
+        get_version: Callable[[], int],
+        max_entries: int = RESPONSE_CACHE_SIZE,
+        max_body_bytes: int = RESPONSE_CACHE_MAX_BODY_BYTES,
+        stale_seconds: float = STALE_WHILE_REVALIDATE_SECONDS,
+    ):
+        self.get_version = get_version
+        self.max_entries = max_entries
+        self.max_body_bytes = max_body_bytes
+        self.stale_seconds = stale_seconds
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._building: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.builds = 0
+        self.not_modified = 0
+
+    async def get(self, key: str, build: Callable[[], Awaitable[bytes]]) -> CachedResponse:
+        """Cached response for key, calling build() to (re)generate the body when needed"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            if entry.version == self.get_version():
+                self.hits += 1
+                return entry
+            if time.monotonic() - entry.built_at <= self.stale_seconds:
+                self.stale_hits += 1
+                self._rebuild(key, build)
+                return entry
+        self.misses += 1
+        # Shielded so a client disconnecting doesn't cancel a build other requests are waiting on
+        return await asyncio.shield(self._rebuild(key, build))
+
+    def _rebuild(self, key: str, build: Callable[[], Awaitable[bytes]]) -> asyncio.Task:
+        task = self._building.get(key)
+        if task is None:
+            task = asyncio.create_task(self._build(key, build))
+            self._building[key] = task
+            task.add_done_callback(lambda done: self._build_done(key, done))
+        return task
+
+    def _build_done(self, key: str, task: asyncio.Task):
+        if self._building.get(key) is task:
+            del self._building[key]
+        if not task.cancelled() and task.exception() is not None:
+            log(f"Error building cached response for {key}: {task.exception()}", level="error")
+
+    async def _build(self, key: str, build: Callable[[], Awaitable[bytes]]) -> CachedResponse:
+        # Read the version first: a write that lands mid-build leaves the entry stale, not wrongly fresh
+        version = self.get_version()
+        entry = CachedResponse(await build(), version)
+        self.builds += 1
+        if len(entry.body) <= self.max_body_bytes:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.pop(key, None)
+        return entry
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "builds": self.builds,
+            "not_modified": self.not_modified,
+            "hit_ratio": round((self.hits + self.stale_hits) / lookups, 4) if lookups else None,
+            "entries": len(self._entries),
+            "building": len(self._building),
+        }
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match check (weak comparison, as RFC 9110 requires for this header)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+async def cached_json_response(
+    cache: ResponseCache,
+    request: Request,
+    build: Callable[[], Awaitable[dict]],
+) -> Response:
+    """
+    Serve build()'s JSON through the cache, keyed by path and query string,
+    with a strong ETag; answers a matching If-None-Match with 304.
+    """
+    async def render() -> bytes:
+        return dumps_response(await build())
+
+    key = f"{request.url.path}?{request.url.query}"
+    entry = await cache.get(key, render)
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("If-None-Match"), entry.etag):
+        cache.not_modified += 1
+        return Response(status_code=304, headers=headers)
+    return Response(entry.body, media_type="application/json", headers=headers)
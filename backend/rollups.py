@@ -0,0 +1,217 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from database import VisitorDatabase
+from logs import log
+
+# Bucket sizes, as the length of the ISO timestamp prefix that names the bucket
+ROLLUP_PERIODS = {
+    "hour": 13,  # "2025-06-01T13"
+    "day": 10,   # "2025-06-01"
+}
+
+ROLLUP_DIMENSIONS = ("country", "referer")
+
+# How often new visit events are folded into the rollup tables
+ROLLUP_INTERVAL_SECONDS = 60
+
+# Events younger than this are left for the next pass, so the enricher has
+# had time to resolve the visitor's country first
+ROLLUP_DELAY_SECONDS = 120
+
+# Events folded in per transaction
+ROLLUP_BATCH_SIZE = 5000
+
+# Raw events older than this are deleted (once rolled up); the rollups are kept forever
+VISIT_RETENTION_DAYS = 30
+PRUNE_INTERVAL_SECONDS = 60 * 60
+PRUNE_BATCH_SIZE = 5000
+
+ROLLUP_JOB = "visit_rollups"
+
+# Adds events in (low, high] to every bucket they fall in. An IP counts
+# towards unique_ips only if it has no earlier, already rolled up event in
+# the same bucket (events are pruned long after their day bucket closes).
+ROLLUP_TOTALS_SQL = """
+    INSERT INTO visit_rollups (period, bucket, visits, unique_ips)
+    SELECT :period, substr(v.ts, 1, :length), COUNT(*),
+           COUNT(DISTINCT CASE WHEN NOT EXISTS (
+               SELECT 1 FROM visits p
+               WHERE p.ip = v.ip AND p.ts >= substr(v.ts, 1, :length) AND p.id <= :low
+           ) THEN v.ip END)
+    FROM visits v
+    WHERE v.id > :low AND v.id <= :high
+    GROUP BY substr(v.ts, 1, :length)
+    ON CONFLICT (period, bucket) DO UPDATE SET
+        visits = visits + excluded.visits,
+        unique_ips = unique_ips + excluded.unique_ips
+"""
+
+ROLLUP_COUNTRY_SQL = """
+    INSERT INTO visit_rollup_dimensions (period, bucket, dimension, value, visits, unique_ips)
+    SELECT :period, substr(v.ts, 1, :length), 'country', COALESCE(visitors.country_code, ''), COUNT(*),
+           COUNT(DISTINCT CASE WHEN NOT EXISTS (
+               SELECT 1 FROM visits p
+               WHERE p.ip = v.ip AND p.ts >= substr(v.ts, 1, :length) AND p.id <= :low
+           ) THEN v.ip END)
+    FROM visits v LEFT JOIN visitors ON visitors.ip = v.ip
+    WHERE v.id > :low AND v.id <= :high
+    GROUP BY substr(v.ts, 1, :length), COALESCE(visitors.country_code, '')
+    ON CONFLICT (period, bucket, dimension, value) DO UPDATE SET
+        visits = visits + excluded.visits,
+        unique_ips = unique_ips + excluded.unique_ips
+"""
+
+ROLLUP_REFERER_SQL = """
+    INSERT INTO visit_rollup_dimensions (period, bucket, dimension, value, visits, unique_ips)
+    SELECT :period, substr(v.ts, 1, :length), 'referer', COALESCE(v.referer, ''), COUNT(*),
+           COUNT(DISTINCT CASE WHEN NOT EXISTS (
+               SELECT 1 FROM visits p
+               WHERE p.ip = v.ip AND p.ts >= substr(v.ts, 1, :length) AND p.id <= :low
+                 AND COALESCE(p.referer, '') = COALESCE(v.referer, '')
+           ) THEN v.ip END)
+    FROM visits v
+    WHERE v.id > :low AND v.id <= :high
+    GROUP BY substr(v.ts, 1, :length), COALESCE(v.referer, '')
+    ON CONFLICT (period, bucket, dimension, value) DO UPDATE SET
+        visits = visits + excluded.visits,
+        unique_ips = unique_ips + excluded.unique_ips
+"""
+
+
+def bucket_for(period: str, timestamp: str) -> str:
+    """Bucket name for an ISO timestamp, e.g. bucket_for("day", "2025-06-01T13:00:00") == "2025-06-01" """
+    return timestamp[:ROLLUP_PERIODS[period]]
+
+
+class VisitRollups:
+    """
+    Keeps the hourly and daily rollup tables up to date from the visits log.
+
+    The visits table is append-only, so a watermark (the last visits.id
+    folded in, kept in job_state) is all that's needed to maintain the
+    rollups incrementally: each pass aggregates only the events after it and
+    adds them to the existing buckets, in the same transaction that moves the
+    watermark. Raw events past VISIT_RETENTION_DAYS are pruned afterwards;
+    events that haven't been rolled up yet are never deleted.
+    """
+
+    def __init__(self, db: VisitorDatabase):
+        self.db = db
+        self._task: Optional[asyncio.Task] = None
+        self._last_prune: Optional[float] = None
+        self.rolled_up = 0
+        self.pruned = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.roll_up()
+                if self._last_prune is None or time.monotonic() - self._last_prune >= PRUNE_INTERVAL_SECONDS:
+                    await self.prune()
+            except Exception as e:
+                log(f"Error rolling up visits: {e}", level="error", exc_info=True)
+            await asyncio.sleep(ROLLUP_INTERVAL_SECONDS)
+
+    async def roll_up(self, delay_seconds: float = ROLLUP_DELAY_SECONDS) -> int:
+        """Fold every visit event older than delay_seconds into the rollups; returns the number of events"""
+        cutoff = (datetime.utcnow() - timedelta(seconds=delay_seconds)).isoformat()
+        total = 0
+        while True:
+            async with self.db.writer() as conn:
+                cursor = await conn.execute("SELECT value FROM job_state WHERE name = ?", (ROLLUP_JOB,))
+                row = await cursor.fetchone()
+                low = row[0] if row else 0
+                cursor = await conn.execute(
+                    "SELECT MAX(id), COUNT(*) FROM visits WHERE id > ? AND id <= ? AND ts <= ?",
+                    (low, low + ROLLUP_BATCH_SIZE, cutoff),
+                )
+                high, count = await cursor.fetchone()
+                if not count:
+                    break
+                for period, length in ROLLUP_PERIODS.items():
+                    params = {"period": period, "length": length, "low": low, "high": high}
+                    await conn.execute(ROLLUP_TOTALS_SQL, params)
+                    await conn.execute(ROLLUP_COUNTRY_SQL, params)
+                    await conn.execute(ROLLUP_REFERER_SQL, params)
+                await conn.execute(
+                    "INSERT INTO job_state (name, value) VALUES (?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+                    (ROLLUP_JOB, high),
+                )
+            total += count
+            if count < ROLLUP_BATCH_SIZE:
+                break
+        if total:
+            self.rolled_up += total
+            self.db.bump_data_version()
+        return total
+
+    async def prune(self, retention_days: int = VISIT_RETENTION_DAYS) -> int:
+        """Delete rolled up events older than the retention period; returns the number deleted"""
+        self._last_prune = time.monotonic()
+        cutoff = (datetime.utcnow() - timedelta(days=retention_days)).isoformat()
+        total = 0
+        while True:
+            async with self.db.writer() as conn:
+                cursor = await conn.execute(
+                    """DELETE FROM visits WHERE id IN (
+                           SELECT id FROM visits
+                           WHERE ts < ? AND id <= COALESCE((SELECT value FROM job_state WHERE name = ?), 0)
+                           LIMIT ?
+                       )""",
+                    (cutoff, ROLLUP_JOB, PRUNE_BATCH_SIZE),
+                )
+                deleted = cursor.rowcount
+            total += deleted
+            if deleted < PRUNE_BATCH_SIZE:
+                break
+        if total:
+            self.pruned += total
+            log(f"Pruned {total} visit events older than {retention_days} days")
+        return total
+
+    async def timeseries(self, period: str, since: str, until: Optional[str] = None) -> List[dict]:
+        """Visits and unique IPs per bucket from since (inclusive) to until (inclusive)"""
+        params = [period, bucket_for(period, since)]
+        query = "SELECT bucket, visits, unique_ips FROM visit_rollups WHERE period = ? AND bucket >= ?"
+        if until:
+            query += " AND bucket <= ?"
+            params.append(bucket_for(period, until))
+        query += " ORDER BY bucket"
+        async with self.db.reader() as conn:
+            rows = await (await conn.execute(query, params)).fetchall()
+        return [{"bucket": row[0], "visits": row[1], "unique_ips": row[2]} for row in rows]
+
+    async def top(self, dimension: str, period: str, since: str, limit: int = 10) -> List[dict]:
+        """
+        Most visited values of a dimension since a timestamp. unique_ips is
+        summed over buckets, so an IP seen on several days counts once per day.
+        """
+        async with self.db.reader() as conn:
+            rows = await (await conn.execute(
+                """SELECT value, SUM(visits) AS visits, SUM(unique_ips)
+                   FROM visit_rollup_dimensions
+                   WHERE period = ? AND dimension = ? AND bucket >= ?
+                   GROUP BY value ORDER BY visits DESC, value LIMIT ?""",
+                (period, dimension, bucket_for(period, since), limit),
+            )).fetchall()
+        return [{"value": row[0] or None, "visits": row[1], "unique_ips": row[2]} for row in rows]
+
+    def stats(self) -> dict:
+        return {"rolled_up": self.rolled_up, "pruned": self.pruned}
@@ -0,0 +1,58 @@
+"""
+JSON encoding for the hot endpoints.
+
+Uses orjson, which is in requirements.txt (it encodes dataclasses,
+including the slotted records in records.py, natively and returns bytes
+directly). The stdlib json module is only a fallback for environments
+that don't have it installed.
+"""
+import dataclasses
+import json
+from typing import Any
+
+from fastapi.responses import Response
+
+from metrics import stage
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value: Any):
+    """stdlib fallback for what orjson handles natively"""
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return {field.name: getattr(value, field.name) for field in dataclasses.fields(value)}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    """
+    Compact UTF-8 JSON, the same bytes FastAPI's JSONResponse would produce for plain data.
+    Untimed, for per-row and per-event encoding; whole responses go through dumps_response().
+    """
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, separators=(",", ":"), default=_default
+    ).encode("utf-8")
+
+
+def dumps_response(content: Any) -> bytes:
+    """dumps() for one response body, recorded once as the serialization stage"""
+    with stage("serialization"):
+        return dumps(content)
+
+
+class FastJSONResponse(Response):
+    """
+    JSON response that skips jsonable_encoder. Return it from an endpoint
+    (rather than returning a dict) so FastAPI hands the content straight to
+    dumps_response(); it may contain dicts, lists, scalars and dataclass records.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps_response(content)
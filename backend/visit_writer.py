@@ -0,0 +1,419 @@
+"""
+Single-writer process for running the API with several uvicorn workers.
+
+SQLite allows one writer at a time, so instead of every worker opening the
+visitors database for writing (and contending on its lock), one dedicated
+process owns every write: the visit accumulator, the geo enricher, the
+rollups, database maintenance and the reverse geocoder (which also keeps
+Nominatim's one request per second limit global rather than per worker).
+Workers only open read-only connections and forward visits to it over a
+Unix socket:
+
+    VISITORS_DB_PATH=... VISIT_WRITER_SOCKET=/run/portfolio-backend/visit-writer.sock python visit_writer.py
+    VISIT_WRITER_SOCKET=/run/portfolio-backend/visit-writer.sock uvicorn main:app --workers 4
+
+The protocol is one JSON array per line. Workers send [id, op, *args] and
+get back [id, data_version, result] or [id, data_version, null, error]
+(not necessarily in order). Lines with id 0 are sent unprompted whenever
+the data version changes, so the workers' response caches follow writes
+made by the background jobs too.
+
+Workers also send [0, "publish", event] for each visit, without waiting
+for an answer; the writer passes it on to every worker as
+[0, data_version, event], so live visitor streams on any worker see
+visits served by all of them.
+"""
+import asyncio
+import itertools
+import json
+import os
+import signal
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+from database import VisitorDatabase, default_db_path, remove_if_corrupted
+from enrichment import GeoEnricher
+from geocoding import GEOCODE_DEADLINE_SECONDS, GeocodingService
+from geoip import GeoIPDatabase
+from ipranges import IPClassifier
+from logs import log
+from maintenance import DatabaseMaintenance
+from notes import NotesStore
+from rollups import VisitRollups
+from visits import VisitAccumulator
+
+# Longest line either side accepts
+MAX_MESSAGE_BYTES = 64 * 1024
+
+# How often the writer checks whether its data version changed (and tells the workers)
+VERSION_PUSH_INTERVAL_SECONDS = 0.25
+
+# How long a worker waits for the writer to acknowledge a visit
+WRITER_REQUEST_TIMEOUT_SECONDS = 5
+
+# Reconnect backoff for workers that lose (or can't yet reach) the writer
+RECONNECT_MIN_SECONDS = 0.1
+RECONNECT_MAX_SECONDS = 5
+
+# Reverse geocoding answers get this long on top of the geocoder's own deadline to come back
+REVERSE_DEADLINE_MARGIN_SECONDS = 0.5
+
+
+def encode(message) -> bytes:
+    return json.dumps(message, separators=(",", ":")).encode() + b"\n"
+
+
+class VisitWriter:
+    """
+    The writer process: opens the visitors database for writing, runs every
+    job that writes to it and serves the workers on a Unix socket.
+    """
+
+    def __init__(self, db_path: Path, socket_path: Path):
+        self.db_path = db_path
+        self.socket_path = socket_path
+        self.db: Optional[VisitorDatabase] = None
+        self.accumulator: Optional[VisitAccumulator] = None
+        self.geoip = GeoIPDatabase()
+        self.geocoder: Optional[GeocodingService] = None
+        self.enricher: Optional[GeoEnricher] = None
+        self.rollups: Optional[VisitRollups] = None
+        self.maintenance: Optional[DatabaseMaintenance] = None
+        self.classifier = IPClassifier.from_env()
+        self.requests = 0
+        self.errors = 0
+        self.events = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Dict[asyncio.StreamWriter, None] = {}
+        self._version_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Open the database and start the jobs, then listen; workers can connect once the schema exists"""
+        remove_if_corrupted(self.db_path)
+        db = VisitorDatabase(self.db_path)
+        await db.open()
+        self.db = db
+        log(f"Visitors database opened for writing: {self.db_path}")
+        await NotesStore(db).seed()
+
+        self.accumulator = VisitAccumulator(db)
+        self.accumulator.start()
+
+        try:
+            self.geoip.load()
+        except Exception as e:
+            log(f"Error loading GeoLite2 database: {e}", level="error", exc_info=True)
+        self.geoip.start()
+        try:
+            self.geocoder = GeocodingService.from_env(db)
+        except Exception as e:
+            log(f"Failed to initialize geopy: {e}", level="error")
+
+        self.enricher = GeoEnricher(db, lambda: self.geoip.lookup, lambda: self.geocoder, self.classifier.is_special)
+        self.enricher.start()
+        self.geoip.on_reload = self.enricher.wake
+        self.rollups = VisitRollups(db)
+        self.rollups.start()
+        self.maintenance = DatabaseMaintenance(db)
+        await self.maintenance.start()
+
+        if self.socket_path.exists():
+            self.socket_path.unlink()  # Left behind by a writer that didn't shut down cleanly
+        self._server = await asyncio.start_unix_server(
+            self._serve, path=str(self.socket_path), limit=MAX_MESSAGE_BYTES
+        )
+        self._version_task = asyncio.create_task(self._push_versions())
+        log(f"Visit writer listening on {self.socket_path}")
+
+    async def stop(self):
+        """Stop accepting visits, write out everything pending and close the database"""
+        if self._server is not None:
+            self._server.close()
+            for connection in list(self._connections):
+                connection.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._version_task is not None:
+            self._version_task.cancel()
+            try:
+                await self._version_task
+            except asyncio.CancelledError:
+                pass
+            self._version_task = None
+        for job in (self.maintenance, self.rollups, self.enricher):
+            if job is not None:
+                await job.stop()
+        await self.geoip.stop()
+        self.geoip.close()
+        if self.geocoder is not None:
+            self.geocoder.close()
+        if self.accumulator is not None:
+            await self.accumulator.stop()
+        if self.db is not None:
+            await self.db.close()
+            log("Visitors database checkpointed on shutdown")
+        try:
+            self.socket_path.unlink()
+        except FileNotFoundError:
+            pass
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """One worker's connection; each request runs as its own task so a slow geocode doesn't hold up visits"""
+        self._connections[writer] = None
+        tasks = set()
+        try:
+            writer.write(encode([0, self.db.data_version, None]))
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.create_task(self._answer(line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError) as e:
+            log(f"Visit writer connection error: {e}", level="warning")
+        finally:
+            self._connections.pop(writer, None)
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def _answer(self, line: bytes, writer: asyncio.StreamWriter):
+        request_id = None
+        try:
+            request_id, op, *args = json.loads(line)
+            if request_id == 0:
+                self.notify(op, *args)
+                return
+            self.requests += 1
+            reply = [request_id, None, await self.handle(op, *args)]
+        except Exception as e:
+            self.errors += 1
+            log(f"Error handling visit writer request: {e}", level="error", exc_info=True)
+            if request_id == 0:
+                return  # Notifications get no answer, not even an error
+            reply = [request_id, None, None, str(e)]
+        reply[1] = self.db.data_version
+        if not writer.is_closing():
+            writer.write(encode(reply))
+            await writer.drain()
+
+    async def handle(self, op: str, *args):
+        """Run one worker request; the return value is sent back as the result"""
+        if op == "record":
+            ip, referer = args
+            visit_count, last_referer = await self.accumulator.record(ip, referer)
+            if visit_count == 1 and self.enricher is not None:
+                # First visit from this IP: store its geo fields in the background
+                self.enricher.wake()
+            return [visit_count, last_referer]
+        if op == "reverse":
+            lat, lng = args
+            if self.geocoder is None:
+                return None
+            return await self.geocoder.reverse(lat, lng)
+        if op == "stats":
+            return self.stats()
+        raise ValueError(f"Unknown visit writer request {op!r}")
+
+    def notify(self, op: str, *args):
+        """Handle a worker message that expects no answer"""
+        if op == "publish":
+            event, = args
+            self.events += 1
+            self._broadcast(encode([0, self.db.data_version, event]))
+            return
+        raise ValueError(f"Unknown visit writer notification {op!r}")
+
+    def _broadcast(self, message: bytes):
+        for connection in list(self._connections):
+            if not connection.is_closing():
+                connection.write(message)
+
+    async def _push_versions(self):
+        version = self.db.data_version
+        while True:
+            await asyncio.sleep(VERSION_PUSH_INTERVAL_SECONDS)
+            if self.db.data_version == version:
+                continue
+            version = self.db.data_version
+            self._broadcast(encode([0, version, None]))
+
+    def stats(self) -> dict:
+        return {
+            "workers_connected": len(self._connections),
+            "requests": self.requests,
+            "errors": self.errors,
+            "events": self.events,
+            "commits": self.db.commits,
+            "data_version": self.db.data_version,
+            "visits_pending": self.accumulator.pending_visitors,
+            "visit_events_pending": self.accumulator.pending_events,
+            "maintenance": self.maintenance.stats() if self.maintenance is not None else None,
+            "rollups": self.rollups.stats() if self.rollups is not None else None,
+            "geocode": self.geocoder.stats() if self.geocoder is not None else None,
+        }
+
+
+class VisitWriterClient:
+    """
+    A worker's connection to the visit writer. record() has the same
+    signature as VisitAccumulator.record, so main.py can use either.
+
+    The connection is (re)established in the background; while it is down
+    calls raise ConnectionError straight away rather than queueing visits.
+    on_version is called whenever the writer's data version changes, and
+    on_event with every event any worker published.
+    """
+
+    def __init__(
+        self,
+        socket_path: Path,
+        on_version: Optional[Callable[[int], None]] = None,
+        on_event: Optional[Callable[[dict], None]] = None,
+    ):
+        self.socket_path = socket_path
+        self.on_version = on_version
+        self.on_event = on_event
+        self.version: Optional[int] = None
+        self.reconnects = 0
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connected = asyncio.Event()
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count(1)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def wait_connected(self, timeout: float) -> bool:
+        """Wait until the writer accepts our connection (it only listens once the schema exists)"""
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    @property
+    def in_flight(self) -> int:
+        """Requests sent to the writer and not answered yet"""
+        return len(self._pending)
+
+    async def record(self, ip: str, referer: Optional[str] = None) -> Tuple[int, Optional[str]]:
+        """Count one visit from ip in the writer process and return its (visit_count, last_referer)"""
+        visit_count, last_referer = await self._call("record", ip, referer)
+        return visit_count, last_referer
+
+    async def reverse(self, lat: float, lng: float) -> Optional[str]:
+        """Street location from the writer's geocoder, or None if it misses the deadline"""
+        try:
+            return await self._call("reverse", lat, lng, timeout=GEOCODE_DEADLINE_SECONDS + REVERSE_DEADLINE_MARGIN_SECONDS)
+        except asyncio.TimeoutError:
+            return None
+
+    async def stats(self) -> dict:
+        return await self._call("stats")
+
+    def publish(self, event: dict):
+        """Pass an event to every worker's on_event, this one included; dropped while disconnected"""
+        writer = self._writer
+        if writer is not None and not writer.is_closing():
+            writer.write(encode([0, "publish", event]))
+
+    async def _call(self, op: str, *args, timeout: float = WRITER_REQUEST_TIMEOUT_SECONDS):
+        writer = self._writer
+        if writer is None:
+            raise ConnectionError("Not connected to the visit writer")
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            writer.write(encode([request_id, op, *args]))
+            await writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def _run(self):
+        delay = RECONNECT_MIN_SECONDS
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(str(self.socket_path), limit=MAX_MESSAGE_BYTES)
+            except OSError:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_SECONDS)
+                continue
+            delay = RECONNECT_MIN_SECONDS
+            self._writer = writer
+            self._connected.set()
+            log(f"Connected to visit writer at {self.socket_path}")
+            try:
+                await self._read_replies(reader)
+            except (ConnectionError, asyncio.LimitOverrunError, ValueError) as e:
+                log(f"Visit writer connection error: {e}", level="warning")
+            finally:
+                self._writer = None
+                self._connected.clear()
+                writer.close()
+                for future in self._pending.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError("Visit writer connection lost"))
+            self.reconnects += 1
+            log("Lost connection to visit writer, reconnecting", level="warning")
+
+    async def _read_replies(self, reader: asyncio.StreamReader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            request_id, version, result, *error = json.loads(line)
+            if version != self.version:
+                self.version = version
+                if self.on_version is not None:
+                    self.on_version(version)
+            if request_id == 0:
+                if result is not None and self.on_event is not None:
+                    self.on_event(result)
+                continue
+            future = self._pending.get(request_id)
+            if future is None or future.done():
+                continue  # The caller already gave up
+            if error:
+                future.set_exception(RuntimeError(f"Visit writer error: {error[0]}"))
+            else:
+                future.set_result(result)
+
+
+async def run(db_path: Path, socket_path: Path):
+    writer = VisitWriter(db_path, socket_path)
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+    try:
+        await writer.start()
+        await stopping.wait()
+        log("Visit writer shutting down")
+    finally:
+        await writer.stop()
+
+
+def main():
+    socket_path = os.environ.get("VISIT_WRITER_SOCKET")
+    if not socket_path:
+        raise SystemExit("Set VISIT_WRITER_SOCKET to the Unix socket path the workers connect to")
+    asyncio.run(run(default_db_path(), Path(socket_path)))
+
+
+if __name__ == "__main__":
+    main()
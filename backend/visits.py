@@ -0,0 +1,269 @@
+import asyncio
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from database import VisitorDatabase
+from logs import log
+from metrics import stage
+
+# Pending visits are written to SQLite at least this often...
+VISIT_FLUSH_INTERVAL_MS = 500
+# ...or as soon as this many visits have accumulated, whichever comes first
+VISIT_FLUSH_MAX_EVENTS = 200
+
+# How many persisted visit counts to remember so repeat visitors skip the DB read
+PERSISTED_COUNT_CACHE_SIZE = 50_000
+
+# Changes whenever another connection (e.g. an access log import) commits to the database
+SELECT_DATA_VERSION_SQL = "PRAGMA data_version"
+
+UPSERT_VISITS_SQL = """
+    INSERT INTO visitors (ip, visit_count, first_visit, last_visit, last_referer)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(ip) DO UPDATE SET
+        visit_count = visit_count + excluded.visit_count,
+        last_visit = excluded.last_visit,
+        last_referer = excluded.last_referer
+"""
+
+# Same upsert for a single visit, handing back the new state in the same round trip
+UPSERT_VISIT_RETURNING_SQL = UPSERT_VISITS_SQL + "    RETURNING visit_count, last_referer\n"
+
+INSERT_VISIT_EVENT_SQL = "INSERT INTO visits (ts, ip, referer) VALUES (?, ?, ?)"
+
+SELECT_VISITOR_SQL = "SELECT visit_count, last_referer FROM visitors WHERE ip = ?"
+
+
+class PendingVisit:
+    """Visits from one IP that have not been written to SQLite yet"""
+
+    __slots__ = ("base", "delta", "first_visit", "last_visit", "last_referer")
+
+    def __init__(self, base: int, now: str):
+        self.base = base  # Visit count already persisted when this entry was created
+        self.delta = 0
+        self.first_visit = now
+        self.last_visit = now
+        self.last_referer = ""
+
+    @property
+    def visit_count(self) -> int:
+        return self.base + self.delta
+
+
+class VisitAccumulator:
+    """
+    Write-behind visit counter.
+
+    Visits are counted in memory straight away and a background task writes
+    every pending delta to SQLite in one transaction, so page views never
+    wait on a commit. Counts handed back to callers are the persisted count
+    plus whatever is still pending. Each visit is also appended to the visits
+    event log in the same transaction.
+
+    With write_behind=False every visit is instead written immediately with a
+    single INSERT ... ON CONFLICT DO UPDATE ... RETURNING statement, which is
+    atomic, so concurrent visits from one IP can't overwrite each other.
+
+    Persisted counts are remembered for repeat visitors. Other processes
+    (access_logs.py, geo_backfill.py) write to the same database, so every
+    write first checks SQLite's data_version and forgets them all if another
+    connection has committed since. Stored counts are only ever incremented
+    in SQL, so a stale entry can only make the count shown to a visitor lag
+    until the next write.
+    """
+
+    def __init__(
+        self,
+        db: VisitorDatabase,
+        flush_interval_ms: int = VISIT_FLUSH_INTERVAL_MS,
+        flush_max_events: int = VISIT_FLUSH_MAX_EVENTS,
+        write_behind: bool = True,
+    ):
+        self.db = db
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_max_events = flush_max_events
+        self._pending: Dict[str, PendingVisit] = {}
+        self._flushing: Dict[str, PendingVisit] = {}
+        self._persisted: "OrderedDict[str, Tuple[int, str]]" = OrderedDict()
+        # PRAGMA data_version on the writer connection at the last write
+        self._sqlite_data_version: Optional[int] = None
+        self._pending_events = 0
+        # (ts, ip, referer) for every visit not yet appended to the visits table
+        self._events: List[Tuple[str, str, str]] = []
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start the background flush task"""
+        if self._task is None and self.write_behind:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Stop the background task and write out everything still pending"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    @property
+    def pending_visitors(self) -> int:
+        """IPs with visits not written to SQLite yet"""
+        return len(self._pending)
+
+    @property
+    def pending_events(self) -> int:
+        """Visit events not written to SQLite yet"""
+        return len(self._events)
+
+    async def record(self, ip: str, referer: Optional[str] = None) -> Tuple[int, Optional[str]]:
+        """Count one visit from ip and return its (visit_count, last_referer)"""
+        now = datetime.utcnow().isoformat()
+        if not self.write_behind:
+            return await self._record_now(ip, referer or '', now)
+
+        entry = self._pending.get(ip)
+        if entry is None:
+            base, _ = await self._known_state(ip)
+            # Another request from the same IP may have created the entry while we waited
+            entry = self._pending.get(ip)
+            if entry is None:
+                entry = PendingVisit(base, now)
+                self._pending[ip] = entry
+
+        entry.delta += 1
+        entry.last_visit = now
+        entry.last_referer = referer or ''
+        self._events.append((now, ip, entry.last_referer))
+
+        self._pending_events += 1
+        if self._pending_events >= self.flush_max_events:
+            self._wakeup.set()
+        return entry.visit_count, entry.last_referer or None
+
+    async def _record_now(self, ip: str, referer: str, now: str) -> Tuple[int, Optional[str]]:
+        """Write one visit straight to SQLite with a single upsert"""
+        with stage("db_upsert"):
+            async with self.db.writer() as conn:
+                await self._check_external_writes(conn)
+                cursor = await conn.execute(UPSERT_VISIT_RETURNING_SQL, (ip, 1, now, now, referer))
+                row = await cursor.fetchone()
+                await cursor.close()
+                await conn.execute(INSERT_VISIT_EVENT_SQL, (now, ip, referer))
+        self.db.bump_data_version()
+        self._remember(ip, (row[0], row[1] or ''))
+        return row[0], row[1] or None
+
+    async def get(self, ip: str) -> Tuple[int, Optional[str]]:
+        """Return (visit_count, last_referer) for ip, including pending visits"""
+        entry = self._pending.get(ip)
+        if entry is not None:
+            return entry.visit_count, entry.last_referer or None
+        visit_count, last_referer = await self._known_state(ip)
+        return visit_count, last_referer or None
+
+    async def _known_state(self, ip: str) -> Tuple[int, str]:
+        """Visit count and referer for ip, ignoring the pending (not yet flushing) entry"""
+        entry = self._flushing.get(ip)
+        if entry is not None:
+            return entry.visit_count, entry.last_referer
+
+        state = self._persisted.get(ip)
+        if state is not None:
+            self._persisted.move_to_end(ip)
+            return state
+
+        async with self.db.reader() as conn:
+            cursor = await conn.execute(SELECT_VISITOR_SQL, (ip,))
+            row = await cursor.fetchone()
+        state = (row[0], row[1] or '') if row else (0, '')
+        self._remember(ip, state)
+        return state
+
+    async def _check_external_writes(self, conn) -> bool:
+        """Forget the remembered counts if another connection has committed since the last check"""
+        cursor = await conn.execute(SELECT_DATA_VERSION_SQL)
+        version = (await cursor.fetchone())[0]
+        await cursor.close()
+        # Unknown before the first write, when anything remembered so far may already be out of date
+        changed = version != self._sqlite_data_version
+        self._sqlite_data_version = version
+        if changed:
+            self._persisted.clear()
+        return changed
+
+    def _remember(self, ip: str, state: Tuple[int, str]):
+        self._persisted[ip] = state
+        self._persisted.move_to_end(ip)
+        while len(self._persisted) > PERSISTED_COUNT_CACHE_SIZE:
+            self._persisted.popitem(last=False)
+
+    async def flush(self) -> int:
+        """Write all pending visits in a single transaction; returns the number of IPs written"""
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+
+            batch = self._pending
+            events = self._events
+            self._pending = {}
+            self._events = []
+            self._flushing = batch
+            self._pending_events = 0
+            external_writes = False
+            try:
+                with stage("db_upsert"):
+                    async with self.db.writer() as conn:
+                        external_writes = await self._check_external_writes(conn)
+                        await conn.executemany(
+                            UPSERT_VISITS_SQL,
+                            [
+                                (ip, entry.delta, entry.first_visit, entry.last_visit, entry.last_referer)
+                                for ip, entry in batch.items()
+                            ],
+                        )
+                        await conn.executemany(INSERT_VISIT_EVENT_SQL, events)
+            except BaseException:
+                self._requeue(batch)
+                self._events = events + self._events
+                raise
+            finally:
+                self._flushing = {}
+            self.db.bump_data_version()
+
+            # The batch's counts were based on what we remembered before another process wrote
+            if not external_writes:
+                for ip, entry in batch.items():
+                    self._remember(ip, (entry.visit_count, entry.last_referer))
+            return len(batch)
+
+    def _requeue(self, batch: Dict[str, PendingVisit]):
+        """Put a batch that failed to write back in front of anything recorded since"""
+        for ip, entry in batch.items():
+            newer = self._pending.get(ip)
+            if newer is None:
+                self._pending[ip] = entry
+            else:
+                newer.base = entry.base
+                newer.delta += entry.delta
+                newer.first_visit = entry.first_visit
+            self._pending_events += entry.delta
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                log(f"Error flushing visits: {e}", level="error", exc_info=True)
@@ -8,7 +8,7 @@ function Notes() {
     // FIXED: Use relative path for production
     fetch('/api/notes')
       .then(res => res.json())
-      .then(data => setNotes(data))
+      .then(data => setNotes(data.notes || []))
       .catch(err => console.error("Failed to fetch notes:", err));
   }, []);
 
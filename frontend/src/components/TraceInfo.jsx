@@ -1,6 +1,30 @@
 import { useState, useEffect } from 'react';
 import { useFingerprint } from '../contexts/FingerprintContext';
 
+// /api/visitors is paginated; the wall follows next_cursor until it has every visitor
+const VISITORS_PAGE_LIMIT = 1000;
+
+async function fetchAllVisitors() {
+  const visitors = [];
+  let total = 0;
+  let cursor = null;
+  do {
+    const params = new URLSearchParams({ limit: VISITORS_PAGE_LIMIT });
+    if (cursor) {
+      params.set('cursor', cursor);
+    }
+    const response = await fetch(`/api/visitors?${params}`);
+    if (!response.ok) {
+      throw new Error(`Visitors API returned error: ${response.status}`);
+    }
+    const page = await response.json();
+    visitors.push(...(page.visitors || []));
+    total = page.total;
+    cursor = page.next_cursor;
+  } while (cursor);
+  return { visitors, total };
+}
+
 function TraceInfo({ theme, accentColor, colorOptions }) {
   const { fingerprintData, fingerprintLoading } = useFingerprint();
   const [clientInfo, setClientInfo] = useState(null);
@@ -47,14 +71,9 @@ function TraceInfo({ theme, accentColor, colorOptions }) {
       // Fetch all visitors for the wall
       try {
         console.log('Fetching all visitors...');
-        const visitorsResponse = await fetch('/api/visitors');
-        if (visitorsResponse.ok) {
-          const visitorsData = await visitorsResponse.json();
-          console.log('Visitors data:', visitorsData);
-          setAllVisitors(visitorsData);
-        } else {
-          console.warn('Visitors API returned error:', visitorsResponse.status);
-        }
+        const visitorsData = await fetchAllVisitors();
+        console.log('Visitors data:', visitorsData);
+        setAllVisitors(visitorsData);
       } catch (err) {
         console.warn('Visitors API not available:', err);
       }
@@ -65,6 +84,57 @@ function TraceInfo({ theme, accentColor, colorOptions }) {
     loadInfo();
   }, [fingerprintData, fingerprintLoading]);
 
+  // Keep the wall live: merge each visit from the stream instead of re-fetching the list
+  const wallLoaded = allVisitors !== null;
+  useEffect(() => {
+    if (!wallLoaded || typeof EventSource === 'undefined') {
+      return;
+    }
+    const source = new EventSource('/api/visitors/stream');
+    let connectedBefore = false;
+
+    source.onopen = async () => {
+      // Events sent while we were disconnected are gone, so reload the list after a reconnect
+      if (connectedBefore) {
+        try {
+          setAllVisitors(await fetchAllVisitors());
+        } catch (err) {
+          console.warn('Visitors API not available:', err);
+        }
+      }
+      connectedBefore = true;
+    };
+
+    source.addEventListener('visitor', (event) => {
+      const visitor = JSON.parse(event.data);
+      setAllVisitors((current) => {
+        if (!current || !current.visitors) {
+          return current;
+        }
+        const loaded = current.visitors.some((v) => v.ip === visitor.ip);
+        // Only a first visit is a new visitor; a returning one missing from the list is left alone
+        if (!loaded) {
+          if (visitor.visit_count !== 1) {
+            return current;
+          }
+          return { ...current, visitors: [visitor, ...current.visitors], total: current.total + 1 };
+        }
+        return {
+          ...current,
+          visitors: current.visitors.map((v) => (v.ip !== visitor.ip ? v : {
+            ...v,
+            visit_count: visitor.visit_count,
+            last_visit: visitor.last_visit,
+            geo: visitor.geo || v.geo,
+            streetLocation: visitor.streetLocation || v.streetLocation,
+          })),
+        };
+      });
+    });
+
+    return () => source.close();
+  }, [wallLoaded]);
+
   if (loading || fingerprintLoading || !clientInfo) {
     return (
       <div style={{